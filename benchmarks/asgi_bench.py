@@ -0,0 +1,81 @@
+"""
+Helpers for benchmarking ASGI middleware in process, requests are sent directly to the ASGI callable so the
+numbers reflect middleware overhead rather than network or server costs.
+"""
+import asyncio
+import statistics
+from time import perf_counter
+from typing import Dict, List, Sequence, Tuple
+
+from starlette.types import ASGIApp, Message
+
+
+def build_scope(method: str = 'GET', path: str = '/', headers: Sequence[Tuple[str, str]] = ()) -> Dict:
+    raw_headers = [(b'host', b'testserver'), (b'user-agent', b'benchmark')]
+    raw_headers += [(k.lower().encode(), v.encode()) for k, v in headers]
+    return {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': method,
+        'path': path,
+        'raw_path': path.encode(),
+        'root_path': '',
+        'scheme': 'http',
+        'query_string': b'',
+        'headers': raw_headers,
+        'client': ('127.0.0.1', 50000),
+        'server': ('testserver', 80),
+    }
+
+
+async def request(app: ASGIApp, scope: Dict) -> int:
+    status = 0
+    received = False
+
+    async def receive() -> Message:
+        nonlocal received
+        if received:
+            # like a server, wait for the client to disconnect, which never happens here
+            await asyncio.Event().wait()
+        received = True
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message: Message) -> None:
+        nonlocal status
+        if message['type'] == 'http.response.start':
+            status = message['status']
+
+    await app(dict(scope), receive, send)
+    return status
+
+
+async def run(app: ASGIApp, scope: Dict, *, requests: int, warmup: int = 200) -> List[float]:
+    for _ in range(warmup):
+        await request(app, scope)
+
+    timings = []
+    for _ in range(requests):
+        start = perf_counter()
+        await request(app, scope)
+        timings.append(perf_counter() - start)
+    return timings
+
+
+def summarise(name: str, timings: List[float]) -> str:
+    total = sum(timings)
+    p99 = statistics.quantiles(timings, n=100)[98]
+    return (
+        f'{name:>30}: {len(timings) / total:10,.0f} req/s  '
+        f'mean {statistics.mean(timings) * 1e6:7.1f}µs  p99 {p99 * 1e6:7.1f}µs'
+    )
+
+
+def compare(apps: Dict[str, ASGIApp], scope: Dict, *, requests: int = 20_000) -> None:
+    loop = asyncio.new_event_loop()
+    try:
+        for name, app in apps.items():
+            timings = loop.run_until_complete(run(app, scope, requests=requests))
+            print(summarise(name, timings))
+    finally:
+        loop.close()
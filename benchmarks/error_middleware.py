@@ -0,0 +1,168 @@
+"""
+Compare the per-request overhead of the raw ASGI ErrorMiddleware with the previous BaseHTTPMiddleware
+implementation.
+
+Usage:
+    python benchmarks/error_middleware.py [requests]
+"""
+import sys
+from typing import Any, AsyncGenerator, Awaitable, Callable, Dict, List, Optional
+
+from asgi_bench import build_scope, compare
+from sentry_sdk import capture_event
+from sentry_sdk.utils import event_from_exception, exc_info_from_error
+from starlette.applications import Starlette
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse, Response, StreamingResponse
+
+from foxglove import BaseSettings, glove
+from foxglove.middleware import (
+    CallNext,
+    ErrorMiddleware,
+    get_request_start,
+    line_one,
+    logger,
+    request_log_extra,
+    request_logger,
+)
+from foxglove.utils import get_ip
+
+
+class LegacyErrorMiddleware(BaseHTTPMiddleware):
+    """
+    ErrorMiddleware as it was implemented with BaseHTTPMiddleware, copied unchanged from before the raw ASGI
+    rewrite so the comparison is against the real baseline.
+    """
+
+    def __init__(
+        self,
+        app: Starlette,
+        should_warn: Callable[[Response], bool] = None,
+        get_user: Callable[[Request], Awaitable[Dict[str, Any]]] = None,
+    ):
+        super().__init__(app)
+        self.custom_should_warn = should_warn
+        self.get_user = get_user
+
+        from foxglove.main import glove
+
+        self.glove = glove
+
+    async def dispatch(self, request: Request, call_next: CallNext) -> Response:
+        try:
+            request.state.start_time = get_request_start(request)
+
+            try:
+                response = await call_next(request)
+            except Exception as exc:
+                await self.log(request, exc=exc)
+                return Response('Internal Server Error', media_type='text/plain', status_code=500)
+            else:
+                if self.should_warn(response):
+                    await self.log(request, response=response)
+                return response
+        except Exception:  # pragma: no cover
+            # not sure if this is required, but better to keep it
+            logger.critical('unhandled error in ErrorMiddleware', exc_info=True)
+            raise
+
+    async def log(
+        self, request: Request, *, exc: Optional[Exception] = None, response: Optional[Response] = None
+    ) -> None:
+        event_data = await request_log_extra(request, exc, response)
+        event_data['user'] = await self.user_info(request)
+        view_ref = event_data['transaction']
+
+        if exc:
+            level = 'error'
+            message = f'"{line_one(request)}", {exc!r}'
+            fingerprint = view_ref, request.method, repr(exc)
+            request_logger.exception(message, extra=event_data)
+        else:
+            assert response is not None
+            level = 'warning'
+            message = f'"{line_one(request)}", unexpected response: {response.status_code}'
+            request_logger.warning(message, extra=event_data)
+            fingerprint = view_ref, request.method, str(response.status_code)
+
+        if glove.settings.sentry_dsn:
+            hint = None
+            if exc:
+                exc_data, hint = event_from_exception(exc_info_from_error(exc))
+                event_data.update(exc_data)
+
+            event_data.update(message=message, level=level, logger='foxglove.request_errors', fingerprint=fingerprint)
+            if not capture_event(event_data, hint):
+                logger.critical(
+                    'sentry not configured correctly, not sending message: %s',
+                    message,
+                    extra={'event_data': event_data},
+                )
+
+    def should_warn(self, response: Response) -> bool:
+        if self.custom_should_warn:
+            return self.custom_should_warn(response)
+        else:
+            return response.status_code > 310
+
+    async def user_info(self, request: Request) -> Dict[str, Any]:
+        user = dict(ip_address=get_ip(request))
+        if get_user := self.get_user:
+            try:
+                user.update(await get_user(request))
+            except Exception:
+                logger.exception('error getting user for middleware logging')
+        return user
+
+    @staticmethod
+    async def response_body(response: Response) -> bytes:
+        if hasattr(response, 'body'):
+            return response.body
+        else:
+            body_chunks = []
+            async for chunk in response.body_iterator:
+                if not isinstance(chunk, bytes):
+                    chunk = chunk.encode(response.charset)
+                body_chunks.append(chunk)
+
+            response.body_iterator = async_gen_list(body_chunks)
+            return b''.join(body_chunks)
+
+
+async def async_gen_list(list_: List[bytes]) -> AsyncGenerator[bytes, None]:
+    for c in list_:
+        yield c
+
+
+async def plain_app(scope, receive, send):
+    await PlainTextResponse('hello world')(scope, receive, send)
+
+
+async def streaming_app(scope, receive, send):
+    async def body():
+        for _ in range(20):
+            yield b'x' * 1024
+
+    await StreamingResponse(body())(scope, receive, send)
+
+
+def main(requests: int) -> None:
+    # ErrorMiddleware reads glove.settings on every request
+    glove._settings = BaseSettings(test_mode=True)
+    scope = build_scope()
+    for label, app in ('plain response', plain_app), ('streaming response', streaming_app):
+        print(f'{label}:')
+        compare(
+            {
+                'no middleware': app,
+                'BaseHTTPMiddleware': LegacyErrorMiddleware(app),
+                'ErrorMiddleware (ASGI)': ErrorMiddleware(app),
+            },
+            scope,
+            requests=requests,
+        )
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20_000)
@@ -0,0 +1,61 @@
+"""
+Compare the per-request overhead of the layered foxglove middleware stack with FoxgloveMiddleware which fuses
+the same behaviours into a single ASGI layer.
+
+Usage:
+    python benchmarks/middleware_stack.py [requests]
+"""
+import sys
+
+from asgi_bench import build_scope, compare
+from starlette.middleware.sessions import SessionMiddleware
+from starlette.responses import PlainTextResponse
+
+from foxglove import BaseSettings, glove
+from foxglove.db import PgMiddleware
+from foxglove.middleware import CloudflareCheckMiddleware, CsrfMiddleware, ErrorMiddleware, HostRedirectMiddleware
+from foxglove.stack import FoxgloveMiddleware
+
+host = 'testserver'
+
+
+async def plain_app(scope, receive, send):
+    await PlainTextResponse('hello world')(scope, receive, send)
+
+
+def layered(app, *, origin_checks: bool):
+    settings = glove.settings
+    app = PgMiddleware(app)
+    app = CsrfMiddleware(app)
+    app = SessionMiddleware(
+        app, secret_key=settings.secret_key, session_cookie=settings.cookie_name, same_site='strict'
+    )
+    if origin_checks:
+        app = CloudflareCheckMiddleware(app)
+        app = HostRedirectMiddleware(app, host=host)
+    return ErrorMiddleware(app)
+
+
+def main(requests: int) -> None:
+    glove._settings = BaseSettings(test_mode=True, cloudflare_ips_refresh_interval=None)
+    # a request from a cloudflare IP to the right host, all checks pass
+    scope = build_scope(headers=[('X-Forwarded-For', '173.245.48.1')])
+    for origin_checks in False, True:
+        label = 'error, session, csrf and pg' + (', host redirect and cloudflare check' if origin_checks else '')
+        print(f'{label}:')
+        fused = FoxgloveMiddleware(
+            plain_app, host_redirect=host if origin_checks else None, cloudflare_check=origin_checks
+        )
+        compare(
+            {
+                'no middleware': plain_app,
+                'layered middleware': layered(plain_app, origin_checks=origin_checks),
+                'FoxgloveMiddleware': fused,
+            },
+            scope,
+            requests=requests,
+        )
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20_000)
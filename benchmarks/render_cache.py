@@ -0,0 +1,42 @@
+"""
+Compare buildpg's render with RenderCache for some typical queries.
+
+Usage:
+    python benchmarks/render_cache.py [iterations]
+"""
+import sys
+from timeit import timeit
+
+from buildpg import V, Values, funcs, render
+
+from foxglove.db.render import RenderCache
+
+cases = {
+    'plain values': ('select id, name from users where org=:org and id=:id', lambda: dict(org=1, id=2)),
+    'where clause': (
+        'select id, name from users where :where order by id limit :limit',
+        lambda: dict(where=funcs.AND(V('org') == 1, V('status') == 'active', V('id') > 42), limit=10),
+    ),
+    'insert': (
+        'insert into users (:values__names) values :values returning id',
+        lambda: dict(values=Values(org=1, name='x', email='x@example.com')),
+    ),
+}
+
+
+def main(iterations: int):
+    cache = RenderCache()
+    for name, (template, get_ctx) in cases.items():
+        # components can be rendered many times, so the context is only built once to time just rendering
+        ctx = get_ctx()
+        assert cache(template, **ctx) == render(template, **ctx)
+        t_render = timeit(lambda: render(template, **ctx), number=iterations)
+        t_cache = timeit(lambda: cache(template, **ctx), number=iterations)
+        print(
+            f'{name:>14}: render {t_render / iterations * 1e6:6.2f}µs, '
+            f'cached {t_cache / iterations * 1e6:6.2f}µs ({t_render / t_cache:0.1f}x)'
+        )
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50_000)
@@ -13,6 +13,7 @@ from uvicorn.main import run as uvicorn_run
 
 from foxglove.logs import build_logging_config, setup_logging
 
+from .db import prepare_database
 from .main import glove
 from .settings import BaseSettings
 from .version import VERSION
@@ -31,6 +32,13 @@ def _web():
     """
     Run the web server using uvicorn.
     """
+    if not settings.pg_database_prepared:
+        # prepare the database once here rather than in every worker
+        logger.info('preparing database...')
+        asyncio.run(prepare_database(settings, False, run_migrations=not settings.test_mode))
+        # workers inherit the environment variable, startup in this process (if there are no workers) uses settings
+        os.environ['foxglove_database_prepared'] = 'TRUE'
+        settings.pg_database_prepared = True
     logger.info('running web server at %s...', settings.port)
     # wait_for_services(settings)
     uvicorn_run(
@@ -125,6 +133,7 @@ def _patch(
         '-a',
         help='extra arguments to pass to the patch, repeat for multiple arguments, usage: "-a <name>:<value>"',
     ),
+    restart: bool = typer.Option(False, help='for chunked patches, ignore batches completed by previous runs'),
 ):
     """
     Run a patch function to update or modify the database.
@@ -135,7 +144,7 @@ def _patch(
     # wait_for_services(settings)
 
     arg_lookup = {k.replace('-', '_'): v for k, v in (a.split(':', 1) for a in patch_args)}
-    return run_patch(patch_name, live, arg_lookup)
+    return run_patch(patch_name, live, arg_lookup, restart=restart)
 
 
 @cli.command(name='migrations')
@@ -0,0 +1,238 @@
+import asyncio
+import logging
+from bisect import bisect_right
+from collections import OrderedDict
+from ipaddress import ip_address, ip_network
+from typing import TYPE_CHECKING, Awaitable, Callable, Dict, List, Literal, Optional, Sequence
+
+from . import glove
+from .exceptions import UnexpectedResponse
+
+if TYPE_CHECKING:
+    from arq import ArqRedis
+
+logger = logging.getLogger('foxglove.cloudflare')
+
+__all__ = (
+    'IPRangeCounter',
+    'IPRangeIndex',
+    'CloudflareIPStore',
+    'IPSource',
+    'download_cloudflare_ips',
+    'get_cloudflare_ips',
+    'cloudflare_ips_snapshot',
+)
+
+IPSource = Callable[[], Awaitable[List[str]]]
+
+# from https://www.cloudflare.com/ips/, used until a fresh list is available from redis or a download
+cloudflare_ips_snapshot = (
+    '173.245.48.0/20',
+    '103.21.244.0/22',
+    '103.22.200.0/22',
+    '103.31.4.0/22',
+    '141.101.64.0/18',
+    '108.162.192.0/18',
+    '190.93.240.0/20',
+    '188.114.96.0/20',
+    '197.234.240.0/22',
+    '198.41.128.0/17',
+    '162.158.0.0/15',
+    '104.16.0.0/13',
+    '104.24.0.0/14',
+    '172.64.0.0/13',
+    '131.0.72.0/22',
+    '2400:cb00::/32',
+    '2606:4700::/32',
+    '2803:f800::/32',
+    '2405:b500::/32',
+    '2405:8100::/32',
+    '2a06:98c0::/29',
+    '2c0f:f248::/32',
+)
+
+
+class IPRangeCounter:
+    __slots__ = 'range', 'counter'
+
+    def __init__(self, network_range: str):
+        self.range = ip_network(network_range)
+        self.counter = 0
+
+    def __repr__(self):
+        return f'IPRangeCounter({self.range}, {self.counter})'
+
+
+class IPRangeIndex:
+    """
+    Find which of a list of network ranges contains an IP address.
+
+    Ranges are stored as sorted integer intervals for each address family so lookups are a bisect, the result for
+    recently seen addresses is also kept in a small LRU cache to avoid parsing the address at all.
+    """
+
+    __slots__ = 'ranges', '_starts', '_ends', '_counters', '_cache', '_cache_size'
+
+    def __init__(self, ranges: List[IPRangeCounter], *, cache_size: int = 1024):
+        self.ranges = ranges
+        self._starts: Dict[int, List[int]] = {4: [], 6: []}
+        self._ends: Dict[int, List[int]] = {4: [], 6: []}
+        self._counters: Dict[int, List[IPRangeCounter]] = {4: [], 6: []}
+        for r in sorted(ranges, key=lambda r_: (r_.range.version, r_.range.network_address, -r_.range.prefixlen)):
+            version = r.range.version
+            start, end = int(r.range.network_address), int(r.range.broadcast_address)
+            ends = self._ends[version]
+            if ends and end <= ends[-1]:
+                # this range is within the previous range, CIDR ranges either nest or are disjoint
+                continue
+            self._starts[version].append(start)
+            ends.append(end)
+            self._counters[version].append(r)
+
+        self._cache: 'OrderedDict[str, Optional[IPRangeCounter]]' = OrderedDict()
+        self._cache_size = cache_size
+
+    def lookup(self, ip: str) -> Optional[IPRangeCounter]:
+        """
+        Find the range containing ip and increment its counter, return None if ip isn't in any range or is invalid.
+        """
+        cache = self._cache
+        try:
+            r = cache[ip]
+        except KeyError:
+            r = cache[ip] = self._find(ip)
+            if len(cache) > self._cache_size:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(ip)
+
+        if r is not None:
+            r.counter += 1
+        return r
+
+    def _find(self, ip: str) -> Optional[IPRangeCounter]:
+        try:
+            address = ip_address(ip.strip())
+        except ValueError:
+            return None
+
+        n = int(address)
+        i = bisect_right(self._starts[address.version], n) - 1
+        if i >= 0 and n <= self._ends[address.version][i]:
+            return self._counters[address.version][i]
+
+    def __len__(self) -> int:
+        return len(self.ranges)
+
+
+class CloudflareIPStore:
+    """
+    Cloudflare IP ranges used by CloudflareCheckMiddleware.
+
+    Ranges start from the bundled snapshot, on startup they're replaced by the list cached in redis (if any) and
+    a background task then refreshes them every refresh_interval seconds. Refreshed lists are shared with other
+    workers via redis so only one worker needs to download the lists each interval.
+
+    Requests never wait for a refresh, the index is swapped once a new list is available.
+    """
+
+    redis_key = 'foxglove:cloudflare-ips'
+
+    def __init__(self, source: Optional[IPSource] = None, *, refresh_interval: Optional[float] = None):
+        self.source: IPSource = source or download_cloudflare_ips
+        self.refresh_interval = refresh_interval
+        self.index = IPRangeIndex([IPRangeCounter(r) for r in cloudflare_ips_snapshot])
+        self.loaded_from = 'snapshot'
+        self._redis: Optional['ArqRedis'] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def startup(self, redis: Optional['ArqRedis'] = None) -> None:
+        self._redis = redis
+        await self.load_cached()
+        if self.refresh_interval and self._task is None:
+            self._task = asyncio.create_task(self._refresh_loop())
+
+    async def shutdown(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._redis = None
+
+    async def load_cached(self) -> bool:
+        """
+        Load ranges from redis if another worker has refreshed them recently.
+        """
+        if self._redis is None:
+            return False
+        cached = await self._redis.get(self.redis_key, encoding='utf8')
+        if cached:
+            self.update(cached.split('\n'), 'redis')
+            return True
+        else:
+            return False
+
+    async def refresh(self) -> bool:
+        """
+        Get a new list of ranges from the source and share it with other workers via redis,
+        errors are logged and the current ranges are kept.
+        """
+        try:
+            ranges = await self.source()
+            self.update(ranges, 'source')
+        except Exception as e:
+            logger.warning('error refreshing Cloudflare IP ranges, keeping %d ranges: %r', len(self.index), e)
+            return False
+
+        if self._redis is not None:
+            await self._redis.setex(self.redis_key, int(self.refresh_interval or 3600), '\n'.join(ranges))
+        return True
+
+    def update(self, ranges: Sequence[str], loaded_from: str) -> None:
+        ranges = [r.strip() for r in ranges if r.strip()]
+        if not ranges:
+            raise ValueError('no Cloudflare IP ranges found')
+        self.index = IPRangeIndex([IPRangeCounter(r) for r in ranges])
+        self.loaded_from = loaded_from
+        logger.info('loaded %d Cloudflare IP ranges from %s', len(ranges), loaded_from)
+
+    async def _refresh_loop(self) -> None:
+        # refresh straight away if we're still using the snapshot
+        delay = self.refresh_interval if self.loaded_from != 'snapshot' else 0
+        while True:
+            await asyncio.sleep(delay)
+            delay = self.refresh_interval
+            try:
+                if not await self.load_cached():
+                    await self.refresh()
+            except Exception:
+                logger.exception('error in CloudflareIPStore refresh loop')
+
+
+async def download_cloudflare_ips() -> List[str]:
+    """
+    Download Cloudflare's IP ranges from glove.settings.cloudflare_ips_url, which defaults to
+    https://www.cloudflare.com/ips-v4 and https://www.cloudflare.com/ips-v6, see https://www.cloudflare.com/en-gb/ips/
+    for details.
+    """
+
+    async def get_ips(v: Literal[4, 6]) -> List[str]:
+        url = glove.settings.cloudflare_ips_url.format(version=v)
+        r = await glove.http.get(url, follow_redirects=True)
+        UnexpectedResponse.check(r)
+        return r.text.strip().split('\n')
+
+    v4_ips, v6_ips = await asyncio.gather(get_ips(4), get_ips(6))
+    return v4_ips + v6_ips
+
+
+async def get_cloudflare_ips() -> List[IPRangeCounter]:
+    """
+    Download a list of Cloudflare IP ranges.
+    """
+    ips = [IPRangeCounter(ip) for ip in await download_cloudflare_ips()]
+    logger.info('downloaded %d IPs from CloudFlare to check requests against', len(ips))
+    return ips
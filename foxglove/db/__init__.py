@@ -1,4 +1,5 @@
 # flake8: noqa
-from .main import create_pg_pool, prepare_database, reset_database
+from .loader import BatchLoader, batch_loader
+from .main import create_pg_pool, create_pg_replica_pools, prepare_database, reset_database
 from .middleware import PgMiddleware
 from .utils import lenient_conn
@@ -0,0 +1,162 @@
+import logging
+from time import perf_counter
+from typing import Any, AsyncIterable, AsyncIterator, Iterable, List, Optional, Sequence, Union
+
+from buildpg.asyncpg import BuildPgConnection
+
+__all__ = 'copy_records', 'upsert_records', 'copy_stream', 'iter_chunks'
+
+logger = logging.getLogger('foxglove.db.patch')
+
+Records = Union[Iterable[Sequence[Any]], AsyncIterable[Sequence[Any]]]
+
+
+async def copy_records(
+    conn: BuildPgConnection,
+    table: str,
+    records: Records,
+    *,
+    columns: Sequence[str],
+    schema: Optional[str] = None,
+    chunk_size: int = 10_000,
+    log: logging.Logger = logger,
+) -> int:
+    """
+    Insert records (tuples in the order of columns) into a table using COPY, records can be an iterable or an async
+    iterable so they can be generated without being held in memory. Records are copied chunk_size at a time and
+    progress is logged after each chunk, returns the number of records copied.
+    """
+    progress = Progress(log, f'copied to {table}')
+    async for chunk in iter_chunks(records, chunk_size):
+        await conn.copy_records_to_table(table, records=chunk, columns=columns, schema_name=schema)
+        progress.update(len(chunk))
+    return progress.finish()
+
+
+async def upsert_records(
+    conn: BuildPgConnection,
+    table: str,
+    records: Records,
+    *,
+    columns: Sequence[str],
+    conflict_columns: Sequence[str],
+    update_columns: Optional[Sequence[str]] = None,
+    schema: Optional[str] = None,
+    chunk_size: int = 10_000,
+    log: logging.Logger = logger,
+) -> int:
+    """
+    Insert or update records: each chunk is copied into a temporary table then inserted with
+    "insert ... on conflict (conflict_columns) do update", update_columns defaults to all columns not in
+    conflict_columns, if it's empty conflicting rows are left unchanged.
+
+    Each chunk runs in its own transaction (or savepoint if the connection is already in a transaction),
+    returns the number of records inserted or updated.
+    """
+    target = quote_ident(table) if schema is None else f'{quote_ident(schema)}.{quote_ident(table)}'
+    if update_columns is None:
+        update_columns = [c for c in columns if c not in conflict_columns]
+    cols = ', '.join(quote_ident(c) for c in columns)
+    if update_columns:
+        updates = ', '.join(f'{quote_ident(c)}=excluded.{quote_ident(c)}' for c in update_columns)
+        on_conflict = f'do update set {updates}'
+    else:
+        on_conflict = 'do nothing'
+    conflict = ', '.join(quote_ident(c) for c in conflict_columns)
+    tmp = 'foxglove_upsert'
+    upsert_sql = f'insert into {target} ({cols}) select {cols} from {tmp} on conflict ({conflict}) {on_conflict}'
+
+    progress = Progress(log, f'upserted into {table}')
+    async for chunk in iter_chunks(records, chunk_size):
+        async with conn.transaction():
+            await conn.execute(f'create temporary table {tmp} (like {target} including defaults)')
+            await conn.copy_records_to_table(tmp, records=chunk, columns=columns)
+            status = await conn.execute(upsert_sql)
+            await conn.execute(f'drop table {tmp}')
+        progress.update(int(status.rsplit(' ', 1)[-1]))
+    return progress.finish()
+
+
+async def copy_stream(
+    conn: BuildPgConnection,
+    table: str,
+    source: AsyncIterable[bytes],
+    *,
+    columns: Optional[Sequence[str]] = None,
+    schema: Optional[str] = None,
+    format: str = 'csv',
+    log: logging.Logger = logger,
+    **copy_kwargs: Any,
+) -> str:
+    """
+    Copy data, e.g. CSV, from an async iterable of bytes into a table, progress is logged by the amount of
+    data read. copy_kwargs are passed to asyncpg's copy_to_table (e.g. header=True), returns the COPY status.
+    """
+    progress = Progress(log, f'bytes copied to {table}', every=10 * 1024 * 1024)
+
+    async def counted() -> AsyncIterator[bytes]:
+        async for data in source:
+            yield data
+            progress.update(len(data))
+
+    status = await conn.copy_to_table(
+        table, source=counted(), columns=columns, schema_name=schema, format=format, **copy_kwargs
+    )
+    progress.finish()
+    return status
+
+
+async def iter_chunks(records: Records, chunk_size: int) -> AsyncIterator[List[Any]]:
+    """
+    Split an iterable or async iterable into lists of up to chunk_size items.
+    """
+    chunk: List[Any] = []
+    if hasattr(records, '__aiter__'):
+        async for record in records:
+            chunk.append(record)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+    else:
+        for record in records:
+            chunk.append(record)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def quote_ident(name: str) -> str:
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+class Progress:
+    """
+    Log progress of a bulk operation each time at least "every" more items have been processed.
+    """
+
+    __slots__ = 'log', 'description', 'every', 'start', 'count', '_next_log'
+
+    def __init__(self, log: logging.Logger, description: str, *, every: int = 1):
+        self.log = log
+        self.description = description
+        self.every = every
+        self.start = perf_counter()
+        self.count = 0
+        self._next_log = every
+
+    def update(self, n: int) -> None:
+        self.count += n
+        if self.count >= self._next_log:
+            self._next_log = self.count + self.every
+            self.log.info('%s %s, %s', f'{self.count:,}', self.description, self._rate())
+
+    def finish(self) -> int:
+        self.log.info('finished, %s %s, %s', f'{self.count:,}', self.description, self._rate())
+        return self.count
+
+    def _rate(self) -> str:
+        duration = perf_counter() - self.start
+        rate = self.count / duration if duration else 0
+        return f'{duration:0.1f}s, {rate:,.0f}/s'
@@ -0,0 +1,31 @@
+from typing import Any, AsyncIterator
+
+from buildpg.asyncpg import BuildPgConnection, Record
+
+from .render import render_cache
+
+__all__ = 'iter_rows', 'iter_rows_b'
+
+
+async def iter_rows(conn: BuildPgConnection, sql: str, *args: Any, prefetch: int = 1000) -> AsyncIterator[Record]:
+    """
+    Iterate over the rows returned by a query using a server side cursor, rows are fetched prefetch at a time so
+    large results don't have to be held in memory.
+
+    The cursor runs in a transaction (or a savepoint if the connection is already in a transaction) which is
+    committed when iteration finishes, the connection can't be used for anything else until then.
+    """
+    async with conn.transaction():
+        async for row in conn.cursor(sql, *args, prefetch=prefetch):
+            yield row
+
+
+async def iter_rows_b(
+    conn: BuildPgConnection, query_template: str, *, prefetch: int = 1000, **ctx: Any
+) -> AsyncIterator[Record]:
+    """
+    iter_rows for a buildpg query template.
+    """
+    sql, args = render_cache(query_template, **ctx)
+    async for row in iter_rows(conn, sql, *args, prefetch=prefetch):
+        yield row
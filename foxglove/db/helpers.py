@@ -80,6 +80,10 @@ class DummyPgConn(_LockedExecute):
     def transaction(self):
         return DummyPgTransaction(self._conn, self._lock, self._transaction_lock, set_lock=self._set_transaction_lock)
 
+    def cursor(self, *args, **kwargs):
+        # cursors must be used in a transaction, which holds the transaction lock
+        return self._conn.cursor(*args, **kwargs)
+
     def __repr__(self) -> str:
         return f'<DummyPgConn {self._conn._addr} {self._conn._params}>'
 
@@ -109,7 +113,7 @@ class DummyPgPool(_LockedExecute):
     Connection or BuildPgConnection, including locking before using the underlying connection.
     """
 
-    def acquire(self):
+    def acquire(self, *, timeout: Optional[float] = None):
         return _ConnAcquire(self._conn, self._lock, self._transaction_lock)
 
     async def close(self):
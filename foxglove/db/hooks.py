@@ -0,0 +1,67 @@
+from typing import Any, Callable, Optional, Sequence, Tuple
+
+__all__ = 'QueryHooksMixin', 'QueryHook', 'AfterQuery', 'query_methods'
+
+# called after the query with its result and the exception it raised, one of which is None
+AfterQuery = Callable[[Any, Optional[Exception]], None]
+# called before each query with the connection, method name, SQL (None for copies) and arguments, can return an
+# AfterQuery to be called once the query has finished
+QueryHook = Callable[[Any, str, Optional[str], Sequence[Any]], Optional[AfterQuery]]
+
+# methods which run queries, hooks are also called for prepare and copies
+query_methods = frozenset({'execute', 'executemany', 'fetch', 'fetchval', 'fetchrow'})
+
+
+class QueryHooksMixin:
+    """
+    Connection mixin which calls each of query_hooks before queries, prepare and copies. Request timings, query
+    instrumentation, repeated query detection and write tracking each add a hook in connection_class rather than
+    wrapping the query methods themselves, so queries pass through one wrapper however many are enabled.
+    """
+
+    query_hooks: Tuple[QueryHook, ...] = ()
+
+    async def execute(self, query: str, *args, **kwargs):
+        return await self._run_hooks('execute', query, args, super().execute, query, *args, **kwargs)
+
+    async def executemany(self, command: str, args, **kwargs):
+        return await self._run_hooks('executemany', command, (args,), super().executemany, command, args, **kwargs)
+
+    async def fetch(self, query: str, *args, **kwargs):
+        return await self._run_hooks('fetch', query, args, super().fetch, query, *args, **kwargs)
+
+    async def fetchval(self, query: str, *args, **kwargs):
+        return await self._run_hooks('fetchval', query, args, super().fetchval, query, *args, **kwargs)
+
+    async def fetchrow(self, query: str, *args, **kwargs):
+        return await self._run_hooks('fetchrow', query, args, super().fetchrow, query, *args, **kwargs)
+
+    async def prepare(self, query: str, **kwargs):
+        return await self._run_hooks('prepare', query, (), super().prepare, query, **kwargs)
+
+    async def copy_to_table(self, table_name: str, **kwargs):
+        return await self._run_hooks('copy_to_table', None, (), super().copy_to_table, table_name, **kwargs)
+
+    async def copy_records_to_table(self, table_name: str, **kwargs):
+        return await self._run_hooks(
+            'copy_records_to_table', None, (), super().copy_records_to_table, table_name, **kwargs
+        )
+
+    async def _run_hooks(self, method_name, sql, hook_args, method, /, *args, **kwargs):
+        after_hooks = []
+        for hook in self.query_hooks:
+            if after := hook(self, method_name, sql, hook_args):
+                after_hooks.append(after)
+        if not after_hooks:
+            return await method(*args, **kwargs)
+
+        result = error = None
+        try:
+            result = await method(*args, **kwargs)
+            return result
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            for after in reversed(after_hooks):
+                after(result, error)
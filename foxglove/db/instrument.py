@@ -0,0 +1,259 @@
+import logging
+import re
+from contextvars import ContextVar, Token
+from functools import lru_cache
+from time import perf_counter
+from typing import Any, Dict, List, Optional, Sequence
+
+from starlette.types import Message
+
+from ..timing import add_server_timing, current_timings, reset_timings, start_timings
+from .hooks import AfterQuery, query_methods
+
+__all__ = (
+    'QueryInstrument',
+    'RequestQueries',
+    'QueryStats',
+    'ProcessQueryStats',
+    'query_stats',
+    'start_request_queries',
+    'reset_request_queries',
+    'current_request_queries',
+    'fingerprint_sql',
+    'record_query',
+    'RequestInstrumentation',
+)
+
+logger = logging.getLogger('foxglove.db.queries')
+
+_request_queries: ContextVar[Optional['RequestQueries']] = ContextVar('foxglove_request_queries', default=None)
+
+string_literal_regex = re.compile(r"'(?:[^']|'')*'")
+number_literal_regex = re.compile(r'(?<![$\w])\d+(?:\.\d+)?\b')
+whitespace_regex = re.compile(r'\s+')
+
+
+@lru_cache(maxsize=1024)
+def fingerprint_sql(sql: str) -> str:
+    """
+    Shape of a query with literals replaced by "?" and whitespace collapsed, queries which differ only by their
+    literals or formatting have the same fingerprint.
+    """
+    sql = string_literal_regex.sub('?', sql)
+    sql = number_literal_regex.sub('?', sql)
+    return whitespace_regex.sub(' ', sql).strip()
+
+
+def redact(args: Sequence[Any]) -> List[str]:
+    """
+    Describe query parameters without their values.
+    """
+    return [type(a).__name__ for a in args]
+
+
+class QueryStats:
+    __slots__ = 'count', 'errors', 'total_time', 'max_time', 'rows'
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.rows = 0
+
+    def record(self, duration: float, rows: Optional[int], error: bool) -> None:
+        self.count += 1
+        self.total_time += duration
+        if duration > self.max_time:
+            self.max_time = duration
+        if error:
+            self.errors += 1
+        elif rows:
+            self.rows += rows
+
+    def as_dict(self) -> Dict[str, Any]:
+        return dict(
+            count=self.count,
+            errors=self.errors,
+            total_time=self.total_time,
+            mean_time=self.total_time / self.count if self.count else 0,
+            max_time=self.max_time,
+            rows=self.rows,
+        )
+
+
+class ProcessQueryStats:
+    """
+    Query stats for the process by fingerprint, the number of fingerprints is limited, queries with new
+    fingerprints after the limit is reached are counted under "other".
+    """
+
+    def __init__(self, max_fingerprints: int = 1000):
+        self.max_fingerprints = max_fingerprints
+        self.stats: Dict[str, QueryStats] = {}
+
+    def record(self, fingerprint: str, duration: float, rows: Optional[int], error: bool) -> None:
+        stats = self.stats.get(fingerprint)
+        if stats is None:
+            if len(self.stats) >= self.max_fingerprints:
+                fingerprint = 'other'
+                stats = self.stats.get(fingerprint)
+            if stats is None:
+                stats = self.stats[fingerprint] = QueryStats()
+        stats.record(duration, rows, error)
+
+    def summary(self, *, reset: bool = False) -> Dict[str, Dict[str, Any]]:
+        d = {fingerprint: stats.as_dict() for fingerprint, stats in self.stats.items()}
+        if reset:
+            self.stats = {}
+        return d
+
+
+query_stats = ProcessQueryStats()
+
+
+class RequestQueries:
+    """
+    Queries made during a request, included in log and sentry events for the request. Only the first max_queries
+    are kept, count and total_time include all queries.
+    """
+
+    __slots__ = 'queries', 'max_queries', 'count', 'total_time'
+
+    def __init__(self, max_queries: int = 100):
+        self.queries: List[Dict[str, Any]] = []
+        self.max_queries = max_queries
+        self.count = 0
+        self.total_time = 0.0
+
+    def record(self, fingerprint: str, duration: float, rows: Optional[int], error: Optional[Exception]) -> None:
+        self.count += 1
+        self.total_time += duration
+        if len(self.queries) >= self.max_queries:
+            return
+        q = dict(sql=fingerprint, time=f'{duration * 1000:0.2f}ms', rows=rows)
+        if error is not None:
+            q['error'] = repr(error)
+        self.queries.append(q)
+
+    @property
+    def omitted(self) -> int:
+        return self.count - len(self.queries)
+
+    def as_dict(self) -> Dict[str, Any]:
+        d = dict(count=self.count, total_time=f'{self.total_time * 1000:0.2f}ms', queries=self.queries)
+        if omitted := self.omitted:
+            d['omitted'] = omitted
+        return d
+
+
+def start_request_queries(max_queries: int = 100) -> 'Token[Optional[RequestQueries]]':
+    return _request_queries.set(RequestQueries(max_queries))
+
+
+def reset_request_queries(token: 'Token[Optional[RequestQueries]]') -> None:
+    _request_queries.reset(token)
+
+
+def current_request_queries() -> Optional[RequestQueries]:
+    return _request_queries.get()
+
+
+class RequestInstrumentation:
+    """
+    Request timings and query instrumentation for one request as enabled by settings.request_timings and
+    settings.pg_instrument, shared by ErrorMiddleware, PgMiddleware and FoxgloveMiddleware. Either is skipped if
+    an outer middleware has already started it, reset() must be called when the request is finished.
+    """
+
+    __slots__ = 'timings', 'timings_token', 'queries_token'
+
+    def __init__(self, settings, state: Dict[str, Any]):
+        self.timings = self.timings_token = self.queries_token = None
+        if settings.request_timings and current_timings() is None:
+            self.timings_token = start_timings(settings.server_timing_sample_rate)
+            self.timings = state['timings'] = current_timings()
+        if settings.pg_instrument and current_request_queries() is None:
+            self.queries_token = start_request_queries(settings.pg_instrument_max_queries)
+            state['queries'] = current_request_queries()
+
+    def response_start(self, message: Message) -> None:
+        """
+        Add the Server-Timing header to the "http.response.start" message if this request's timings are sampled.
+        """
+        if self.timings_token and self.timings.sampled:
+            add_server_timing(message, self.timings)
+
+    def reset(self) -> None:
+        if self.timings_token:
+            reset_timings(self.timings_token)
+            self.timings_token = None
+        if self.queries_token:
+            reset_request_queries(self.queries_token)
+            self.queries_token = None
+
+
+def count_rows(result: Any) -> Optional[int]:
+    if isinstance(result, list):
+        return len(result)
+    elif isinstance(result, str):
+        # status from execute, e.g. "INSERT 0 5" or "UPDATE 3"
+        last = result.rsplit(' ', 1)[-1]
+        return int(last) if last.isdigit() else None
+
+
+class QueryInstrument:
+    """
+    Query hook (see foxglove.db.hooks) which records each query's time and rows in the current request's
+    RequestQueries and in the process-wide query_stats, queries slower than slow_query_threshold are logged with
+    their parameters redacted.
+
+    Used for pools if settings.pg_instrument is True.
+    """
+
+    __slots__ = ('slow_query_threshold',)
+
+    def __init__(self, slow_query_threshold: Optional[float] = None):
+        self.slow_query_threshold = slow_query_threshold
+
+    def __call__(self, conn: Any, method: str, sql: Optional[str], args: Sequence[Any]) -> Optional[AfterQuery]:
+        if method not in query_methods:
+            return None
+        start = perf_counter()
+
+        def after(result: Any, error: Optional[Exception]) -> None:
+            duration = perf_counter() - start
+            if error is not None:
+                rows = None
+            elif method in single_row_methods:
+                rows = int(result is not None)
+            else:
+                rows = count_rows(result)
+            record_query(sql, args, duration, rows, error, self.slow_query_threshold)
+
+        return after
+
+
+single_row_methods = frozenset({'fetchval', 'fetchrow'})
+
+
+def record_query(
+    sql: str,
+    args: Sequence[Any],
+    duration: float,
+    rows: Optional[int],
+    error: Optional[Exception],
+    slow_query_threshold: Optional[float],
+) -> None:
+    fingerprint = fingerprint_sql(sql)
+    query_stats.record(fingerprint, duration, rows, error is not None)
+    if request_queries := _request_queries.get():
+        request_queries.record(fingerprint, duration, rows, error)
+
+    if slow_query_threshold is not None and duration > slow_query_threshold:
+        logger.warning(
+            'slow query %0.2fms: %s',
+            duration * 1000,
+            fingerprint,
+            extra={'sql': fingerprint, 'params': redact(args), 'duration': duration, 'rows': rows},
+        )
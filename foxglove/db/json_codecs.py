@@ -0,0 +1,88 @@
+import json
+from typing import Any, Callable, Optional
+
+from buildpg.asyncpg import BuildPgConnection
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+__all__ = 'RawJSON', 'register_json_codecs', 'json_codec_modes'
+
+json_codec_modes = 'decode', 'raw'
+# jsonb's binary format is the JSON text preceded by a version number
+jsonb_version = b'\x01'
+
+
+class RawJSON(bytes):
+    """
+    JSON exactly as returned by postgres, so it can be written straight into a response without being decoded and
+    encoded again.
+    """
+
+    def __repr__(self) -> str:
+        return f'RawJSON({bytes(self)!r})'
+
+
+if orjson is not None:
+    loads: Callable[[bytes], Any] = orjson.loads
+    dumps_bytes: Callable[..., bytes] = orjson.dumps
+else:  # pragma: no cover
+    loads = json.loads
+
+    def dumps_bytes(obj: Any, default: Optional[Callable[[Any], Any]] = None) -> bytes:
+        return json.dumps(obj, separators=(',', ':'), default=default).encode()
+
+
+def encode(value: Any) -> bytes:
+    """
+    Encode a parameter, bytes and strings are assumed to already be JSON.
+    """
+    if isinstance(value, bytes):
+        return value
+    elif isinstance(value, str):
+        return value.encode()
+    else:
+        return dumps_bytes(value)
+
+
+def encode_jsonb(value: Any) -> bytes:
+    return jsonb_version + encode(value)
+
+
+def decode_json(data: bytes) -> Any:
+    return loads(data)
+
+
+def decode_jsonb(data: bytes) -> Any:
+    return loads(data[1:])
+
+
+def raw_json(data: bytes) -> RawJSON:
+    return RawJSON(data)
+
+
+def raw_jsonb(data: bytes) -> RawJSON:
+    return RawJSON(data[1:])
+
+
+async def register_json_codecs(conn: BuildPgConnection, mode: str) -> None:
+    """
+    Register codecs for json and jsonb on a connection, either decoding values with orjson (or json if it's not
+    installed) when mode is "decode", or returning values as RawJSON bytes when mode is "raw".
+
+    Either way parameters can be python objects, or bytes or strings which are already JSON.
+    """
+    if mode not in json_codec_modes:
+        raise ValueError(f'mode must be one of {json_codec_modes}, not {mode!r}')
+    if mode == 'decode':
+        json_decoder, jsonb_decoder = decode_json, decode_jsonb
+    else:
+        json_decoder, jsonb_decoder = raw_json, raw_jsonb
+
+    # the binary format avoids decoding text to a str before parsing it
+    await conn.set_type_codec('json', encoder=encode, decoder=json_decoder, schema='pg_catalog', format='binary')
+    await conn.set_type_codec(
+        'jsonb', encoder=encode_jsonb, decoder=jsonb_decoder, schema='pg_catalog', format='binary'
+    )
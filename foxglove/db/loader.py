@@ -0,0 +1,108 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, List, Optional, Set
+
+from starlette.requests import Request
+
+__all__ = 'BatchLoader', 'batch_loader'
+
+
+class BatchLoader:
+    """
+    Load rows by key for a request, all load() calls made in the same event loop tick are combined into one query
+    and rows are remembered for the rest of the request.
+
+    The query should take an array of keys as its only parameter, e.g.
+    "select id, name from users where id = any($1)", rows are matched to keys by the "key" column. Read only
+    connections are used unless readonly is False.
+    """
+
+    __slots__ = 'request', 'sql', 'key', 'readonly', '_cache', '_pending', '_tasks'
+
+    def __init__(self, request: Request, sql: str, *, key: str = 'id', readonly: bool = True):
+        self.request = request
+        self.sql = sql
+        self.key = key
+        self.readonly = readonly
+        self._cache: Dict[Hashable, asyncio.Future] = {}
+        self._pending: Optional[Dict[Hashable, asyncio.Future]] = None
+        # references to running batches so they're not garbage collected before they finish
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def load(self, key: Hashable) -> Optional[Any]:
+        """
+        Row for key, or None if no row was found.
+        """
+        future = self._cache.get(key)
+        if future is None or future.cancelled():
+            loop = asyncio.get_running_loop()
+            future = self._cache[key] = loop.create_future()
+            if self._pending is None:
+                self._pending = {}
+                loop.call_soon(self._dispatch)
+            self._pending[key] = future
+        # the future is shared by every load of key, cancelling one caller mustn't cancel it for the others
+        return await asyncio.shield(future)
+
+    async def load_many(self, keys: Iterable[Hashable]) -> List[Optional[Any]]:
+        return await asyncio.gather(*[self.load(key) for key in keys])
+
+    def _dispatch(self) -> None:
+        pending, self._pending = self._pending, None
+        task = asyncio.ensure_future(self._load_batch(pending))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _load_batch(self, pending: Dict[Hashable, asyncio.Future]) -> None:
+        try:
+            conn = await self.request.state.get_pg_conn(readonly=self.readonly)
+            rows = await conn.fetch(self.sql, list(pending))
+            found = {row[self.key]: row for row in rows}
+        except asyncio.CancelledError:
+            self._forget(pending)
+            for future in pending.values():
+                future.cancel()
+            raise
+        except Exception as e:
+            self._forget(pending)
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for key, future in pending.items():
+            if not future.done():
+                future.set_result(found.get(key))
+
+    def _forget(self, pending: Dict[Hashable, asyncio.Future]) -> None:
+        """
+        Remove failed or cancelled loads from the cache so their keys can be loaded again.
+        """
+        for key, future in pending.items():
+            if self._cache.get(key) is future:
+                del self._cache[key]
+
+
+def batch_loader(sql: str, *, key: str = 'id', readonly: bool = True) -> Callable[[Request], Awaitable[BatchLoader]]:
+    """
+    Create a dependency which returns the BatchLoader for the query, the same loader is used throughout a request so
+    loads from different dependencies and nested models are combined, usage:
+
+        get_users = batch_loader('select id, name from users where id = any($1)')
+
+        @app.get('/posts/')
+        async def posts(users: BatchLoader = Depends(get_users)):
+            ...
+            author = await users.load(post['author_id'])
+    """
+
+    async def get_loader(request: Request) -> BatchLoader:
+        loaders = getattr(request.state, 'batch_loaders', None)
+        if loaders is None:
+            loaders = request.state.batch_loaders = {}
+        try:
+            return loaders[get_loader]
+        except KeyError:
+            loader = loaders[get_loader] = BatchLoader(request, sql, key=key, readonly=readonly)
+            return loader
+
+    return get_loader
@@ -1,26 +1,110 @@
 import asyncio
 import logging
 import os
+from typing import TYPE_CHECKING, Awaitable, Callable, List, Optional, Tuple, Type
 
-from buildpg.asyncpg import BuildPgPool, DuplicateDatabaseError, UniqueViolationError, create_pool_b
+from buildpg.asyncpg import BuildPgConnection, BuildPgPool, DuplicateDatabaseError, UniqueViolationError, create_pool_b
 
 from ..settings import BaseSettings
+from .hooks import QueryHook, QueryHooksMixin
+from .json_codecs import register_json_codecs
+from .prepared import init_connection
 from .utils import AsyncPgContext, lenient_conn
 
+if TYPE_CHECKING:
+    from .replicas import ReplicaPoolSet
+
 logger = logging.getLogger('foxglove.db')
-__all__ = 'create_pg_pool', 'prepare_database', 'reset_database'
+__all__ = 'create_pg_pool', 'create_pg_replica_pools', 'prepare_database', 'reset_database'
 
 
 async def create_pg_pool(settings: BaseSettings, *, run_migrations: bool = True) -> BuildPgPool:
-    await prepare_database(settings, False, run_migrations=run_migrations)
+    if not settings.pg_database_prepared:
+        await prepare_database(settings, False, run_migrations=run_migrations)
+    return await connect_pg_pool(settings, settings.pg_dsn)
+
+
+async def create_pg_replica_pools(settings: BaseSettings) -> Optional['ReplicaPoolSet']:
+    """
+    Create pools for settings.pg_replica_dsns, returns None if no replicas are configured.
+    """
+    if not settings.pg_replica_dsns:
+        return None
+    from .replicas import ReplicaPoolSet
+
+    pools = await asyncio.gather(*[connect_pg_pool(settings, dsn) for dsn in settings.pg_replica_dsns])
+    return ReplicaPoolSet(pools, strategy=settings.pg_replica_strategy)
+
+
+async def connect_pg_pool(settings: BaseSettings, dsn: str) -> BuildPgPool:
     return await create_pool_b(
-        settings.pg_dsn,
+        dsn,
         min_size=settings.pg_pool_min_size,
         max_size=settings.pg_pool_max_size,
         server_settings=settings.pg_server_settings,
+        connection_class=connection_class(settings),
+        init=connection_init(settings),
     )
 
 
+def connection_init(settings: BaseSettings) -> Optional[Callable[[BuildPgConnection], Awaitable[None]]]:
+    """
+    asyncpg pool "init" function to set up each new connection, or None if there's nothing to do.
+    """
+    json_codec = settings.pg_json_codec
+    prepare_statements = settings.pg_prepare_statements
+    if not json_codec and not prepare_statements:
+        return None
+
+    async def init(conn: BuildPgConnection) -> None:
+        # codecs must be registered first so prepared statements use them
+        if json_codec:
+            await register_json_codecs(conn, json_codec)
+        if prepare_statements:
+            await init_connection(conn)
+
+    return init
+
+
+def connection_class(settings: BaseSettings) -> Type[BuildPgConnection]:
+    """
+    Connection class for pools with the features enabled in settings.
+    """
+    hooks: List[QueryHook] = []
+    if settings.pg_replica_dsns and settings.pg_lsn_max_age:
+        from .replicas import track_writes
+
+        hooks.append(track_writes)
+    if settings.pg_repeated_query_limit and (settings.dev_mode or settings.test_mode):
+        from .repeated import count_repeated
+
+        hooks.append(count_repeated)
+    if settings.pg_instrument:
+        from .instrument import QueryInstrument
+
+        hooks.append(QueryInstrument(settings.pg_slow_query_threshold))
+    if settings.request_timings:
+        from ..timing import time_query
+
+        hooks.append(time_query)
+
+    bases: Tuple[type, ...] = (BuildPgConnection,)
+    attrs = {}
+    if hooks:
+        # one mixin calls every hook so each query is only wrapped once
+        bases = QueryHooksMixin, *bases
+        attrs['query_hooks'] = tuple(hooks)
+    if settings.pg_render_cache:
+        from .render import RenderCacheMixin
+
+        bases = RenderCacheMixin, *bases
+
+    if len(bases) > 1:
+        return type(BuildPgConnection.__name__, bases, attrs)
+    else:
+        return BuildPgConnection
+
+
 async def prepare_database(settings: BaseSettings, overwrite_existing: bool, *, run_migrations: bool = True) -> bool:
     db_created = await create_database(settings, overwrite_existing)
     if settings.pg_migrations and run_migrations:
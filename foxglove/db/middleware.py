@@ -1,51 +1,350 @@
-from typing import TYPE_CHECKING
+import asyncio
+import re
+from time import perf_counter, time
+from typing import TYPE_CHECKING, Any, Dict, Optional
 
-from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.datastructures import Headers, MutableHeaders
 from starlette.requests import Request
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
-__all__ = 'PgMiddleware', 'get_db'
+from ..exceptions import HttpMessageError, HttpServiceUnavailable
+from ..timing import timed
+from .instrument import RequestInstrumentation
+from .repeated import (
+    RepeatedQueries,
+    logger as repeated_logger,
+    repeated_queries_key,
+    reset_repeated_queries,
+    start_repeated_queries,
+)
+from .replicas import RequestWrites, reset_request_writes, start_request_writes, tracks_writes
+
+__all__ = 'PgMiddleware', 'get_db', 'get_db_readonly', 'get_db_primary', 'AcquireMetrics', 'acquire_metrics'
+
+read_methods = frozenset({'GET', 'HEAD'})
 
 if TYPE_CHECKING:
     from buildpg.asyncpg import BuildPgConnection
-    from starlette.responses import Response
 
-    from ..middleware import CallNext
+    from ..settings import BaseSettings
+
+
+class AcquireMetrics:
+    """
+    Time requests spent waiting for a connection from the pool, get() returns a summary and optionally resets
+    the counts so it can be called periodically to report metrics.
+    """
+
+    __slots__ = 'acquired', 'timeouts', 'total_wait', 'max_wait'
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        self.acquired = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait: float, *, timeout: bool = False) -> None:
+        if timeout:
+            self.timeouts += 1
+        else:
+            self.acquired += 1
+            self.total_wait += wait
+        if wait > self.max_wait:
+            self.max_wait = wait
+
+    def get(self, *, reset: bool = False) -> Dict[str, Any]:
+        m = dict(
+            acquired=self.acquired,
+            timeouts=self.timeouts,
+            mean_wait=self.total_wait / self.acquired if self.acquired else 0,
+            max_wait=self.max_wait,
+        )
+        if reset:
+            self.reset()
+        return m
+
+
+acquire_metrics = AcquireMetrics()
 
 
 class GetPgConn:
-    __slots__ = '_glove', '_conn'
+    """
+    Acquire connections for a request when they're first used. Read only connections come from glove.pg_read
+    (the replica pools) if it's set, otherwise, or if a primary connection has already been acquired,
+    the primary connection is used.
+
+    For read-your-writes consistency, after a request which used the primary the WAL position (LSN) is recorded
+    in the session (or the X-Pg-Lsn response header if there's no session), for settings.pg_lsn_max_age seconds
+    after that replicas are only used if they've replayed up to that position.
+    """
+
+    __slots__ = (
+        '_glove',
+        '_scope',
+        '_conn',
+        '_read_conn',
+        '_fallback',
+        'route_reads',
+        'repeated',
+        '_repeated_token',
+        'writes',
+        '_writes_token',
+        'response_started',
+    )
 
-    def __init__(self, glove):
+    def __init__(self, glove, *, route_reads: bool = False, scope: Optional[Scope] = None):
         self._glove = glove
+        self._scope = scope
         self._conn = None
+        self._read_conn = None
+        # whether the primary was used because a replica hadn't caught up
+        self._fallback = False
+        # whether get_db should use a read only connection
+        self.route_reads = route_reads
+        self.response_started = False
+        settings = glove.settings
+        limit = settings.pg_repeated_query_limit
+        # N+1 queries are only looked for in development and tests, queries are counted by the count_repeated hook
+        self.repeated = None
+        self._repeated_token = None
+        if limit and (settings.dev_mode or settings.test_mode):
+            self.repeated = RepeatedQueries(limit)
+            self._repeated_token = start_repeated_queries(self.repeated)
+        # writes are tracked by the track_writes query hook so the LSN is only recorded after requests which wrote
+        self.writes = None
+        self._writes_token = None
+        if settings.pg_lsn_max_age:
+            self.writes = RequestWrites()
+            self._writes_token = start_request_writes(self.writes)
+
+    async def __call__(self, *, readonly: bool = False):
+        if readonly and self._conn is None and (pg_read := self._replica_pools()):
+            if self._read_conn is None:
+                conn = await self._acquire(pg_read)
+                try:
+                    caught_up = await self._replica_caught_up(conn)
+                except BaseException:
+                    await pg_read.release(conn)
+                    raise
+                if caught_up:
+                    self._read_conn = conn
+                else:
+                    await pg_read.release(conn)
+                    self._fallback = True
+            if self._read_conn is not None:
+                return self._read_conn
 
-    async def __call__(self):
         if self._conn is None:
-            self._conn = await self._glove.pg.acquire()
+            self._conn = await self._acquire(self._glove.pg)
         return self._conn
 
+    def _replica_pools(self):
+        pg_read = getattr(self._glove, 'pg_read', None)
+        if pg_read is not self._glove.pg:
+            return pg_read
+
+    async def _replica_caught_up(self, conn) -> bool:
+        lsn = self.required_lsn()
+        if lsn is None:
+            return True
+        # pg_last_wal_replay_lsn() is null if the database isn't a replica
+        return await conn.fetchval('select coalesce(pg_last_wal_replay_lsn() >= $1::pg_lsn, true)', lsn)
+
+    def required_lsn(self) -> Optional[str]:
+        """
+        WAL position replicas must have reached to be used for this request, X-Pg-Lsn header values which aren't
+        valid LSNs are ignored.
+        """
+        scope = self._scope
+        if scope is None:
+            return None
+        session = scope.get('session')
+        if session is None:
+            lsn = Headers(scope=scope).get(lsn_header)
+            if lsn is not None and lsn_regex.fullmatch(lsn):
+                return lsn
+        elif value := session.get(lsn_session_key):
+            lsn, ts = value
+            if time() - ts < self._glove.settings.pg_lsn_max_age:
+                return lsn
+            # replicas should have caught up by now
+            del session[lsn_session_key]
+
+    async def record_lsn(self, message: Message) -> None:
+        """
+        Record the primary's current WAL position if the primary connection was used for a write, should be called
+        with the "http.response.start" message. Writes are tracked by the track_writes query hook, with connection
+        classes which don't use it the position is recorded whenever the primary was used for a request which could
+        have written.
+        """
+        scope = self._scope
+        if (
+            self._conn is None
+            or (self.writes is not None and not self.writes.wrote and tracks_writes(self._conn))
+            or scope is None
+            or (scope['method'] in read_methods and (self._fallback or not self.route_reads))
+            or not self._glove.settings.pg_lsn_max_age
+            or not self._replica_pools()
+        ):
+            return
+        lsn = await self._conn.fetchval('select pg_current_wal_lsn()::text')
+        session = scope.get('session')
+        if session is None:
+            MutableHeaders(scope=message).append(lsn_header, lsn)
+        else:
+            session[lsn_session_key] = [lsn, int(time())]
+
+    async def _acquire(self, pool):
+        settings = self._glove.settings
+        start = perf_counter()
+        try:
+            with timed('db-acquire'):
+                conn = await pool.acquire(timeout=settings.pg_acquire_timeout)
+        except asyncio.TimeoutError:
+            acquire_metrics.record(perf_counter() - start, timeout=True)
+            raise HttpServiceUnavailable(
+                'Service Unavailable, please try again shortly',
+                headers={'Retry-After': str(settings.pg_acquire_retry_after)},
+            )
+        acquire_metrics.record(perf_counter() - start)
+        return conn
+
     async def release(self):
         if self._conn is not None:
             conn = self._conn
             self._conn = None
             await self._glove.pg.release(conn)
+        if self._read_conn is not None:
+            conn = self._read_conn
+            self._read_conn = None
+            await self._glove.pg_read.release(conn)
 
+    async def response_start(self, message: Message) -> None:
+        """
+        Called with the "http.response.start" message before it's sent.
+        """
+        self.response_started = True
+        await self.record_lsn(message)
 
-class PgMiddleware(BaseHTTPMiddleware):
-    def __init__(self, app):
-        super().__init__(app)
+    async def response_sent(self, message: Message) -> None:
+        """
+        Called after each message is sent, connections are released as soon as the response is complete, background
+        tasks may still run but they'll acquire a new connection.
+        """
+        if message['type'] == 'http.response.body' and not message.get('more_body', False):
+            await self.release()
+
+    async def call_app(self, app: ASGIApp, scope: Scope, receive: Receive, send: Send) -> None:
+        """
+        Call the app, returning a 503 response if no connection could be acquired and the app has no exception
+        handler for HttpMessageError.
+        """
+        try:
+            await app(scope, receive, send)
+        except HttpServiceUnavailable as exc:
+            if self.response_started:
+                raise
+            await HttpMessageError.handle(exc)(scope, receive, send)
+
+    async def close(self) -> None:
+        """
+        Release connections and check for repeated queries once the request is finished.
+        """
+        await self.release()
+        self.check_repeated()
+        if self._writes_token is not None:
+            reset_request_writes(self._writes_token)
+            self._writes_token = None
+
+    def check_repeated(self) -> None:
+        """
+        Warn if any query was repeated more than settings.pg_repeated_query_limit times, in test mode the report is
+        also stored in scope['state'] so TestClient fails the test. This also stops counting queries so it must be
+        called in the same context as the GetPgConn was created.
+        """
+        if self._repeated_token is not None:
+            reset_repeated_queries(self._repeated_token)
+            self._repeated_token = None
+        if self.repeated is None or not (report := self.repeated.report()):
+            return
+        repeated_logger.warning('%s %s: %s', self._scope['method'], self._scope['path'], report)
+        if self._glove.settings.test_mode:
+            self._scope.setdefault('state', {})[repeated_queries_key] = report
+
+
+lsn_session_key = 'pg_lsn'
+lsn_header = 'X-Pg-Lsn'
+lsn_regex = re.compile('[0-9A-Fa-f]{1,8}/[0-9A-Fa-f]{1,8}')
+
+
+class PgMiddleware:
+    """
+    Lets get_db acquire a connection from the pool when it's first used in a request, the connection is released
+    as soon as the response has been sent.
+
+    If settings.pg_acquire_timeout is set and no connection can be acquired within that time a 503 response with a
+    Retry-After header is returned rather than waiting indefinitely for a connection.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
 
         from ..main import glove
 
         self.glove = glove
 
-    async def dispatch(self, request: Request, call_next: 'CallNext') -> 'Response':
-        request.state.get_pg_conn = GetPgConn(self.glove)
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        settings = self.glove.settings
+        get_pg_conn = GetPgConn(self.glove, route_reads=routes_reads(settings, scope), scope=scope)
+        state = scope.setdefault('state', {})
+        state['get_pg_conn'] = get_pg_conn
+        # timings and queries are normally started by ErrorMiddleware, they're started here if it's not being used
+        instruments = RequestInstrumentation(settings, state)
+
+        async def send_wrapper(message: Message) -> None:
+            if message['type'] == 'http.response.start':
+                await get_pg_conn.response_start(message)
+                instruments.response_start(message)
+            await send(message)
+            await get_pg_conn.response_sent(message)
+
         try:
-            return await call_next(request)
+            await get_pg_conn.call_app(self.app, scope, receive, send_wrapper)
         finally:
-            await request.state.get_pg_conn.release()
+            await get_pg_conn.close()
+            instruments.reset()
+
+
+def routes_reads(settings: 'BaseSettings', scope: Scope) -> bool:
+    return settings.pg_route_reads and scope['method'] in read_methods
 
 
 async def get_db(request: Request) -> 'BuildPgConnection':
+    """
+    Connection for the request, this is a read only connection for GET and HEAD requests if settings.pg_route_reads
+    is True and replicas are configured.
+    """
+    get_pg_conn: GetPgConn = request.state.get_pg_conn
+    return await get_pg_conn(readonly=get_pg_conn.route_reads)
+
+
+async def get_db_readonly(request: Request) -> 'BuildPgConnection':
+    """
+    Read only connection from a replica, or the primary if no replicas are configured.
+    """
+    return await request.state.get_pg_conn(readonly=True)
+
+
+async def get_db_primary(request: Request) -> 'BuildPgConnection':
+    """
+    Connection to the primary database regardless of the request method, use instead of get_db for GET
+    routes which write or must read the latest data.
+    """
     return await request.state.get_pg_conn()
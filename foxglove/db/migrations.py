@@ -1,8 +1,9 @@
 import asyncio
+import hashlib
 import logging
-from typing import List
+from typing import List, Tuple
 
-from asyncpg import LockNotAvailableError
+from asyncpg import LockNotAvailableError, UndefinedTableError
 from buildpg.asyncpg import BuildPgConnection
 
 from .. import glove
@@ -27,6 +28,14 @@ create table if not exists {migrations_table_name} (
   unique (ref, sql_section)
 );
 """
+# digests of complete sets of migrations which have been applied, so startup can skip checking each migration
+digest_table_name = 'migrations_digest'
+digest_table_sql = f"""
+create table if not exists {digest_table_name} (
+  digest char(64) primary key,
+  ts timestamptz not null default current_timestamp
+);
+"""
 
 
 async def run_migrations(settings: BaseSettings, patches: List[Patch], live: bool, *, fake: bool = False) -> int:
@@ -38,9 +47,20 @@ async def run_migrations(settings: BaseSettings, patches: List[Patch], live: boo
     if not migration_patches:
         return 0
 
+    migrations = [(patch, *migration_ref(patch, settings)) for patch in migration_patches]
+    digest = migrations_digest([(ref, sql_section) for _, ref, sql_section in migrations])
+
     count = 0
     up_to_date = 0
     async with AsyncPgContext(settings.pg_dsn) as conn:
+        try:
+            digest_found = await conn.fetchval(f'select 1 from {digest_table_name} where digest=$1', digest)
+        except UndefinedTableError:
+            digest_found = None
+        if digest_found:
+            logger.info('all %d migrations already up to date ✓', len(migrations))
+            return 0
+
         tr = conn.transaction()
         await tr.start()
 
@@ -58,17 +78,7 @@ async def run_migrations(settings: BaseSettings, patches: List[Patch], live: boo
         default_pg = getattr(glove, 'pg', None)
         glove.pg = DummyPgPool(conn)
         logger.info('checking %d migration patches...', len(migration_patches))
-        for patch in migration_patches:
-            if patch.auto_sql_section:
-                content = get_sql_section(patch.auto_sql_section, settings.sql)
-                sql_section = f'{patch.auto_sql_section}::\n{content}'
-            else:
-                # '-' is required to make the unique constraint work since null would mean rows wouldn't conflict
-                sql_section = '-'
-
-            patch_ref = patch.func.__name__
-            if isinstance(patch.auto_run, str):
-                patch_ref += f':{patch.auto_run}'
+        for patch, patch_ref, sql_section in migrations:
             migration_id = await conn.fetchval(
                 f"""
                 insert into {migrations_table_name} (ref, sql_section, fake)
@@ -99,6 +109,8 @@ async def run_migrations(settings: BaseSettings, patches: List[Patch], live: boo
         glove.pg = default_pg
         verb = 'faked' if fake else 'run'
         if live:
+            await conn.execute(digest_table_sql)
+            await conn.execute(f'insert into {digest_table_name} (digest) values ($1) on conflict do nothing', digest)
             await tr.commit()
             if count == 0:
                 logger.info('all %d migrations already up to date ✓', up_to_date)
@@ -113,6 +125,33 @@ async def run_migrations(settings: BaseSettings, patches: List[Patch], live: boo
     return count
 
 
+def migration_ref(patch: Patch, settings: BaseSettings) -> Tuple[str, str]:
+    """
+    The ref and sql section recorded in the migrations table for a patch.
+    """
+    if patch.auto_sql_section:
+        content = get_sql_section(patch.auto_sql_section, settings.sql)
+        sql_section = f'{patch.auto_sql_section}::\n{content}'
+    else:
+        # '-' is required to make the unique constraint work since null would mean rows wouldn't conflict
+        sql_section = '-'
+
+    patch_ref = patch.func.__name__
+    if isinstance(patch.auto_run, str):
+        patch_ref += f':{patch.auto_run}'
+    return patch_ref, sql_section
+
+
+def migrations_digest(refs: List[Tuple[str, str]]) -> str:
+    """
+    sha256 of all migration refs and sql sections, independent of the order of patches.
+    """
+    h = hashlib.sha256()
+    for ref, sql_section in sorted(refs):
+        h.update(f'{ref}\0{sql_section}\0'.encode())
+    return h.hexdigest()
+
+
 async def run_patch(conn: BuildPgConnection, patch: Patch, ref: str, live: bool) -> bool:
     kwargs = dict(conn=conn, live=live, args={'__migration__': 'true'}, logger=logger)
     logger.info('{:-^50}'.format(f' {ref} ... '))
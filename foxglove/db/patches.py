@@ -4,7 +4,8 @@ import re
 from dataclasses import dataclass
 from enum import Enum
 from importlib import import_module
-from typing import Any, Callable, Dict, List, Type, Union
+from time import perf_counter
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Type, Union
 
 from .. import glove
 from ..settings import BaseSettings
@@ -18,20 +19,36 @@ __all__ = (
     'update_enums',
     'run_sql_section',
     'Patch',
+    'Chunked',
     'get_sql_section',
     'import_patches',
 )
 
 
+@dataclass
+class Chunked:
+    """
+    Options for chunked patches: key_range_sql should return the min and max (inclusive) of an integer key, the patch
+    is called with "start" and "end" (exclusive) for each batch of batch_size keys. Each batch is committed with
+    a record in the patch_progress table so the patch can be resumed, batches are run on "workers" connections
+    at once.
+    """
+
+    key_range_sql: str
+    batch_size: int = 1000
+    workers: int = 1
+
+
 @dataclass
 class Patch:
     func: Callable[..., Any]
     direct: bool = False
     auto_run: Union[None, bool, str] = None
     auto_sql_section: str = None
+    chunked: Optional[Chunked] = None
 
 
-def run_patch(patch_name: str, live: bool, args: Dict[str, str]):
+def run_patch(patch_name: str, live: bool, args: Dict[str, str], *, restart: bool = False):
     patches = import_patches(glove.settings)
 
     if patch_name is None:
@@ -54,18 +71,20 @@ def run_patch(patch_name: str, live: bool, args: Dict[str, str]):
             logger.error('direct patches must be called with "--live"')
             return 1
         log_msg = f'running patch {patch_name} direct'
+    elif patch.chunked:
+        log_msg = f'running patch {patch_name} chunked {"live" if live else "not live, first batch only"}'
     else:
         log_msg = f'running patch {patch_name} {"live" if live else "not live"}'
     loop = asyncio.get_event_loop()
-    return loop.run_until_complete(_run_patch(patch, live, args, log_msg)) or 0
+    return loop.run_until_complete(_run_patch(patch, live, args, log_msg, restart)) or 0
 
 
-async def _run_patch(patch: Patch, live: bool, args: Dict[str, str], log_msg: str):
+async def _run_patch(patch: Patch, live: bool, args: Dict[str, str], log_msg: str, restart: bool = False):
     from .main import lenient_conn
 
     conn = await lenient_conn(glove.settings)
     tr = None
-    if not patch.direct:
+    if not patch.direct and not patch.chunked:
         tr = conn.transaction()
         await tr.start()
     glove.pg = DummyPgPool(conn)
@@ -73,7 +92,9 @@ async def _run_patch(patch: Patch, live: bool, args: Dict[str, str], log_msg: st
     kwargs = dict(conn=conn, live=live, args=args, logger=logger)
     logger.info('{:-^50}'.format(f' {log_msg} '))
     try:
-        if asyncio.iscoroutinefunction(patch.func):
+        if patch.chunked:
+            result = await _run_chunked(patch, conn, live, args, restart)
+        elif asyncio.iscoroutinefunction(patch.func):
             result = await patch.func(**kwargs)
         else:
             result = patch.func(**kwargs)
@@ -82,12 +103,14 @@ async def _run_patch(patch: Patch, live: bool, args: Dict[str, str], log_msg: st
     except BaseException:
         logger.info('{:-^50}'.format(' error '))
         logger.exception('Error running %s patch', patch.func.__name__)
-        if not patch.direct:
+        if tr:
             await tr.rollback()
         return 1
     else:
         if patch.direct:
             logger.info('{:-^50}'.format(' committed patch '))
+        elif patch.chunked:
+            logger.info('{:-^50}'.format(' committed batches ' if live else ' not live, rolled back '))
         else:
             if live:
                 logger.info('{:-^50}'.format(' live, committed patch '))
@@ -100,7 +123,147 @@ async def _run_patch(patch: Patch, live: bool, args: Dict[str, str], log_msg: st
         await conn.close()
 
 
-def patch(func_=None, /, direct=False, auto_run: Union[str, bool] = None, auto_sql_section: str = None):
+progress_table_sql = """
+create table if not exists patch_progress (
+  patch varchar(255) not null,
+  batch_start bigint not null,
+  batch_end bigint not null,
+  ts timestamptz not null default current_timestamp,
+  primary key (patch, batch_start)
+);
+"""
+
+
+async def _run_chunked(patch: Patch, conn, live: bool, args: Dict[str, str], restart: bool) -> str:
+    """
+    Run a chunked patch: batches are run in order (or "workers" at a time), each in its own transaction with
+    a patch_progress record so batches completed by a previous run are skipped.
+    """
+    if live:
+        return await _run_batches(patch, conn, live, args, restart)
+
+    # when not live everything, including creating patch_progress, is rolled back, the batch runs in a savepoint
+    # inside this transaction
+    tr = conn.transaction()
+    await tr.start()
+    try:
+        return await _run_batches(patch, conn, live, args, restart)
+    finally:
+        await tr.rollback()
+
+
+async def _run_batches(patch: Patch, conn, live: bool, args: Dict[str, str], restart: bool) -> str:
+    chunked = patch.chunked
+    name = patch.func.__name__
+    await conn.execute(progress_table_sql)
+    if restart:
+        await conn.execute('delete from patch_progress where patch=$1', name)
+    key_min, key_max = await conn.fetchrow(chunked.key_range_sql)
+    if key_min is None:
+        return 'no keys to process'
+
+    done: List[Tuple[int, int]] = [
+        tuple(r) for r in await conn.fetch('select batch_start, batch_end from patch_progress where patch=$1', name)
+    ]
+    batches = list(pending_batches(key_min, key_max + 1, chunked.batch_size, done))
+    total = len(batches) + len(done)
+    if done:
+        logger.info('resuming, %d of %d batches already complete', len(done), total)
+    if not live:
+        batches = batches[:1]
+
+    queue: asyncio.Queue = asyncio.Queue()
+    for batch in batches:
+        queue.put_nowait(batch)
+    start_time = perf_counter()
+    completed = len(done)
+
+    async def run_queue(batch_conn) -> None:
+        nonlocal completed
+        while not queue.empty():
+            start, end = queue.get_nowait()
+            tr = batch_conn.transaction()
+            await tr.start()
+            try:
+                await patch.func(conn=batch_conn, live=live, args=args, logger=logger, start=start, end=end)
+                await batch_conn.execute(
+                    'insert into patch_progress (patch, batch_start, batch_end) values ($1, $2, $3)', name, start, end
+                )
+            except BaseException:
+                await tr.rollback()
+                raise
+            if live:
+                await tr.commit()
+            else:
+                await tr.rollback()
+            completed += 1
+            logger.info(
+                'batch %d/%d complete, keys %d to %d, %0.1fs', completed, total, start, end, perf_counter() - start_time
+            )
+
+    workers = min(chunked.workers, len(batches))
+    if workers > 1:
+        await _run_workers(run_queue, workers)
+    else:
+        await run_queue(conn)
+    return f'{len(batches)} batches run, {completed}/{total} complete'
+
+
+def pending_batches(
+    key_min: int, key_end: int, batch_size: int, done: Sequence[Tuple[int, int]]
+) -> Iterator[Tuple[int, int]]:
+    """
+    Batches of up to batch_size keys from key_min to key_end (exclusive) which aren't covered by the completed batches
+    in done, batches stop at the start of a completed batch so resuming with a different batch_size or key range
+    doesn't skip keys.
+    """
+    start = key_min
+    for done_start, done_end in sorted(done) + [(key_end, key_end)]:
+        while start < min(done_start, key_end):
+            end = min(start + batch_size, done_start, key_end)
+            yield start, end
+            start = end
+        start = max(start, done_end)
+
+
+async def _run_workers(run_queue: Callable[[Any], Awaitable[None]], workers: int) -> None:
+    """
+    Run batches on "workers" connections from a new pool, if a batch fails the other workers are cancelled so
+    they don't start or commit more batches.
+    """
+    from .main import connect_pg_pool
+
+    settings = glove.settings
+    pool_settings = settings.copy(update=dict(pg_pool_min_size=workers, pg_pool_max_size=workers))
+    pool = await connect_pg_pool(pool_settings, settings.pg_dsn)
+    try:
+
+        async def pool_worker() -> None:
+            async with pool.acquire() as worker_conn:
+                await run_queue(worker_conn)
+
+        tasks = [asyncio.ensure_future(pool_worker()) for _ in range(workers)]
+        try:
+            finished, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        for task in finished:
+            if not task.cancelled() and (exc := task.exception()):
+                raise exc
+    finally:
+        await pool.close()
+
+
+def patch(
+    func_=None,
+    /,
+    direct=False,
+    auto_run: Union[str, bool] = None,
+    auto_sql_section: str = None,
+    chunked: Optional[Chunked] = None,
+):
     if func_:
         _patch_list.append(Patch(func_))
         return func_
@@ -112,7 +275,11 @@ def patch(func_=None, /, direct=False, auto_run: Union[str, bool] = None, auto_s
                     'patches with direct=True, cannot also have auto_run set since migrations '
                     'run in a single transaction'
                 )
-            _patch_list.append(Patch(func, direct, auto_run, auto_sql_section))
+            if chunked and (direct or auto_run):
+                raise TypeError('chunked patches commit each batch, they cannot also be direct or auto_run')
+            if chunked and not asyncio.iscoroutinefunction(func):
+                raise TypeError('chunked patches must be async functions')
+            _patch_list.append(Patch(func, direct, auto_run, auto_sql_section, chunked))
             return func
 
         return wrapper
@@ -0,0 +1,81 @@
+import logging
+from time import perf_counter
+from typing import Any, Dict, List
+
+from buildpg.asyncpg import BuildPgConnection
+
+from .render import render_cache
+
+__all__ = 'StatementRegistry', 'hot_statements', 'init_connection'
+
+logger = logging.getLogger('foxglove.db')
+
+
+class StatementRegistry:
+    """
+    Statements which are prepared on every new pool connection so the first requests after a deploy or restart don't
+    pay to parse and plan them, usage:
+
+        get_user_sql = hot_statements.add_b('select id, name from users where id=:id', id=None)
+
+    Statements must be added before the pool is created (e.g. at import time) to be prepared on its first
+    connections.
+    """
+
+    def __init__(self):
+        # dict to keep the order and avoid duplicates
+        self._statements: Dict[str, None] = {}
+
+    def add(self, sql: str) -> str:
+        """
+        Add SQL with "$1" style parameters, returns the sql.
+        """
+        self._statements[sql] = None
+        return sql
+
+    def add_b(self, query_template: str, **ctx: Any) -> str:
+        """
+        Add a buildpg template, ctx needs the same variables and components as when the query is run, but the
+        values of parameters don't matter. Returns the rendered SQL.
+        """
+        sql, _ = render_cache(query_template, **ctx)
+        return self.add(sql)
+
+    @property
+    def statements(self) -> List[str]:
+        return list(self._statements)
+
+    async def prepare(self, conn: BuildPgConnection) -> int:
+        """
+        Prepare statements on a connection and add them to its statement cache so queries with the same SQL use
+        them, returns the number of statements prepared. Statements which fail (e.g. because a table doesn't exist
+        yet) are logged and skipped.
+        """
+        prepared = 0
+        for sql in self._statements:
+            try:
+                # asyncpg's public prepare() creates a separate statement outside the cache which fetch() etc. use,
+                # so it wouldn't help later queries. _get_statement is private, asyncpg is pinned in setup.py and
+                # test_get_statement_signature checks the signature hasn't changed
+                await conn._get_statement(sql, None)
+            except Exception as e:
+                logger.warning('error preparing statement %r: %s: %s', sql, e.__class__.__name__, e)
+            else:
+                prepared += 1
+        return prepared
+
+    def __len__(self) -> int:
+        return len(self._statements)
+
+
+hot_statements = StatementRegistry()
+
+
+async def init_connection(conn: BuildPgConnection) -> None:
+    """
+    asyncpg pool "init" function, called for each new connection including when the pool grows.
+    """
+    if hot_statements:
+        start = perf_counter()
+        count = await hot_statements.prepare(conn)
+        logger.debug('prepared %d statements in %0.2fms', count, (perf_counter() - start) * 1000)
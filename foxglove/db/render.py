@@ -0,0 +1,161 @@
+from collections import OrderedDict
+from functools import lru_cache, partial
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+from buildpg import render
+from buildpg.components import Component, RawDangerous
+
+__all__ = 'RenderCache', 'render_cache', 'RenderCacheMixin'
+
+Path = Tuple[Any, ...]
+
+
+class RenderCache:
+    """
+    Cache of buildpg rendered SQL keyed by the template and the structure of any components (their raw SQL chunks and
+    where their parameters go), so repeat renders only have to collect the parameters and the SQL text passed to
+    asyncpg is the same string each time, which keeps asyncpg's prepared statement cache effective.
+
+    When an entry is added the parameters it would return are checked against buildpg's render, if they don't match
+    the template isn't cached.
+    """
+
+    def __init__(self, max_size: int = 1000):
+        self.max_size = max_size
+        self._cache: Dict[Hashable, Optional[Tuple[str, List[Path]]]] = OrderedDict()
+
+    def __call__(self, query_template: str, **ctx: Any) -> Tuple[str, List[Any]]:
+        leaves: Dict[Path, Any] = {}
+        shapes: List[Any] = []
+        try:
+            for name, extra in template_vars(query_template):
+                value = ctx[name]
+                if extra:
+                    gen = getattr(value, 'render_' + extra)()
+                elif isinstance(value, Component):
+                    gen = value.render()
+                else:
+                    leaves[(name,)] = value
+                    shapes.append(None)
+                    continue
+                shape: List[Any] = []
+                walk(gen, (name,), shape, leaves)
+                shapes.append(tuple(shape))
+        except Exception:
+            # render() will raise a proper BuildError
+            return render(query_template, **ctx)
+
+        key = query_template, tuple(shapes)
+        try:
+            entry = self._cache[key]
+        except KeyError:
+            return self._add(key, query_template, ctx, leaves)
+
+        if entry is None:
+            # rendering this template can't be cached
+            return render(query_template, **ctx)
+        self._cache.move_to_end(key)
+        sql, paths = entry
+        return sql, [leaves[p] for p in paths]
+
+    def _add(self, key: Hashable, query_template: str, ctx: Dict[str, Any], leaves: Dict[Path, Any]):
+        paths: List[Path] = []
+        sql, params = recording_render(query_template, ctx, paths)
+        entry = None
+        if all(p in leaves for p in paths):
+            rebound = [leaves[p] for p in paths]
+            if len(rebound) == len(params) and all(a is b for a, b in zip(rebound, params)):
+                entry = sql, paths
+        self._cache[key] = entry
+        if len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+        return sql, params
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+
+@lru_cache(maxsize=1000)
+def template_vars(query_template: str) -> Tuple[Tuple[str, Optional[str]], ...]:
+    """
+    Unique variables in a template as (name, extra) where extra is set for "name__extra" variables.
+    """
+    found = {}
+    for m in render.regex.finditer(query_template):
+        name, _, extra = m.group(1).partition(render.sep)
+        found[(name, extra or None)] = None
+    return tuple(found)
+
+
+def walk(gen, var_parts: Path, shape: List[Any], leaves: Dict[Path, Any]) -> None:
+    """
+    Collect the structure and parameters of a component the same way buildpg's Renderer.add_chunk numbers them.
+    """
+    for i, chunk in enumerate(gen):
+        if isinstance(chunk, RawDangerous):
+            shape.append(chunk)
+        elif isinstance(chunk, Component):
+            sub_shape: List[Any] = []
+            walk(chunk.render(), (*var_parts, i), sub_shape, leaves)
+            shape.append(tuple(sub_shape))
+        else:
+            leaves[(*var_parts, i)] = chunk
+            shape.append(None)
+
+
+def recording_render(query_template: str, ctx: Dict[str, Any], paths: List[Path]) -> Tuple[str, List[Any]]:
+    """
+    The same as buildpg's Renderer.__call__ but also records where each parameter came from.
+    """
+    params = []
+    existing_params = {}
+
+    def add_param(p, *var_parts):
+        try:
+            index = existing_params[var_parts]
+        except KeyError:
+            params.append(p)
+            paths.append(var_parts)
+            index = len(params)
+            existing_params[var_parts] = index
+        return f'${index}'
+
+    repl = partial(render.replace, ctx=ctx, add_param=add_param)
+    return render.regex.sub(repl, query_template), params
+
+
+render_cache = RenderCache()
+
+
+class RenderCacheMixin:
+    """
+    Connection mixin to use render_cache for the *_b methods, used for pools if settings.pg_render_cache is True.
+    """
+
+    async def execute_b(self, query_template, *, _timeout: float = None, print_=False, **kwargs):
+        query, args = render_cache(query_template, **kwargs)
+        self._print_query(print_, query, args)
+        return await self.execute(query, *args, timeout=_timeout)
+
+    async def fetch_b(self, query_template, *, _timeout: float = None, print_=False, **kwargs):
+        query, args = render_cache(query_template, **kwargs)
+        self._print_query(print_, query, args)
+        return await self.fetch(query, *args, timeout=_timeout)
+
+    async def fetchval_b(self, query_template, *, _timeout: float = None, _column=0, print_=False, **kwargs):
+        query, args = render_cache(query_template, **kwargs)
+        self._print_query(print_, query, args)
+        return await self.fetchval(query, *args, timeout=_timeout, column=_column)
+
+    async def fetchrow_b(self, query_template, *, _timeout: float = None, print_=False, **kwargs):
+        query, args = render_cache(query_template, **kwargs)
+        self._print_query(print_, query, args)
+        return await self.fetchrow(query, *args, timeout=_timeout)
+
+    def cursor_b(self, query_template, *, _timeout: float = None, _prefetch=None, print_=False, **kwargs):
+        query, args = render_cache(query_template, **kwargs)
+        self._print_query(print_, query, args)
+        return self.cursor(query, *args, timeout=_timeout, prefetch=_prefetch)
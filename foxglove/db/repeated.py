@@ -0,0 +1,70 @@
+import logging
+import traceback
+from contextvars import ContextVar, Token
+from typing import Any, Dict, List, Optional, Sequence
+
+from .hooks import query_methods
+from .instrument import fingerprint_sql
+
+__all__ = 'RepeatedQueries', 'count_repeated', 'repeated_queries_key'
+
+logger = logging.getLogger('foxglove.db.repeated')
+
+# key in scope['state'] where the report is stored for TestClient to fail the test
+repeated_queries_key = 'repeated_queries'
+_repeated_queries: ContextVar[Optional['RepeatedQueries']] = ContextVar('foxglove_repeated_queries', default=None)
+
+
+class RepeatedQueries:
+    """
+    Count queries with the same fingerprint made during a request to find N+1 queries: queries run in a loop
+    which could be replaced by a single query. The stack is captured when a fingerprint first exceeds the limit.
+    """
+
+    __slots__ = 'limit', 'counts', 'stacks'
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.counts: Dict[str, int] = {}
+        self.stacks: Dict[str, List[str]] = {}
+
+    def record(self, sql: str) -> None:
+        fingerprint = fingerprint_sql(sql)
+        count = self.counts[fingerprint] = self.counts.get(fingerprint, 0) + 1
+        if count == self.limit + 1:
+            # skip this frame, record_repeated, count_repeated and the QueryHooksMixin methods
+            self.stacks[fingerprint] = traceback.format_stack()[:-5]
+
+    def report(self) -> Optional[str]:
+        """
+        Description of queries which were repeated more than limit times, or None if there were none.
+        """
+        if not self.stacks:
+            return None
+        lines = []
+        for fingerprint, stack in self.stacks.items():
+            lines.append(f'{self.counts[fingerprint]} queries (limit {self.limit}): {fingerprint}\n')
+            lines.extend(stack)
+        return 'repeated queries in request, use a join or "where id = any($1)" instead:\n' + ''.join(lines)
+
+
+def count_repeated(conn: Any, method: str, sql: Optional[str], args: Sequence[Any]) -> None:
+    """
+    Query hook (see foxglove.db.hooks) which counts queries in the current request's RepeatedQueries, used for pools
+    in dev_mode and test_mode if settings.pg_repeated_query_limit is set.
+    """
+    if method in query_methods:
+        record_repeated(sql)
+
+
+def record_repeated(query: str) -> None:
+    if (repeated := _repeated_queries.get()) is not None:
+        repeated.record(query)
+
+
+def start_repeated_queries(repeated: RepeatedQueries) -> 'Token[Optional[RepeatedQueries]]':
+    return _repeated_queries.set(repeated)
+
+
+def reset_repeated_queries(token: 'Token[Optional[RepeatedQueries]]') -> None:
+    _repeated_queries.reset(token)
@@ -0,0 +1,140 @@
+import re
+from contextvars import ContextVar, Token
+from functools import lru_cache
+from itertools import cycle
+from typing import Any, Dict, List, Optional, Sequence
+
+from buildpg.asyncpg import BuildPgConnection, BuildPgPool
+
+__all__ = 'ReplicaPoolSet', 'RequestWrites', 'track_writes', 'tracks_writes', 'is_write'
+
+strategies = 'round-robin', 'least-busy'
+
+
+class ReplicaPoolSet:
+    """
+    Pools for read-only replicas which behave like a single pool, each acquire() picks a pool either in turn
+    ("round-robin") or the pool with the fewest connections currently in use ("least-busy").
+    """
+
+    def __init__(self, pools: List[BuildPgPool], *, strategy: str = 'round-robin'):
+        assert pools, 'at least one pool is required'
+        assert strategy in strategies, f'strategy must be one of {strategies}, not {strategy!r}'
+        self.pools = pools
+        self.strategy = strategy
+        self._cycle = cycle(pools)
+        self._in_use: Dict[int, int] = {id(p): 0 for p in pools}
+        # connection id -> the pool it came from, so it can be released
+        self._conn_pools: Dict[int, BuildPgPool] = {}
+
+    def choose(self) -> BuildPgPool:
+        if self.strategy == 'round-robin':
+            return next(self._cycle)
+        else:
+            return min(self.pools, key=lambda p: self._in_use[id(p)])
+
+    async def acquire(self, *, timeout: Optional[float] = None) -> BuildPgConnection:
+        pool = self.choose()
+        self._in_use[id(pool)] += 1
+        try:
+            conn = await pool.acquire(timeout=timeout)
+        except BaseException:
+            self._in_use[id(pool)] -= 1
+            raise
+        self._conn_pools[id(conn)] = pool
+        return conn
+
+    async def release(self, conn: BuildPgConnection) -> None:
+        pool = self._conn_pools.pop(id(conn))
+        self._in_use[id(pool)] -= 1
+        await pool.release(conn)
+
+    async def close(self) -> None:
+        for pool in self.pools:
+            await pool.close()
+
+    def __repr__(self) -> str:
+        return f'<ReplicaPoolSet {len(self.pools)} pools, {self.strategy}>'
+
+
+# statements which can't change data, "with" statements are checked for data modifying sub-statements
+read_keywords = frozenset(
+    {
+        'select',
+        'show',
+        'explain',
+        'values',
+        'table',
+        'fetch',
+        'begin',
+        'start',
+        'commit',
+        'end',
+        'rollback',
+        'abort',
+        'savepoint',
+        'release',
+        'set',
+        'reset',
+        'discard',
+        'listen',
+        'unlisten',
+    }
+)
+first_word_regex = re.compile(r'(?:\s+|--[^\n]*|/\*.*?\*/)*(\w+)', re.S)
+modifying_regex = re.compile(r'\b(?:insert|update|delete|merge)\b', re.I)
+
+
+@lru_cache(maxsize=1024)
+def is_write(sql: str) -> bool:
+    """
+    Whether a statement might change data, based on its first keyword. Writes made by functions called from a select
+    aren't detected.
+    """
+    m = first_word_regex.match(sql)
+    if m is None:
+        return False
+    word = m.group(1).lower()
+    if word == 'with':
+        return bool(modifying_regex.search(sql))
+    return word not in read_keywords
+
+
+class RequestWrites:
+    """
+    Whether a statement which might change data has been run during a request, set by the track_writes query hook.
+    """
+
+    __slots__ = ('wrote',)
+
+    def __init__(self):
+        self.wrote = False
+
+
+_request_writes: ContextVar[Optional[RequestWrites]] = ContextVar('foxglove_request_writes', default=None)
+
+
+def track_writes(conn: Any, method: str, sql: Optional[str], args: Sequence[Any]) -> None:
+    """
+    Query hook (see foxglove.db.hooks) which marks the current request's RequestWrites when a statement which might
+    change data is run or prepared (it may be run any number of times later), copies always write. Used for pools
+    when replicas are configured so the WAL position is only recorded after requests which wrote.
+    """
+    writes = _request_writes.get()
+    if writes is not None and not writes.wrote and (sql is None or is_write(sql)):
+        writes.wrote = True
+
+
+def tracks_writes(conn: Any) -> bool:
+    """
+    Whether writes made with conn are recorded by track_writes.
+    """
+    return track_writes in getattr(conn, 'query_hooks', ())
+
+
+def start_request_writes(writes: RequestWrites) -> 'Token[Optional[RequestWrites]]':
+    return _request_writes.set(writes)
+
+
+def reset_request_writes(token: 'Token[Optional[RequestWrites]]') -> None:
+    _request_writes.reset(token)
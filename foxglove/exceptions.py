@@ -26,6 +26,7 @@ __all__ = (
     'HttpConflict',
     'HttpUnprocessableEntity',
     'HttpTooManyRequests',
+    'HttpServiceUnavailable',
     'Http470',
     'manual_response_error',
     'UnexpectedResponse',
@@ -125,6 +126,10 @@ class HttpTooManyRequests(HttpMessageError):
     status = 429
 
 
+class HttpServiceUnavailable(HttpMessageError):
+    status = 503
+
+
 class Http470(HttpMessageError):
     status = 470
     custom_reason = 'Invalid user input'
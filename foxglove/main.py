@@ -1,6 +1,6 @@
 import asyncio
 import os
-from typing import Literal
+from typing import TYPE_CHECKING, Literal, Union
 
 import arq
 import httpx
@@ -8,17 +8,27 @@ from buildpg.asyncpg import BuildPgPool
 from pydantic.env_settings import BaseSettings as PydanticBaseSettings
 from uvicorn.importer import ImportFromStringError, import_from_string
 
-from .db import create_pg_pool
+from .db import create_pg_pool, create_pg_replica_pools
 from .settings import BaseSettings
 
+if TYPE_CHECKING:
+    from .cloudflare import CloudflareIPStore
+    from .db.replicas import ReplicaPoolSet
+    from .reporting import ErrorReporter, EventRateLimiter
+
 __all__ = ('glove',)
 
 
 class Glove:
     _settings: BaseSettings
     _http: httpx.AsyncClient
+    _cloudflare_ips: 'CloudflareIPStore'
     pg: BuildPgPool
+    # replica pools, or the same as pg if no replicas are configured
+    pg_read: Union[BuildPgPool, 'ReplicaPoolSet']
     redis: arq.ArqRedis
+    error_reporter: 'ErrorReporter'
+    event_limiter: 'EventRateLimiter'
 
     async def startup(self, *, run_migrations: Literal[True, False, 'unless-test-mode'] = 'unless-test-mode') -> None:
         from .logs import setup_sentry
@@ -30,23 +40,57 @@ class Glove:
 
         if not hasattr(self, 'pg'):
             self.pg = await create_pg_pool(self.settings, run_migrations=run_migrations)
+        if not hasattr(self, 'pg_read'):
+            self.pg_read = await create_pg_replica_pools(self.settings) or self.pg
         if not hasattr(self, 'redis') and self.settings.redis_settings:
             self.redis = await arq.create_pool(self.settings.redis_settings)
+            if self.settings.request_timings:
+                from .timing import timed_redis_execute
+
+                self.redis.execute = timed_redis_execute(self.redis.execute)
+        if cloudflare_ips := getattr(self, '_cloudflare_ips', None):
+            await cloudflare_ips.startup(getattr(self, 'redis', None))
+        if not hasattr(self, 'event_limiter') and self.settings.error_event_burst and not self.settings.test_mode:
+            from .reporting import EventRateLimiter
+
+            self.event_limiter = EventRateLimiter(
+                burst=self.settings.error_event_burst,
+                window=self.settings.error_event_window,
+                redis=getattr(self, 'redis', None) if self.settings.error_event_limit_redis else None,
+            )
+        if not hasattr(self, 'error_reporter') and not self.settings.test_mode:
+            from .reporting import ErrorReporter
+
+            self.error_reporter = ErrorReporter(
+                max_size=self.settings.error_report_queue_size,
+                batch_size=self.settings.error_report_batch_size,
+                event_limiter=getattr(self, 'event_limiter', None),
+                summary_interval=self.settings.error_event_window,
+            )
+            self.error_reporter.start()
 
     def context(self) -> 'GloveContext':
         return GloveContext(self)
 
     async def shutdown(self) -> None:
+        if error_reporter := getattr(self, 'error_reporter', None):
+            # flush error reports before closing connections they might use
+            await error_reporter.shutdown()
         coros = []
+        if cloudflare_ips := getattr(self, '_cloudflare_ips', None):
+            # the store itself is kept so middleware referencing it continues to work after a restart
+            await cloudflare_ips.shutdown()
         if pg := getattr(self, 'pg', None):
             coros.append(pg.close())
+        if (pg_read := getattr(self, 'pg_read', None)) and pg_read is not pg:
+            coros.append(pg_read.close())
         if http := getattr(self, '_http', None):
             coros.append(http.aclose())
         if redis := getattr(self, 'redis', None):
             redis.close()
             coros.append(redis.wait_closed())
         await asyncio.gather(*coros)
-        for prop in 'pg', '_http', 'redis':
+        for prop in 'pg', 'pg_read', '_http', 'redis', 'error_reporter', 'event_limiter':
             if hasattr(self, prop):
                 delattr(self, prop)
 
@@ -54,9 +98,28 @@ class Glove:
     def http(self) -> httpx.AsyncClient:
         http = getattr(self, '_http', None)
         if http is None:
-            http = self._http = httpx.AsyncClient(timeout=self.settings.http_client_timeout)
+            event_hooks = None
+            if self.settings.request_timings:
+                from .timing import http_request_hook, http_response_hook
+
+                event_hooks = {'request': [http_request_hook], 'response': [http_response_hook]}
+            http = self._http = httpx.AsyncClient(timeout=self.settings.http_client_timeout, event_hooks=event_hooks)
         return http
 
+    @property
+    def cloudflare_ips(self) -> 'CloudflareIPStore':
+        """
+        Cloudflare IP ranges, created on first use, startup loads them from redis and starts refreshing them
+        if settings.cloudflare_ips_refresh_interval is set.
+        """
+        cloudflare_ips = getattr(self, '_cloudflare_ips', None)
+        if cloudflare_ips is None:
+            from .cloudflare import CloudflareIPStore
+
+            interval = self.settings.cloudflare_ips_refresh_interval
+            cloudflare_ips = self._cloudflare_ips = CloudflareIPStore(refresh_interval=interval)
+        return cloudflare_ips
+
     @property
     def settings(self) -> BaseSettings:
         settings = getattr(self, '_settings', None)
@@ -1,25 +1,43 @@
-import asyncio
 import json
 import logging
 import re
 import secrets
-from ipaddress import ip_address, ip_network
-from operator import attrgetter
+from dataclasses import dataclass
+from functools import partial
 from time import time
-from typing import Any, AsyncGenerator, Awaitable, Callable, Dict, List, Literal, Optional, Set
+from typing import (
+    Any,
+    AsyncGenerator,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    Mapping,
+    Optional,
+    Pattern,
+    Set,
+    Tuple,
+    Union,
+)
+from urllib.parse import urlsplit
 
 from sentry_sdk import capture_event
 from sentry_sdk.utils import event_from_exception, exc_info_from_error
 from starlette.applications import Starlette
-from starlette.datastructures import URL
+from starlette.datastructures import Headers
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.requests import Request
 from starlette.responses import RedirectResponse, Response
 from starlette.routing import get_name as get_endpoint_name
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
 from . import glove
-from .exceptions import UnexpectedResponse
-from .utils import get_ip
+from .cloudflare import CloudflareIPStore, IPRangeCounter, IPRangeIndex, get_cloudflare_ips  # noqa: F401
+from .db.instrument import RequestInstrumentation
+from .utils import LazyDict, get_ip
 
 logger = logging.getLogger('foxglove.middleware')
 request_logger = logging.getLogger('foxglove.bad_requests')
@@ -27,6 +45,8 @@ CallNext = Callable[[Request], Awaitable[Response]]
 
 __all__ = (
     'ErrorMiddleware',
+    'CapturedResponse',
+    'ResponseCapture',
     'CsrfMiddleware',
     'HostRedirectMiddleware',
     'CloudflareCheckMiddleware',
@@ -36,14 +56,113 @@ __all__ = (
 )
 
 
-class ErrorMiddleware(BaseHTTPMiddleware):
+class CapturedResponse:
+    """
+    Stand-in for a starlette Response built from the ASGI messages sent by the app, this is what
+    ErrorMiddleware passes to should_warn and uses when logging unexpected responses.
+
+    should_warn is called as the response starts, before any of the body has been sent, so body is always empty
+    at that point, a should_warn which checks the body (which worked with the BaseHTTPMiddleware implementation)
+    must be changed to only use status_code and headers.
+    """
+
+    __slots__ = 'status_code', 'raw_headers', 'body_chunks', 'body_size'
+
+    def __init__(self, message: Message):
+        self.status_code: int = message['status']
+        self.raw_headers: List[Tuple[bytes, bytes]] = list(message.get('headers', []))
+        self.body_chunks: List[bytes] = []
+        self.body_size = 0
+
+    def add_body(self, chunk: bytes, limit: int) -> None:
+        """
+        Record a chunk of the body, only the first limit bytes are kept but body_size counts the whole body.
+        """
+        if (remaining := limit - self.body_size) > 0:
+            self.body_chunks.append(chunk[:remaining])
+        self.body_size += len(chunk)
+
+    @property
+    def headers(self) -> Headers:
+        return Headers(raw=self.raw_headers)
+
+    @property
+    def body(self) -> bytes:
+        return b''.join(self.body_chunks)
+
+
+@dataclass
+class ErrorEvent:
+    """
+    An error or unexpected response ready to be logged, everything needing the request has already been resolved.
+    """
+
+    message: str
+    level: str
+    fingerprint: Tuple[str, ...]
+    data: Dict[str, Any]
+    exc: Optional[Exception]
+
+
+class ResponseCapture:
+    """
+    Watches the messages of one response for ErrorMiddleware (and FoxgloveMiddleware), should_warn decides
+    whether the response is reported as it starts, if so the start of the body is kept for the report.
+    """
+
+    __slots__ = 'errors', 'response', 'warn', 'body_limit'
+
+    def __init__(self, errors: 'ErrorMiddleware'):
+        self.errors = errors
+        self.response: Optional[CapturedResponse] = None
+        self.warn = False
+        self.body_limit = 0
+
+    def record(self, message: Message) -> None:
+        """
+        Called with each message before it's sent.
+        """
+        if message['type'] == 'http.response.start':
+            self.response = CapturedResponse(message)
+            self.warn = self.errors.should_warn(self.response)
+            if self.warn:
+                self.body_limit = self.errors.glove.settings.log_response_body_limit
+        elif self.warn and message['type'] == 'http.response.body':
+            self.response.add_body(message.get('body', b''), self.body_limit)
+
+    async def handle_error(self, request: Request, exc: Exception, send: Send) -> None:
+        """
+        Return a 500 response if the response hasn't started and report the error. If the response has already
+        started there's nothing more we can send, the server will close the connection.
+        """
+        if self.response is None:
+            error_response = Response('Internal Server Error', media_type='text/plain', status_code=500)
+            await error_response(request.scope, request.receive, send)
+        await self.errors.report(request, exc=exc)
+
+    async def complete(self, request: Request) -> None:
+        """
+        Called once the response has been sent without an error.
+        """
+        if self.warn:
+            await self.errors.report(request, response=self.response)
+
+
+class ErrorMiddleware:
+    """
+    Catch and log errors and unexpected responses, implemented as raw ASGI middleware rather than with
+    BaseHTTPMiddleware to avoid the extra task and memory stream on every request.
+
+    should_warn gets a CapturedResponse with the status and headers but no body, see CapturedResponse.
+    """
+
     def __init__(
         self,
-        app: Starlette,
-        should_warn: Callable[[Response], bool] = None,
+        app: ASGIApp,
+        should_warn: Callable[[CapturedResponse], bool] = None,
         get_user: Callable[[Request], Awaitable[Dict[str, Any]]] = None,
     ):
-        super().__init__(app)
+        self.app = app
         self.custom_should_warn = should_warn
         self.get_user = get_user
 
@@ -51,50 +170,116 @@ class ErrorMiddleware(BaseHTTPMiddleware):
 
         self.glove = glove
 
-    async def dispatch(self, request: Request, call_next: CallNext) -> Response:
-        try:
-            request.state.start_time = get_request_start(request)
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        request = Request(scope, receive)
+        request.state.start_time = get_request_start(request)
+        instruments = RequestInstrumentation(self.glove.settings, scope.setdefault('state', {}))
+        capture = ResponseCapture(self)
 
+        async def send_wrapper(message: Message) -> None:
+            if message['type'] == 'http.response.start':
+                instruments.response_start(message)
+            capture.record(message)
+            await send(message)
+
+        try:
             try:
-                response = await call_next(request)
+                await self.app(scope, receive, send_wrapper)
             except Exception as exc:
-                await self.log(request, exc=exc)
-                return Response('Internal Server Error', media_type='text/plain', status_code=500)
+                await capture.handle_error(request, exc, send)
             else:
-                if self.should_warn(response):
-                    await self.log(request, response=response)
-                return response
+                await capture.complete(request)
         except Exception:  # pragma: no cover
             # not sure if this is required, but better to keep it
             logger.critical('unhandled error in ErrorMiddleware', exc_info=True)
             raise
+        finally:
+            instruments.reset()
+
+    async def report(
+        self,
+        request: Request,
+        *,
+        exc: Optional[Exception] = None,
+        response: Optional[CapturedResponse] = None,
+    ) -> None:
+        """
+        Report the request, this is called after the response has been sent. Everything which needs the request,
+        including get_user, is resolved here, then if glove.error_reporter is running the event is logged in a
+        background task, otherwise (e.g. in test mode) it's logged here.
+        """
+        request.state.end_time = time()
+        event = await self.build_event(request, exc=exc, response=response)
+        reporter = getattr(self.glove, 'error_reporter', None)
+        if reporter and reporter.running:
+            reporter.submit(partial(self.emit, event))
+        else:
+            await self.emit(event)
 
     async def log(
-        self, request: Request, *, exc: Optional[Exception] = None, response: Optional[Response] = None
+        self,
+        request: Request,
+        *,
+        exc: Optional[Exception] = None,
+        response: Union[Response, CapturedResponse, None] = None,
     ) -> None:
-        event_data = await request_log_extra(request, exc, response)
-        event_data['user'] = await self.user_info(request)
-        view_ref = event_data['transaction']
+        await self.emit(await self.build_event(request, exc=exc, response=response))
 
+    async def build_event(
+        self,
+        request: Request,
+        *,
+        exc: Optional[Exception] = None,
+        response: Union[Response, CapturedResponse, None] = None,
+    ) -> 'ErrorEvent':
+        view_ref = get_transaction(request.scope)
         if exc:
             level = 'error'
             message = f'"{line_one(request)}", {exc!r}'
             fingerprint = view_ref, request.method, repr(exc)
-            request_logger.exception(message, extra=event_data)
         else:
             assert response is not None
             level = 'warning'
             message = f'"{line_one(request)}", unexpected response: {response.status_code}'
-            request_logger.warning(message, extra=event_data)
             fingerprint = view_ref, request.method, str(response.status_code)
 
+        event_data = await request_log_extra(request, exc, response)
+        event_data['user'] = await self.user_info(request)
+        return ErrorEvent(message, level, fingerprint, event_data, exc)
+
+    async def emit(self, event: 'ErrorEvent') -> None:
+        """
+        Log the event and send it to sentry, unless it's suppressed by glove.event_limiter.
+        """
+        message, event_data, exc = event.message, event.data, event.exc
+        if event_limiter := getattr(self.glove, 'event_limiter', None):
+            suppressed = await event_limiter.check(event.fingerprint, message)
+            if suppressed is None:
+                # too many similar events, this one is counted and reported with the next event emitted or by
+                # ErrorReporter's periodic summary
+                return
+            elif suppressed:
+                message += f', suppressed {suppressed} similar events'
+                event_data['extra']['suppressed_events'] = suppressed
+
+        if exc:
+            request_logger.exception(message, exc_info=exc, extra=event_data)
+        else:
+            request_logger.warning(message, extra=event_data)
+
         if glove.settings.sentry_dsn:
             hint = None
             if exc:
                 exc_data, hint = event_from_exception(exc_info_from_error(exc))
                 event_data.update(exc_data)
 
-            event_data.update(message=message, level=level, logger='foxglove.request_errors', fingerprint=fingerprint)
+            event_data.update(
+                message=message, level=event.level, logger='foxglove.request_errors', fingerprint=event.fingerprint
+            )
             if not capture_event(event_data, hint):
                 logger.critical(
                     'sentry not configured correctly, not sending message: %s',
@@ -102,7 +287,7 @@ class ErrorMiddleware(BaseHTTPMiddleware):
                     extra={'event_data': event_data},
                 )
 
-    def should_warn(self, response: Response) -> bool:
+    def should_warn(self, response: Union[Response, CapturedResponse]) -> bool:
         if self.custom_should_warn:
             return self.custom_should_warn(response)
         else:
@@ -115,76 +300,142 @@ class ErrorMiddleware(BaseHTTPMiddleware):
                 user.update(await get_user(request))
             except Exception:
                 logger.exception('error getting user for middleware logging')
+            finally:
+                # the request's connection has already been released, release any connection get_user acquired
+                if get_pg_conn := getattr(request.state, 'get_pg_conn', None):
+                    await get_pg_conn.release()
         return user
 
     @staticmethod
     async def response_body(response: Response) -> bytes:
-        if hasattr(response, 'body'):
-            return response.body
-        else:
-            body_chunks = []
-            async for chunk in response.body_iterator:
-                if not isinstance(chunk, bytes):
-                    chunk = chunk.encode(response.charset)
-                body_chunks.append(chunk)
-
-            response.body_iterator = async_gen_list(body_chunks)
-            return b''.join(body_chunks)
+        return await get_response_body(response, glove.settings.log_response_body_limit)
 
 
 async def request_log_extra(
-    request: Request, exc: Optional[Exception] = None, response: Optional[Response] = None
+    request: Request, exc: Optional[Exception] = None, response: Union[Response, CapturedResponse, None] = None
 ) -> Dict[str, Any]:
-    extra = dict(query=dict(request.query_params))
+    """
+    Build "extra" for logging and sentry events about a request. Values which are expensive to build are only
+    calculated when they're read, request and response bodies are truncated to the log_request_body_limit and
+    log_response_body_limit settings.
+    """
+    settings = glove.settings
+    extra = LazyDict()
+    extra.set_lazy('query', lambda: dict(request.query_params))
 
     if start_time := getattr(request.state, 'start_time', None):
-        extra['duration'] = f'{(time() - start_time) * 1000:0.2f}ms'
+        end_time = getattr(request.state, 'end_time', None) or time()
+        extra['duration'] = f'{(end_time - start_time) * 1000:0.2f}ms'
+
+    if timings := getattr(request.state, 'timings', None):
+        extra.set_lazy('timings', timings.as_dict)
+
+    if queries := getattr(request.state, 'queries', None):
+        extra['db_time'] = f'{queries.total_time * 1000:0.2f}ms'
+        extra.set_lazy('queries', lambda: queries.queries)
+        if queries.omitted:
+            extra['queries_omitted'] = queries.omitted
 
     if endpoint := request.scope.get('endpoint'):
-        extra.update(route_endpoint=get_endpoint_name(endpoint), path_params=dict(request.path_params))
+        extra['route_endpoint'] = get_endpoint_name(endpoint)
+        extra.set_lazy('path_params', lambda: dict(request.path_params))
 
     if exc:
-        extra['exception_extra'] = exc_extra(exc)
+        extra.set_lazy('exception_extra', partial(exc_extra, exc))
     elif response:
-        extra.update(
-            response_status=response.status_code,
-            response_headers=dict(response.headers),
-            response_body=lenient_json(await get_response_body(response)),
-        )
+        limit = settings.log_response_body_limit
+        body = await get_response_body(response, limit)
+        if isinstance(response, CapturedResponse):
+            body_size: Optional[int] = response.body_size
+        else:
+            # the full size of a streaming response isn't known if it's been truncated
+            body_size = len(body) if hasattr(response, 'body') or len(body) <= limit else None
+        extra['response_status'] = response.status_code
+        extra.set_lazy('response_headers', lambda: dict(response.headers))
+        extra.set_lazy('response_body', partial(capped_json, body, limit, body_size))
+
+    request_data = LazyDict(method=request.method)
+    request_data.set_lazy('url', lambda: str(request.url))
+    request_data.set_lazy('query_string', lambda: request.url.query)
+    request_data.set_lazy('cookies', lambda: dict(request.cookies))
+    request_data.set_lazy('headers', lambda: dict(request.headers))
+    request_body: Optional[bytes] = request.scope.get('_body')
+    request_body_size = None if request_body is None else len(request_body)
+    request_body_limit = settings.log_request_body_limit
+    request_data.set_lazy('data', partial(capped_json, request_body, request_body_limit, request_body_size))
+    request_data.set_lazy('inferred_content_type', lambda: request.headers.get('Content-Type'))
 
     return dict(
         extra=extra,
         user=dict(ip_address=get_ip(request)),
-        transaction=re.sub(r'/\d{2,}/', '/{number}/', str(request.url.path)),
-        request=dict(
-            url=str(request.url),
-            query_string=request.url.query,
-            cookies=dict(request.cookies),
-            headers=dict(request.headers),
-            method=request.method,
-            data=lenient_json(request.scope.get('_body')),
-            inferred_content_type=request.headers.get('Content-Type'),
-        ),
+        transaction=get_transaction(request.scope),
+        request=request_data,
     )
 
 
-async def get_response_body(response: Response) -> bytes:
+unmatched_transaction = '<unmatched>'
+
+
+def get_transaction(scope: Scope) -> str:
+    """
+    Name of the view for logging, this is the path template of the matched route (e.g. "/users/{id}/") or the
+    endpoint name if the route has no path. If no route matched unmatched_transaction is used rather than the path,
+    the transaction is part of event fingerprints so requests to random paths would otherwise each get their own.
+    """
+    if path := getattr(scope.get('route'), 'path', None):
+        return path
+    elif endpoint := scope.get('endpoint'):
+        return get_endpoint_name(endpoint)
+    else:
+        return unmatched_transaction
+
+
+def capped_json(body: Optional[bytes], limit: int, size: Optional[int]) -> Any:
+    """
+    Decode a body for logging, bodies longer than limit are truncated and not decoded. size is the full size of the
+    body or None if it's not known.
+    """
+    if body is None:
+        return None
+    elif size is None or size > limit:
+        total = f'{size:,} bytes' if size is not None else f'over {limit:,} bytes'
+        return f'{body[:limit].decode(errors="replace")}... (truncated, {total})'
+    else:
+        return lenient_json(body)
+
+
+async def get_response_body(response: Response, limit: Optional[int] = None) -> bytes:
+    """
+    Get the body of a response for logging, for streaming responses at most limit + 1 bytes are read (so truncation
+    can be detected), the response's body_iterator is replaced so the captured chunks followed by the rest of the
+    stream are still sent to the client.
+    """
     if hasattr(response, 'body'):
         return response.body
-    else:
-        body_chunks = []
-        async for chunk in response.body_iterator:
-            if not isinstance(chunk, bytes):
-                chunk = chunk.encode(response.charset)
-            body_chunks.append(chunk)
 
-        response.body_iterator = async_gen_list(body_chunks)
-        return b''.join(body_chunks)
+    body_chunks: List[bytes] = []
+    size = 0
+    iterator = response.body_iterator.__aiter__()
+    async for chunk in iterator:
+        if not isinstance(chunk, bytes):
+            chunk = chunk.encode(response.charset)
+        body_chunks.append(chunk)
+        size += len(chunk)
+        if limit is not None and size > limit:
+            break
+
+    response.body_iterator = tee_body(body_chunks, iterator, response.charset)
+    body = b''.join(body_chunks)
+    return body if limit is None else body[: limit + 1]
 
 
-async def async_gen_list(list_: List[bytes]) -> AsyncGenerator[bytes, None]:
-    for c in list_:
-        yield c
+async def tee_body(
+    captured: List[bytes], rest: AsyncIterator[Union[str, bytes]], charset: str
+) -> AsyncGenerator[bytes, None]:
+    for chunk in captured:
+        yield chunk
+    async for chunk in rest:
+        yield chunk if isinstance(chunk, bytes) else chunk.encode(charset)
 
 
 def line_one(request: Request) -> str:
@@ -243,49 +494,148 @@ def update_session_id(request: Request) -> str:
     return new_session_id
 
 
-class CsrfMiddleware(BaseHTTPMiddleware):
+benign_methods = frozenset({'HEAD', 'GET', 'OPTIONS'})
+# matches "scheme://hostname" at the start of a URL when there's no port, credentials or IPv6 address to deal with
+simple_origin_regex = re.compile(r'([a-z][a-z\d+\-.]*://[^/?#@:\[\]]+)(?:[/?#]|$)', flags=re.I)
+
+
+def referrer_origin(referrer: str) -> str:
+    """
+    Convert a Referer header to "scheme://hostname" for comparison with allowed origins, uses a regex in the common
+    case and only falls back to fully parsing the URL if that fails.
+    """
+    if m := simple_origin_regex.match(referrer):
+        return m.group(1).lower()
+    url = urlsplit(referrer)
+    return f'{url.scheme}://{url.hostname}'
+
+
+# flags which can be scoped to a group, re.UNICODE is the default for str patterns so is left out
+scoped_flags = (re.ASCII, 'a'), (re.IGNORECASE, 'i'), (re.MULTILINE, 'm'), (re.DOTALL, 's'), (re.VERBOSE, 'x')
+global_flags_regex = re.compile(r'\(\?[aiLmsux]+\)')
+
+
+def scoped_pattern(pattern: Pattern) -> str:
+    """
+    Pattern as a group with its flags scoped to the group (e.g. "(?i:...)") so it can be combined with others,
+    leading global flags like "(?i)" are already included in pattern.flags so they're removed.
+    """
+    source = pattern.pattern
+    while m := global_flags_regex.match(source):
+        source = source[m.end() :]
+    flags = ''.join(letter for flag, letter in scoped_flags if pattern.flags & flag)
+    if pattern.flags & re.VERBOSE:
+        # end any comment on the last line so it doesn't swallow the closing bracket
+        source += '\n'
+    return f'(?{flags}:{source})'
+
+
+def combine_patterns(patterns: Iterable[Pattern]) -> Optional[Pattern]:
+    """
+    Combine a list of patterns into one regex so a path or origin can be checked with a single fullmatch call, each
+    pattern keeps its own flags.
+    """
+    patterns = list(patterns)
+    if patterns:
+        return re.compile('|'.join(scoped_pattern(p) for p in patterns))
+
+
+class CsrfMiddleware:
     """
     Ensures a GET request has been made before post requests and that session_id is set in the session.
 
-    This prevents CSRF especially if the cookie has same_site strict
+    This prevents CSRF especially if the cookie has same_site strict.
+
+    Paths are checked against settings:
+    * csrf_ignore_paths: no checks at all, the session isn't touched
+    * csrf_upload_paths: must be "multipart/form-data", Origin and Referrer headers may be omitted
+    * csrf_cross_origin_paths: unsafe requests with an Origin matching cross_origin_origins are allowed
+      without a session
     """
 
     def __init__(
         self,
-        app: Starlette,
+        app: ASGIApp,
         *,
         should_check: Callable[[Request], bool] = None,
         enable_header_check: bool = None,
         allows_origins: Set[str] = None,
     ):
-        super().__init__(app)
+        self.app = app
         self.should_check = should_check
+        settings = glove.settings
         if enable_header_check is None:
-            self.enable_header_check = not (glove.settings.dev_mode or glove.settings.test_mode)
+            self.enable_header_check = not (settings.dev_mode or settings.test_mode)
         else:
             self.enable_header_check = enable_header_check
-        self.allows_origins = glove.settings.origin if allows_origins is None else allows_origins
+        if allows_origins is None:
+            allows_origins = {settings.origin} if settings.origin else set()
+        self.allows_origins: FrozenSet[str] = frozenset(allows_origins)
+
+        self.ignore_paths = combine_patterns(settings.csrf_ignore_paths)
+        self.upload_paths = combine_patterns(settings.csrf_upload_paths)
+        self.cross_origin_paths = combine_patterns(settings.csrf_cross_origin_paths)
+        self.cross_origin_origins = combine_patterns(settings.cross_origin_origins)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
 
-    async def dispatch(self, request: Request, call_next: CallNext) -> Response:
-        if self.should_check and not self.should_check(request):
-            return await call_next(request)
+        error_response, set_session_id = self.check_request(scope, receive, Headers(scope=scope))
+        if error_response:
+            await error_response(scope, receive, send)
+        elif set_session_id:
+            session = scope['session']
 
-        session_id = request.session.get(session_id_key)
-        benign_request = request.method in {'HEAD', 'GET', 'OPTIONS'}
-        if not benign_request:
-            if session_id is None:
-                return Response(no_cookie_response, media_type='application/json', status_code=403)
-            if error := self.header_check(request):
-                return Response(header_error_response % error, media_type='application/json', status_code=403)
+            async def send_wrapper(message: Message) -> None:
+                # set the session id for any valid GET request, this must happen before the session
+                # middleware sees the start of the response
+                if message['type'] == 'http.response.start' and message['status'] == 200:
+                    session[session_id_key] = secrets.token_urlsafe()
+                await send(message)
 
-        response = await call_next(request)
+            await self.app(scope, receive, send_wrapper)
+        else:
+            await self.app(scope, receive, send)
+
+    def check_request(
+        self, scope: Scope, receive: Receive, headers: Mapping[str, str]
+    ) -> Tuple[Optional[Response], bool]:
+        """
+        Returns a response if the request should be rejected and whether session_id should be set in the session
+        when a successful response is sent.
+        """
+        path = scope['path']
+        if self.ignore_paths and self.ignore_paths.fullmatch(path):
+            return None, False
+        if self.should_check and not self.should_check(Request(scope, receive)):
+            return None, False
+
+        session = scope['session']
+        if scope['method'] not in benign_methods:
+            return self.check_unsafe(path, headers, session), False
+        else:
+            return None, session_id_key not in session
+
+    def check_unsafe(self, path: str, headers: Mapping[str, str], session: Dict[str, Any]) -> Optional[Response]:
+        if self.cross_origin_paths and self.cross_origin_paths.fullmatch(path):
+            origin = headers.get('origin')
+            if origin and self.cross_origin_origins and self.cross_origin_origins.fullmatch(origin):
+                return None
 
-        # set the session id for any valid GET request
-        if benign_request and response.status_code == 200 and session_id is None:
-            update_session_id(request)
-        return response
+        if session_id_key not in session:
+            return Response(no_cookie_response, media_type='application/json', status_code=403)
+
+        upload = bool(self.upload_paths and self.upload_paths.fullmatch(path))
+        if upload and not headers.get('content-type', '').startswith('multipart/form-data'):
+            error = 'upload path, wrong Content-Type'
+        else:
+            error = self.header_check(headers, upload=upload)
+        if error:
+            return Response(header_error_response % error, media_type='application/json', status_code=403)
 
-    def header_check(self, request: Request) -> Optional[str]:
+    def header_check(self, headers: Mapping[str, str], *, upload: bool = False) -> Optional[str]:
         """
         Origin and Referrer checks for CSRF, see
         https://cheatsheetseries.owasp.org/cheatsheets/
@@ -296,16 +646,15 @@ class CsrfMiddleware(BaseHTTPMiddleware):
 
         # origin header is optional (e.g. is omitted from firefox uploads)
         origin_ok = False
-        if origin := request.headers.get('origin'):
+        if origin := headers.get('origin'):
             if origin not in self.allows_origins:
                 return 'Incorrect Origin header'
             origin_ok = True
 
-        if referrer := request.headers.get('referer'):
-            referrer_url = URL(referrer)
-            if f'{referrer_url.scheme}://{referrer_url.hostname}' not in self.allows_origins:
+        if referrer := headers.get('referer'):
+            if referrer_origin(referrer) not in self.allows_origins:
                 return 'Incorrect Referrer header'
-        elif not origin_ok:
+        elif not (origin_ok or upload):
             return 'Missing Origin and Referrer headers'
 
 
@@ -322,24 +671,22 @@ class HostRedirectMiddleware(BaseHTTPMiddleware):
             return RedirectResponse(request.url.replace(hostname=self.host), status_code=301)
 
 
-class IPRangeCounter:
-    __slots__ = 'range', 'counter'
-
-    def __init__(self, network_range: str):
-        self.range = ip_network(network_range)
-        self.counter = 0
-
-    def __repr__(self):
-        return f'IPRangeCounter({self.range}, {self.counter})'
-
-
 class CloudflareCheckMiddleware(BaseHTTPMiddleware):
     default_response_body = b'Request incorrectly routed, this looks like a problem with your DNS or Proxy.'
 
     def __init__(self, app: Starlette, response_text: str = None):
         super().__init__(app)
         self.response_body = response_text.encode() if response_text else self.default_response_body
-        self.ip_ranges: Optional[List[IPRangeCounter]] = None
+        # creating the store here means glove.startup will load it from redis and start refreshing it
+        self.ip_store: CloudflareIPStore = glove.cloudflare_ips
+
+    @property
+    def ip_index(self) -> IPRangeIndex:
+        return self.ip_store.index
+
+    @property
+    def ip_ranges(self) -> List[IPRangeCounter]:
+        return self.ip_index.ranges
 
     async def dispatch(self, request: Request, call_next: CallNext) -> Response:
         """
@@ -348,53 +695,26 @@ class CloudflareCheckMiddleware(BaseHTTPMiddleware):
 
         https://stackoverflow.com/a/37061471/949890
         """
-        ip = None
-        x_forwarded_for = request.headers.get('x-forwarded-for')
-        if x_forwarded_for:
-            ip = x_forwarded_for.rsplit(',', 1)[-1].strip()
-        else:
-            client = request.scope.get('client')
-            if client:
-                ip = client[0]
-
+        ip = forwarded_ip(request.headers.get('x-forwarded-for'), request.scope)
         if ip and await self.is_cloudflare_ip(ip):
             return await call_next(request)
+        else:
+            return await self.reject(request, ip)
 
+    async def reject(self, request: Request, ip: Optional[str]) -> Response:
         extra = {'extra': await request_log_extra(request), 'cf_ip_ranges': self.ip_ranges}
         logger.warning('Request not routed through CloudFlare ip=%s url="%s"', ip, request.url, extra=extra)
         return Response(self.response_body, status_code=400)
 
     async def is_cloudflare_ip(self, ip: str) -> bool:
-        try:
-            ip = ip_address(ip.strip())
-        except ValueError:
-            pass
-        else:
-            if self.ip_ranges is None:
-                self.ip_ranges = ip_ranges = await get_cloudflare_ips()
-            else:
-                ip_ranges = self.ip_ranges
-
-            for r in ip_ranges:
-                if ip in r.range:
-                    r.counter += 1
-                    self.ip_ranges.sort(key=attrgetter('counter'), reverse=True)
-                    return True
-        return False
+        return self.ip_store.index.lookup(ip) is not None
 
 
-async def get_cloudflare_ips() -> List[IPRangeCounter]:
+def forwarded_ip(x_forwarded_for: Optional[str], scope: Scope) -> Optional[str]:
     """
-    Get a list of cloudflare IPs from https://www.cloudflare.com/ips-v4 and https://www.cloudflare.com/ips-v6,
-    see https://www.cloudflare.com/en-gb/ips/ for details.
+    The last entry in X-Forwarded-For, or the client address if the header isn't set.
     """
-
-    async def get_ips(v: Literal[4, 6]) -> List[IPRangeCounter]:
-        r = await glove.http.get(f'https://www.cloudflare.com/ips-v{v}', follow_redirects=True)
-        UnexpectedResponse.check(r)
-        return [IPRangeCounter(ip) for ip in r.text.strip().split('\n')]
-
-    v4_ips, v6_ips = await asyncio.gather(get_ips(4), get_ips(6))
-    ips = v4_ips + v6_ips
-    logger.info('downloaded %d IPs from CloudFlare to check requests against', len(ips))
-    return ips
+    if x_forwarded_for:
+        return x_forwarded_for.rsplit(',', 1)[-1].strip()
+    elif client := scope.get('client'):
+        return client[0]
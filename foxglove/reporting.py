@@ -0,0 +1,257 @@
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from time import monotonic, time
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+from sentry_sdk import capture_event
+
+if TYPE_CHECKING:
+    from arq import ArqRedis
+
+logger = logging.getLogger('foxglove.reporting')
+request_logger = logging.getLogger('foxglove.bad_requests')
+
+__all__ = 'ErrorReporter', 'EventRateLimiter', 'Report'
+
+Report = Callable[[], Awaitable[None]]
+
+
+class ErrorReporter:
+    """
+    Bounded queue of reports (e.g. logging a failed request and sending it to sentry) which are run by a background
+    task so reporting never delays a response.
+
+    Reports are run in batches of up to batch_size with a yield to the event loop between batches so a burst of
+    errors doesn't starve request handling. When the queue is full new reports are dropped and counted, the count is
+    logged when the queue is next processed.
+
+    If event_limiter is set, events it has suppressed which haven't been reported with a later event are reported
+    every summary_interval seconds as "suppressed N similar events", so a storm which stops is still summarised.
+    """
+
+    def __init__(
+        self,
+        *,
+        max_size: int = 1000,
+        batch_size: int = 50,
+        event_limiter: Optional['EventRateLimiter'] = None,
+        summary_interval: float = 60,
+    ):
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.event_limiter = event_limiter
+        self.summary_interval = summary_interval
+        self.dropped = 0
+        self._queue: Optional['asyncio.Queue[Report]'] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._queue = asyncio.Queue(self.max_size)
+            self._task = asyncio.create_task(self._run())
+
+    def submit(self, report: Report) -> bool:
+        """
+        Add a report to the queue, returns False if the queue is full and the report has been dropped.
+        """
+        assert self._queue is not None, 'ErrorReporter not started'
+        try:
+            self._queue.put_nowait(report)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+        else:
+            return True
+
+    async def flush(self) -> None:
+        """
+        Wait for all reports currently in the queue to be run.
+        """
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def shutdown(self, timeout: float = 5) -> None:
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(self.flush(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning('timed out flushing error reports, %d reports not sent', self._queue.qsize())
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._log_dropped()
+        await self.report_suppressed()
+        self._task = self._queue = None
+
+    async def report_suppressed(self) -> None:
+        """
+        Log and send to sentry a summary of each group of events suppressed by event_limiter.
+        """
+        if self.event_limiter is None:
+            return
+        for fingerprint, message, count in await self.event_limiter.pop_suppressed():
+            summary = f'{message}, suppressed {count} similar events'
+            request_logger.warning(summary, extra={'suppressed_events': count})
+            event = dict(message=summary, level='warning', logger='foxglove.request_errors', fingerprint=fingerprint)
+            capture_event(dict(event, extra={'suppressed_events': count}))
+
+    async def _run(self) -> None:
+        queue = self._queue
+        next_summary = monotonic() + self.summary_interval
+        while True:
+            if self.event_limiter is None:
+                first = await queue.get()
+            else:
+                try:
+                    first = await asyncio.wait_for(queue.get(), timeout=max(next_summary - monotonic(), 0))
+                except asyncio.TimeoutError:
+                    first = None
+                if monotonic() >= next_summary:
+                    await self.report_suppressed()
+                    next_summary = monotonic() + self.summary_interval
+                if first is None:
+                    continue
+
+            batch: List[Report] = [first]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+
+            self._log_dropped()
+            for report in batch:
+                try:
+                    await report()
+                except Exception:
+                    logger.exception('error running error report')
+                finally:
+                    queue.task_done()
+            # let requests run between batches
+            await asyncio.sleep(0)
+
+    def _log_dropped(self) -> None:
+        if self.dropped:
+            logger.warning('error report queue full, %d reports dropped', self.dropped)
+            self.dropped = 0
+
+
+class EventRateLimiter:
+    """
+    Limit how many events (log records and sentry events) are emitted for each fingerprint.
+
+    Each fingerprint gets a token bucket holding up to burst tokens which refills at burst tokens per window seconds,
+    events without a token are suppressed and counted. check() returns the number of events suppressed since the
+    last emitted event so it can be included in the next one as a "suppressed X similar events" summary,
+    pop_suppressed() returns counts which haven't been reported that way, e.g. because the events stopped, it's called
+    periodically by ErrorReporter.
+
+    If redis is set, the count is shared between workers using a fixed window counter per fingerprint instead,
+    the first event in each window reports how many events were suppressed in the previous window. Counts are read
+    and deleted from redis in one transaction so each is only reported by one worker.
+    """
+
+    redis_prefix = 'foxglove:events'
+
+    def __init__(
+        self, *, burst: int = 10, window: float = 60, redis: 'ArqRedis' = None, max_fingerprints: int = 10_000
+    ):
+        self.burst = burst
+        self.window = window
+        self.redis = redis
+        self.max_fingerprints = max_fingerprints
+        # fingerprint -> [tokens, last updated, suppressed count, message of the last suppressed event]
+        self._buckets: 'OrderedDict[Hashable, List[Any]]' = OrderedDict()
+        # (redis key, window) -> (fingerprint, message) for windows where this worker suppressed events
+        self._redis_windows: Dict[Tuple[str, int], Tuple[Hashable, str]] = {}
+
+    async def check(self, fingerprint: Hashable, message: str = '') -> Optional[int]:
+        """
+        Returns None if the event should be suppressed, otherwise the number of similar events suppressed since the
+        last event with this fingerprint was emitted. message is used in the summary if events are suppressed.
+        """
+        if self.redis is not None:
+            try:
+                return await self._check_redis(fingerprint, message)
+            except Exception as e:
+                logger.warning('error checking event rate limit with redis, %s: %s', e.__class__.__name__, e)
+        return self._check_local(fingerprint, message)
+
+    async def pop_suppressed(self) -> List[Tuple[Hashable, str, int]]:
+        """
+        (fingerprint, message, count) for events which were suppressed and haven't been reported with a later
+        event, the counts are reset so they're only reported once. With redis only finished windows are included.
+        """
+        suppressed = []
+        for fingerprint, bucket in self._buckets.items():
+            if bucket[2]:
+                suppressed.append((fingerprint, bucket[3], bucket[2]))
+                bucket[2] = 0
+
+        window_id = int(time() // self.window)
+        for key, window in [k for k in self._redis_windows if k[1] < window_id]:
+            fingerprint, message = self._redis_windows.pop((key, window))
+            try:
+                count = await self._pop_redis_count(key, window)
+            except Exception as e:
+                logger.warning('error getting suppressed events from redis, %s: %s', e.__class__.__name__, e)
+            else:
+                if count:
+                    suppressed.append((fingerprint, message, count))
+        return suppressed
+
+    def _check_local(self, fingerprint: Hashable, message: str) -> Optional[int]:
+        now = monotonic()
+        bucket = self._buckets.get(fingerprint)
+        if bucket is None:
+            bucket = self._buckets[fingerprint] = [self.burst, now, 0, message]
+            if len(self._buckets) > self.max_fingerprints:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(fingerprint)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.burst / self.window)
+            bucket[1] = now
+
+        if bucket[0] < 1:
+            bucket[2] += 1
+            bucket[3] = message
+            return None
+
+        bucket[0] -= 1
+        suppressed, bucket[2] = bucket[2], 0
+        return suppressed
+
+    async def _check_redis(self, fingerprint: Hashable, message: str) -> Optional[int]:
+        key = f'{self.redis_prefix}:{hashlib.md5(repr(fingerprint).encode()).hexdigest()}'
+        window_id = int(time() // self.window)
+
+        tr = self.redis.multi_exec()
+        tr.incr(f'{key}:{window_id}')
+        tr.expire(f'{key}:{window_id}', int(self.window * 2) + 1)
+        count, _ = await tr.execute()
+        if count > self.burst:
+            self._redis_windows[(key, window_id)] = fingerprint, message
+            return None
+        elif count == 1:
+            return await self._pop_redis_count(key, window_id - 1)
+        else:
+            return 0
+
+    async def _pop_redis_count(self, key: str, window_id: int) -> int:
+        """
+        Get and delete the count for a finished window, returns the number of events suppressed in that window.
+        """
+        tr = self.redis.multi_exec()
+        tr.get(f'{key}:{window_id}')
+        tr.delete(f'{key}:{window_id}')
+        count, _ = await tr.execute()
+        return max(int(count or 0) - self.burst, 0)
@@ -0,0 +1,245 @@
+import csv
+import io
+from abc import ABC, abstractmethod
+from typing import Any, AsyncIterable, AsyncIterator, Mapping, Optional, Sequence
+
+from buildpg.asyncpg import BuildPgConnection
+from starlette.background import BackgroundTask
+from starlette.responses import Response, StreamingResponse
+
+from .db.cursor import iter_rows
+from .db.json_codecs import RawJSON, dumps_bytes
+
+__all__ = (
+    'RawJSONResponse',
+    'StreamingRawJSONResponse',
+    'StreamingRowsResponse',
+    'JSONArrayResponse',
+    'NDJSONResponse',
+    'CSVResponse',
+    'json_bytes',
+)
+
+# streamed responses are sent in chunks of about this size
+stream_chunk_size = 65_536
+
+
+def json_bytes(value: Any) -> bytes:
+    """
+    JSON from postgres as bytes: RawJSON or other bytes are returned as is (see settings.pg_json_codec), strings are
+    encoded, anything else (e.g. values decoded by the "decode" codec) is serialised.
+    """
+    if isinstance(value, bytes):
+        return value
+    elif isinstance(value, str):
+        return value.encode()
+    elif value is None:
+        return b'null'
+    else:
+        return dumps_bytes(value)
+
+
+class RawJSONResponse(Response):
+    """
+    JSON response where the content is already JSON, usually built by postgres, so it's never decoded and
+    encoded again.
+    """
+
+    media_type = 'application/json'
+
+    def render(self, content: Any) -> bytes:
+        return json_bytes(content)
+
+    @classmethod
+    async def from_query(
+        cls,
+        conn: BuildPgConnection,
+        sql: str,
+        *args: Any,
+        status_code: int = 200,
+        headers: Optional[Mapping[str, str]] = None,
+        background: Optional[BackgroundTask] = None,
+    ) -> 'RawJSONResponse':
+        """
+        Response from a query which returns a single JSON value, e.g.
+        "select json_build_object('count', count(*)) from users".
+        """
+        value = await conn.fetchval(sql, *args)
+        return cls(value, status_code=status_code, headers=headers, background=background)
+
+    @classmethod
+    async def from_rows(
+        cls,
+        conn: BuildPgConnection,
+        sql: str,
+        *args: Any,
+        status_code: int = 200,
+        headers: Optional[Mapping[str, str]] = None,
+        background: Optional[BackgroundTask] = None,
+    ) -> 'RawJSONResponse':
+        """
+        Response with a JSON array of the rows returned by a query, each row is an object with its columns as keys.
+        """
+        return await cls.from_query(
+            conn, rows_json_sql(sql), *args, status_code=status_code, headers=headers, background=background
+        )
+
+
+def rows_json_sql(sql: str) -> str:
+    return f"select coalesce(json_agg(t), '[]') from ({sql}) t"
+
+
+class StreamingRawJSONResponse(StreamingResponse):
+    """
+    Stream a JSON array of the rows returned by a query using a server side cursor, so only about prefetch rows are
+    held in memory at once. Each row is converted to JSON by postgres. The connection must stay available until
+    the response is complete, PgMiddleware and FoxgloveMiddleware only release it after the response.
+    """
+
+    media_type = 'application/json'
+
+    def __init__(
+        self,
+        conn: BuildPgConnection,
+        sql: str,
+        *args: Any,
+        prefetch: int = 1000,
+        status_code: int = 200,
+        headers: Optional[Mapping[str, str]] = None,
+        background: Optional[BackgroundTask] = None,
+    ):
+        rows = iter_rows(conn, f'select row_to_json(t) from ({sql}) t', *args, prefetch=prefetch)
+        content = chunked(encode_array((json_bytes(row[0]) async for row in rows)))
+        super().__init__(content, status_code=status_code, headers=headers, background=background)
+
+
+class StreamingRowsResponse(StreamingResponse, ABC):
+    """
+    Base for responses which encode rows (e.g. from iter_rows) as they're sent, rows can be asyncpg records, dicts
+    or any other mapping. Rows are only read as fast as the client receives the response.
+
+    json and jsonb values returned as RawJSON (settings.pg_json_codec = "raw") are included as they are.
+    """
+
+    def __init__(
+        self,
+        rows: AsyncIterable[Mapping[str, Any]],
+        status_code: int = 200,
+        headers: Optional[Mapping[str, str]] = None,
+        background: Optional[BackgroundTask] = None,
+    ):
+        super().__init__(chunked(self.encode(rows)), status_code=status_code, headers=headers, background=background)
+
+    @abstractmethod
+    def encode(self, rows: AsyncIterable[Mapping[str, Any]]) -> AsyncIterator[bytes]:
+        """
+        Encode rows as the body of the response.
+        """
+
+
+class JSONArrayResponse(StreamingRowsResponse):
+    """
+    Stream rows as a JSON array of objects.
+    """
+
+    media_type = 'application/json'
+
+    def encode(self, rows: AsyncIterable[Mapping[str, Any]]) -> AsyncIterator[bytes]:
+        return encode_array((encode_row(row) async for row in rows))
+
+
+class NDJSONResponse(StreamingRowsResponse):
+    """
+    Stream rows as newline delimited JSON, one object per line.
+    """
+
+    media_type = 'application/x-ndjson'
+
+    async def encode(self, rows: AsyncIterable[Mapping[str, Any]]) -> AsyncIterator[bytes]:
+        async for row in rows:
+            yield encode_row(row) + b'\n'
+
+
+class CSVResponse(StreamingRowsResponse):
+    """
+    Stream rows as CSV with a header row, columns are taken from the first row unless they're given.
+    """
+
+    media_type = 'text/csv'
+
+    def __init__(
+        self,
+        rows: AsyncIterable[Mapping[str, Any]],
+        status_code: int = 200,
+        headers: Optional[Mapping[str, str]] = None,
+        background: Optional[BackgroundTask] = None,
+        *,
+        columns: Optional[Sequence[str]] = None,
+    ):
+        self.columns = columns
+        super().__init__(rows, status_code=status_code, headers=headers, background=background)
+
+    async def encode(self, rows: AsyncIterable[Mapping[str, Any]]) -> AsyncIterator[bytes]:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        columns = self.columns
+        if columns is not None:
+            writer.writerow(columns)
+        async for row in rows:
+            if columns is None:
+                columns = list(row.keys())
+                writer.writerow(columns)
+            writer.writerow([csv_value(row[c]) for c in columns])
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+        if remaining := buffer.getvalue():
+            # the header if there were no rows
+            yield remaining.encode()
+
+
+def encode_row(row: Mapping[str, Any]) -> bytes:
+    if not any(isinstance(v, RawJSON) for v in row.values()):
+        return dumps_bytes(dict(row), default=str)
+    # raw JSON values are already encoded, so the object is built here rather than by dumps_bytes
+    items = b','.join(dumps_bytes(str(k)) + b':' + encode_value(v) for k, v in row.items())
+    return b'{' + items + b'}'
+
+
+def encode_value(value: Any) -> bytes:
+    if isinstance(value, RawJSON):
+        return value
+    else:
+        return dumps_bytes(value, default=str)
+
+
+def csv_value(value: Any) -> Any:
+    if isinstance(value, RawJSON):
+        # JSON values are written as JSON text, as postgres does when copying to CSV
+        return value.decode()
+    else:
+        return value
+
+
+async def encode_array(items: AsyncIterable[bytes]) -> AsyncIterator[bytes]:
+    yield b'['
+    sep = b''
+    async for item in items:
+        yield sep
+        yield item
+        sep = b','
+    yield b']'
+
+
+async def chunked(parts: AsyncIterable[bytes]) -> AsyncIterator[bytes]:
+    """
+    Combine parts into chunks of about stream_chunk_size bytes to avoid sending lots of tiny messages.
+    """
+    chunk = bytearray()
+    async for part in parts:
+        chunk += part
+        if len(chunk) >= stream_chunk_size:
+            yield bytes(chunk)
+            chunk.clear()
+    if chunk:
+        yield bytes(chunk)
@@ -1,7 +1,7 @@
 import os
 import secrets
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Pattern
+from typing import Any, Dict, List, Literal, Optional, Pattern
 from urllib.parse import urlparse
 
 from pydantic import BaseSettings as PydanticBaseSettings, validator
@@ -63,6 +63,36 @@ class BaseSettings(PydanticBaseSettings):
     pg_pool_max_size: int = 10
     pg_server_settings: Optional[Dict[str, str]] = {'jit': 'off'}
     pg_migrations: bool = False
+    # set by "foxglove web" after preparing the database in the parent process so each worker doesn't repeat it
+    pg_database_prepared: bool = False
+    # read-only replicas, used by get_db_readonly and by get_db for GET and HEAD requests if pg_route_reads is True
+    pg_replica_dsns: List[str] = []
+    # how a replica is chosen for each request: "round-robin" or "least-busy"
+    pg_replica_strategy: Literal['round-robin', 'least-busy'] = 'round-robin'
+    pg_route_reads: bool = True
+    # for this many seconds after a request writes, replicas are only used if they've replayed the write, 0 to disable
+    pg_lsn_max_age: int = 60
+    # how long requests wait for a connection from the pool before a 503 response is returned, None (the default)
+    # waits as long as it takes
+    pg_acquire_timeout: Optional[float] = None
+    # Retry-After header value in seconds for 503 responses when no connection could be acquired
+    pg_acquire_retry_after: int = 2
+    # cache the SQL rendered by the *_b query methods so repeat queries only collect their parameters
+    pg_render_cache: bool = True
+    # prepare statements added to foxglove.db.prepared.hot_statements on each new pool connection
+    pg_prepare_statements: bool = True
+    # codecs for json and jsonb columns: None to return strings (asyncpg's default), "decode" to parse values with
+    # orjson (or json if orjson isn't installed), "raw" to return RawJSON bytes which can be used in responses as is
+    pg_json_codec: Optional[Literal['decode', 'raw']] = None
+    # record each query's time, rows and fingerprint, the queries are included in request logs and sentry events
+    pg_instrument: bool = False
+    # with pg_instrument, at most this many queries are included in request events, the rest are only counted
+    pg_instrument_max_queries: int = 100
+    # with pg_instrument, queries which take longer than this many seconds are logged, None to disable
+    pg_slow_query_threshold: Optional[float] = 0.5
+    # in dev_mode and test_mode, warn (and fail tests using TestClient) when a request runs the same query more
+    # than this many times, usually a query in a loop which should be one query, None to disable
+    pg_repeated_query_limit: Optional[int] = 10
 
     redis_settings: Optional[RedisSettings] = redis_settings_default
     port: int = 8000
@@ -70,11 +100,40 @@ class BaseSettings(PydanticBaseSettings):
     # secrets.token_hex() is used to avoid a public default value ever being used in production
     secret_key: str = secrets.token_hex()
     cookie_name: str = 'foxglove'
+    # used by FoxgloveMiddleware, the same as the arguments to starlette's SessionMiddleware
+    session_max_age: Optional[int] = 14 * 24 * 3600
+    session_same_site: str = 'strict'
+    session_https_only: bool = False
+    # if set, FoxgloveMiddleware redirects requests for other hosts to this host
+    host_redirect: Optional[str] = None
+    # whether FoxgloveMiddleware checks requests come via Cloudflare
+    cloudflare_check: bool = False
 
     locale: Optional[str] = None
 
     http_client_timeout = 10
 
+    # errors and unexpected responses are reported by a background task, except in test mode
+    error_report_queue_size: int = 1000
+    error_report_batch_size: int = 50
+    # at most error_event_burst events are emitted per error_event_window seconds for each fingerprint
+    # (view, method, status or exception), None to disable, error_event_limit_redis shares counts between workers
+    error_event_burst: Optional[int] = 10
+    error_event_window: int = 60
+    error_event_limit_redis: bool = False
+    # record time spent on db queries, http requests and redis commands, the breakdown is included in request logs
+    request_timings: bool = True
+    # fraction of responses which get a Server-Timing header with the breakdown
+    server_timing_sample_rate: float = 0
+    # request and response bodies longer than this are truncated in logs and sentry events
+    log_request_body_limit: int = 16_384
+    log_response_body_limit: int = 16_384
+
+    # used by CloudflareCheckMiddleware, "{version}" is replaced with 4 or 6
+    cloudflare_ips_url = 'https://www.cloudflare.com/ips-v{version}'
+    # how often to refresh Cloudflare IP ranges in the background, None to only use the snapshot or redis cache
+    cloudflare_ips_refresh_interval: Optional[int] = 24 * 3600
+
     csrf_ignore_paths: List[Pattern] = []
     csrf_upload_paths: List[Pattern] = []
     csrf_cross_origin_paths: List[Pattern] = []
@@ -153,6 +212,7 @@ class BaseSettings(PydanticBaseSettings):
             'pg_dsn': {'env': 'DATABASE_URL'},
             'redis_settings': {'env': ['REDISCLOUD_URL', 'REDIS_URL']},
             'dev_mode': {'env': ['foxglove_dev_mode']},
+            'pg_database_prepared': {'env': ['foxglove_database_prepared']},
             'environment': {'env': ['ENV', 'ENVIRONMENT']},
             'release': {'env': ['COMMIT', 'RELEASE', 'HEROKU_SLUG_COMMIT']},
         }
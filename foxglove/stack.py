@@ -0,0 +1,227 @@
+import json
+import secrets
+from base64 import b64decode, b64encode
+from time import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import itsdangerous
+from itsdangerous.exc import BadSignature
+from starlette.datastructures import MutableHeaders
+from starlette.requests import Request, cookie_parser
+from starlette.responses import RedirectResponse, Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .db.instrument import RequestInstrumentation
+from .db.middleware import GetPgConn, routes_reads
+from .middleware import (
+    CapturedResponse,
+    CloudflareCheckMiddleware,
+    CsrfMiddleware,
+    ErrorMiddleware,
+    ResponseCapture,
+    forwarded_ip,
+    session_id_key,
+)
+
+__all__ = ('FoxgloveMiddleware',)
+
+# headers read by FoxgloveMiddleware, collected in a single pass over the scope's headers
+header_names = frozenset(
+    {b'host', b'cookie', b'origin', b'referer', b'content-type', b'x-forwarded-for', b'x-request-start'}
+)
+
+
+class FoxgloveMiddleware:
+    """
+    The standard foxglove middleware fused into one ASGI layer, it behaves like this stack (outermost first):
+
+    * ErrorMiddleware
+    * HostRedirectMiddleware, if settings.host_redirect is set
+    * CloudflareCheckMiddleware, if settings.cloudflare_check
+    * SessionMiddleware, configured with settings.secret_key, cookie_name and session_* settings
+    * CsrfMiddleware
+    * PgMiddleware
+
+    but reads the headers it needs once and wraps send once rather than adding a layer per behaviour. Each behaviour
+    can be turned off with the matching argument, None means use the default or the setting.
+
+    Like that stack, only the session is handled for websocket connections.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        *,
+        errors: bool = True,
+        host_redirect: Optional[str] = None,
+        cloudflare_check: Optional[bool] = None,
+        sessions: bool = True,
+        csrf: bool = True,
+        pg: bool = True,
+        should_warn: Callable[[CapturedResponse], bool] = None,
+        get_user: Callable[[Request], Awaitable[Dict[str, Any]]] = None,
+        should_check: Callable[[Request], bool] = None,
+    ):
+        from .main import glove
+
+        self.app = app
+        self.glove = glove
+        settings = glove.settings
+
+        self.errors = ErrorMiddleware(app, should_warn=should_warn, get_user=get_user) if errors else None
+
+        self.host = host_redirect or settings.host_redirect
+        if cloudflare_check if cloudflare_check is not None else settings.cloudflare_check:
+            self.cloudflare: Optional[CloudflareCheckMiddleware] = CloudflareCheckMiddleware(app)
+        else:
+            self.cloudflare = None
+
+        self.sessions = sessions
+        self.signer = itsdangerous.TimestampSigner(settings.secret_key)
+        self.session_cookie = settings.cookie_name
+        self.session_max_age = settings.session_max_age
+        self.security_flags = f'httponly; samesite={settings.session_same_site}'
+        if settings.session_https_only:
+            self.security_flags += '; secure'
+
+        assert sessions or not csrf, 'csrf checks require sessions'
+        self.csrf = CsrfMiddleware(app, should_check=should_check) if csrf else None
+        self.pg = pg
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            if scope['type'] == 'websocket' and self.sessions:
+                # as with SessionMiddleware the session is available to websockets but changes aren't saved
+                self.load_session(scope, read_headers(scope))
+            await self.app(scope, receive, send)
+            return
+
+        headers = read_headers(scope)
+        request = Request(scope, receive)
+        if not self.errors:
+            await self.handle(request, headers, send, None)
+            return
+
+        request.state.start_time = request_start(headers)
+        capture = ResponseCapture(self.errors)
+        try:
+            await self.handle(request, headers, send, capture)
+        except Exception as exc:
+            await capture.handle_error(request, exc, send)
+        else:
+            await capture.complete(request)
+
+    async def handle(
+        self, request: Request, headers: Dict[str, str], send: Send, capture: Optional[ResponseCapture]
+    ) -> None:
+        """
+        Everything apart from catching errors, capture is passed in so send only needs to be wrapped once.
+        """
+        scope, receive = request.scope, request.receive
+        settings = self.glove.settings
+        instruments = RequestInstrumentation(settings, scope.setdefault('state', {}))
+        session_was_empty = True
+        set_session_id = False
+        get_pg_conn: Optional[GetPgConn] = None
+
+        async def send_wrapper(message: Message) -> None:
+            if message['type'] == 'http.response.start':
+                if get_pg_conn:
+                    # before the session cookie is set since the LSN may be stored in the session
+                    await get_pg_conn.response_start(message)
+                instruments.response_start(message)
+                if set_session_id and message['status'] == 200:
+                    scope['session'][session_id_key] = secrets.token_urlsafe()
+                if 'session' in scope and self.sessions:
+                    self.set_session_cookie(message, scope['session'], session_was_empty)
+            if capture:
+                capture.record(message)
+            await send(message)
+            if get_pg_conn:
+                await get_pg_conn.response_sent(message)
+
+        try:
+            early_response = await self.check_origin(request, headers)
+            if early_response is None:
+                if self.sessions:
+                    session_was_empty = self.load_session(scope, headers)
+                if self.csrf:
+                    early_response, set_session_id = self.csrf.check_request(scope, receive, headers)
+
+            if early_response:
+                await early_response(scope, receive, send_wrapper)
+            elif self.pg:
+                get_pg_conn = GetPgConn(self.glove, route_reads=routes_reads(settings, scope), scope=scope)
+                request.state.get_pg_conn = get_pg_conn
+                await get_pg_conn.call_app(self.app, scope, receive, send_wrapper)
+            else:
+                await self.app(scope, receive, send_wrapper)
+        finally:
+            if get_pg_conn:
+                await get_pg_conn.close()
+            instruments.reset()
+
+    async def check_origin(self, request: Request, headers: Dict[str, str]) -> Optional[Response]:
+        """
+        Host redirect and Cloudflare checks, these happen before the session is loaded.
+        """
+        if self.host and headers.get('host', '').split(':', 1)[0] != self.host:
+            return RedirectResponse(request.url.replace(hostname=self.host), status_code=301)
+        if self.cloudflare:
+            ip = forwarded_ip(headers.get('x-forwarded-for'), request.scope)
+            if not (ip and await self.cloudflare.is_cloudflare_ip(ip)):
+                return await self.cloudflare.reject(request, ip)
+
+    def load_session(self, scope: Scope, headers: Dict[str, str]) -> bool:
+        """
+        Set scope['session'] from the session cookie, returns True if the session was empty.
+        """
+        scope['session'] = {}
+        cookie = headers.get('cookie')
+        if not cookie:
+            return True
+        data = cookie_parser(cookie).get(self.session_cookie)
+        if data is None:
+            return True
+        try:
+            data = self.signer.unsign(data.encode(), max_age=self.session_max_age)
+        except BadSignature:
+            return True
+        else:
+            scope['session'] = json.loads(b64decode(data))
+            return False
+
+    def set_session_cookie(self, message: Message, session: Dict[str, Any], session_was_empty: bool) -> None:
+        """
+        Add the Set-Cookie header for the session in the same form as starlette's SessionMiddleware.
+        """
+        if session:
+            data = self.signer.sign(b64encode(json.dumps(session).encode())).decode()
+            max_age = f'Max-Age={self.session_max_age}; ' if self.session_max_age else ''
+            cookie = f'{self.session_cookie}={data}; path=/; {max_age}{self.security_flags}'
+        elif not session_was_empty:
+            expires = 'expires=Thu, 01 Jan 1970 00:00:00 GMT; '
+            cookie = f'{self.session_cookie}=null; path=/; {expires}{self.security_flags}'
+        else:
+            return
+        MutableHeaders(scope=message).append('Set-Cookie', cookie)
+
+
+def read_headers(scope: Scope) -> Dict[str, str]:
+    headers: Dict[str, str] = {}
+    for key, value in scope['headers']:
+        if key in header_names:
+            name = key.decode('latin-1')
+            if name in headers:
+                if name == 'cookie':
+                    headers[name] += '; ' + value.decode('latin-1')
+            else:
+                headers[name] = value.decode('latin-1')
+    return headers
+
+
+def request_start(headers: Dict[str, str]) -> float:
+    try:
+        return float(headers.get('x-request-start', '.')) / 1000
+    except ValueError:
+        return time()
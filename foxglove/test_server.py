@@ -12,6 +12,8 @@ from aiohttp.web_middlewares import middleware
 from aiohttp.web_response import Response, json_response
 from async_timeout import timeout
 
+from .cloudflare import cloudflare_ips_snapshot
+
 __all__ = 'create_dummy_server', 'DummyServer', 'Offline'
 
 
@@ -37,6 +39,12 @@ async def recaptcha_dummy(request):
         return json_response(dict(success=False, hostname='testserver'))
 
 
+async def cloudflare_ips(request):
+    version = int(request.match_info['version'])
+    ips = request.app.get('cloudflare_ips', cloudflare_ips_snapshot)
+    return Response(text='\n'.join(ip for ip in ips if (':' in ip) == (version == 6)))
+
+
 @middleware
 async def log_middleware(request, handler):
     try:
@@ -59,6 +67,7 @@ def create_dummy_app() -> Application:
         [
             web.route('*', r'/status/{status:\d+}/', return_any_status, name='any-status'),
             web.post('/recaptcha_url/', recaptcha_dummy, name='recaptcha-dummy'),
+            web.get(r'/ips-v{version:[46]}', cloudflare_ips, name='cloudflare-ips'),
         ]
     )
     app['log'] = []
@@ -37,6 +37,8 @@ import requests
 from starlette.types import Message, Receive, Scope, Send
 from starlette.websockets import WebSocketDisconnect
 
+from .db.repeated import repeated_queries_key
+
 # Annotations for `Session.request()`
 Cookies = Union[MutableMapping[str, str], RequestsCookieJar]
 Params = Union[bytes, MutableMapping[str, str]]
@@ -244,6 +246,10 @@ class _ASGIAdapter(HTTPAdapter):
             if self.raise_server_exceptions:
                 raise exc from None
 
+        # set by GetPgConn.check_repeated if the request ran the same query too many times
+        if repeated_queries := scope.get('state', {}).get(repeated_queries_key):
+            fail(f'{request.method} {request.url}, {repeated_queries}')
+
         if self.raise_server_exceptions:
             assert response_started, 'TestClient did not receive any response.'
         elif not response_started:
@@ -539,6 +545,10 @@ def check_response(response: Response, expected_status: Optional[int]) -> None:
         f'body:\n{body}'
     )
 
+    fail(msg)
+
+
+def fail(msg: str) -> None:
     if pytest:  # pragma: no branch
         pytest.fail(msg)
     else:  # pragma: no cover
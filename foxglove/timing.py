@@ -0,0 +1,147 @@
+import random
+from contextvars import ContextVar, Token
+from time import perf_counter
+from typing import Any, Awaitable, Callable, Dict, List, Optional, TypeVar
+
+from starlette.datastructures import MutableHeaders
+from starlette.types import Message
+
+__all__ = 'RequestTimings', 'current_timings', 'start_timings', 'reset_timings', 'timed', 'time_query'
+
+T = TypeVar('T')
+
+_timings: ContextVar[Optional['RequestTimings']] = ContextVar('foxglove_timings', default=None)
+
+
+class RequestTimings:
+    """
+    Time spent in each phase of a request (e.g. "db", "db-acquire", "http", "redis"), phases can be recorded many
+    times, the total time and number of times is kept for each.
+    """
+
+    __slots__ = 'start', 'phases', 'sampled'
+
+    def __init__(self, *, sampled: bool = False):
+        self.start = perf_counter()
+        # phase -> [total duration, count]
+        self.phases: Dict[str, List[Any]] = {}
+        # whether the Server-Timing header should be added to the response
+        self.sampled = sampled
+
+    def add(self, phase: str, duration: float) -> None:
+        try:
+            p = self.phases[phase]
+        except KeyError:
+            self.phases[phase] = [duration, 1]
+        else:
+            p[0] += duration
+            p[1] += 1
+
+    def server_timing(self) -> str:
+        """
+        Value for the Server-Timing header, durations are in milliseconds.
+        """
+        total = (perf_counter() - self.start) * 1000
+        items = [f'{phase};dur={d * 1000:0.2f};desc="{count}"' for phase, (d, count) in self.phases.items()]
+        items.append(f'total;dur={total:0.2f}')
+        return ', '.join(items)
+
+    def as_dict(self) -> Dict[str, str]:
+        return {phase: f'{duration * 1000:0.2f}ms ({count})' for phase, (duration, count) in self.phases.items()}
+
+
+def start_timings(sample_rate: float) -> 'Token[Optional[RequestTimings]]':
+    """
+    Start collecting timings for the current context, a fraction sample_rate of requests are marked as sampled
+    so the Server-Timing header is added.
+    """
+    sampled = sample_rate >= 1 or (sample_rate > 0 and random.random() < sample_rate)
+    return _timings.set(RequestTimings(sampled=sampled))
+
+
+def add_server_timing(message: Message, timings: RequestTimings) -> None:
+    """
+    Add the Server-Timing header to an "http.response.start" message.
+    """
+    MutableHeaders(scope=message).append('Server-Timing', timings.server_timing())
+
+
+def reset_timings(token: 'Token[Optional[RequestTimings]]') -> None:
+    _timings.reset(token)
+
+
+def current_timings() -> Optional[RequestTimings]:
+    return _timings.get()
+
+
+class timed:
+    """
+    Context manager to record the time taken by a block, does nothing if timings aren't being collected.
+    """
+
+    __slots__ = 'phase', 'timings', 'start'
+
+    def __init__(self, phase: str):
+        self.phase = phase
+        self.timings = _timings.get()
+
+    def __enter__(self) -> None:
+        if self.timings is not None:
+            self.start = perf_counter()
+
+    def __exit__(self, *args: Any) -> None:
+        if self.timings is not None:
+            self.timings.add(self.phase, perf_counter() - self.start)
+
+
+async def timed_await(phase: str, timings: RequestTimings, awaitable: Awaitable[T]) -> T:
+    start = perf_counter()
+    try:
+        return await awaitable
+    finally:
+        timings.add(phase, perf_counter() - start)
+
+
+def timed_redis_execute(execute: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+    """
+    Wrap aioredis's Redis.execute to record the time taken by each command, the future returned by execute is
+    returned unchanged if timings aren't being collected.
+    """
+
+    def wrapper(command: Any, *args: Any, **kwargs: Any) -> Awaitable[T]:
+        fut = execute(command, *args, **kwargs)
+        timings = _timings.get()
+        if timings is None:
+            return fut
+        else:
+            return timed_await('redis', timings, fut)
+
+    return wrapper
+
+
+async def http_request_hook(request) -> None:
+    if _timings.get() is not None:
+        request.extensions['foxglove_start'] = perf_counter()
+
+
+async def http_response_hook(response) -> None:
+    timings = _timings.get()
+    start = response.request.extensions.get('foxglove_start')
+    if timings is not None and start is not None:
+        # this is the time until the response headers are received
+        timings.add('http', perf_counter() - start)
+
+
+def time_query(conn: Any, method: str, sql: Optional[str], args: Any) -> Optional[Callable[[Any, Any], None]]:
+    """
+    Query hook (see foxglove.db.hooks) which records the time taken by queries as the "db" phase.
+    """
+    timings = _timings.get()
+    if timings is None:
+        return None
+    start = perf_counter()
+
+    def after(result: Any, error: Any) -> None:
+        timings.add('db', perf_counter() - start)
+
+    return after
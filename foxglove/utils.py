@@ -1,8 +1,8 @@
-from typing import Dict, List, Optional, TypeVar
+from typing import Any, Callable, Dict, Iterator, List, MutableMapping, Optional, TypeVar
 
 from starlette.requests import Request
 
-__all__ = 'get_ip', 'list_not_none', 'dict_not_none'
+__all__ = 'get_ip', 'list_not_none', 'dict_not_none', 'LazyDict'
 
 IP_HEADER = 'X-Forwarded-For'
 
@@ -33,3 +33,49 @@ def dict_not_none(*args: Dict[str, T], **kwargs: T) -> Dict[str, T]:
     if kwargs:
         d.update(kwargs)
     return {key: value for key, value in d.items() if value is not None}
+
+
+class LazyDict(MutableMapping[str, Any]):
+    """
+    Mapping where values can be set from functions which are only called when the value is first read, used to
+    avoid building parts of log and sentry events which are never read.
+    """
+
+    __slots__ = '_data', '_factories'
+
+    def __init__(self, **values: Any):
+        self._data: Dict[str, Any] = values
+        self._factories: Dict[str, Callable[[], Any]] = {}
+
+    def set_lazy(self, key: str, factory: Callable[[], Any]) -> None:
+        self._data.pop(key, None)
+        self._factories[key] = factory
+
+    def __getitem__(self, key: str) -> Any:
+        try:
+            return self._data[key]
+        except KeyError:
+            factory = self._factories.pop(key)
+            value = self._data[key] = factory()
+            return value
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self._factories.pop(key, None)
+        self._data[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        if self._factories.pop(key, None) is None:
+            del self._data[key]
+
+    def __iter__(self) -> Iterator[str]:
+        yield from list(self._data)
+        yield from list(self._factories)
+
+    def __len__(self) -> int:
+        return len(self._data) + len(self._factories)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._data or key in self._factories
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
@@ -49,7 +49,8 @@ setup(
     install_requires=[
         'arq>=0.19.1',
         'aioredis>=1.3.1,<2',
-        'asyncpg>=0.23.0',
+        # foxglove.db.prepared uses asyncpg's private Connection._get_statement, check it before raising this limit
+        'asyncpg>=0.23.0,<0.33',
         'fastapi>=0.72',
         'itsdangerous>=1.1.0',
         'buildpg>=0.3.0',
@@ -1,5 +1,6 @@
 import asyncio
 import os
+from typing import Any, AsyncIterable, Dict, List, Optional, Sequence, Tuple
 
 import pytest
 from buildpg import asyncpg
@@ -188,3 +189,171 @@ def _fix_create_request(settings: Settings):
             return Request(scope, None, None)
 
     return CreateRequest(app)
+
+
+class FakeTransaction:
+    def __init__(self, conn: 'FakeConn'):
+        self.conn = conn
+
+    async def start(self):
+        self.conn.transaction_depth += 1
+        self.conn.calls.append(('begin',))
+
+    async def commit(self):
+        self.conn.transaction_depth -= 1
+        self.conn.calls.append(('commit',))
+
+    async def rollback(self):
+        self.conn.transaction_depth -= 1
+        self.conn.calls.append(('rollback',))
+
+    async def __aenter__(self):
+        await self.start()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if exc_type:
+            await self.rollback()
+        else:
+            await self.commit()
+
+
+class FakeCursor:
+    def __init__(self, rows: Sequence[Any]):
+        self.rows = iter(rows)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.rows)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class FakeConn:
+    """
+    Stand in for a connection in tests which don't need postgres: queries, copies and transactions are recorded in
+    calls, results come from value, rows and status, or result() in subclasses.
+    """
+
+    def __init__(self, pool: Optional['FakePool'] = None, *, value: Any = None, rows: Sequence[Any] = (), status='OK'):
+        self.pool = pool
+        self.value = value
+        self.rows = rows
+        self.status = status
+        self.calls: List[Tuple[Any, ...]] = []
+        self.codecs: Dict[str, Tuple[Any, Any]] = {}
+        self.transaction_depth = 0
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.pool and self.pool.name})'
+
+    @property
+    def in_transaction(self) -> bool:
+        return self.transaction_depth > 0
+
+    def result(self, method: str, sql: str, args: Tuple[Any, ...]) -> Any:
+        if method == 'execute':
+            return self.status
+        elif method == 'fetch':
+            return list(self.rows)
+        elif method == 'fetchrow':
+            return self.rows[0] if self.rows else None
+        elif method == 'fetchval':
+            return self.value
+
+    async def query(self, method: str, sql: str, args: Tuple[Any, ...]) -> Any:
+        self.calls.append((method, sql, args))
+        return self.result(method, sql, args)
+
+    async def execute(self, sql: str, *args, timeout=None):
+        return await self.query('execute', sql, args)
+
+    async def executemany(self, sql: str, args, *, timeout=None):
+        return await self.query('executemany', sql, tuple(args))
+
+    async def fetch(self, sql: str, *args, timeout=None):
+        return await self.query('fetch', sql, args)
+
+    async def fetchval(self, sql: str, *args, column=0, timeout=None):
+        return await self.query('fetchval', sql, args)
+
+    async def fetchrow(self, sql: str, *args, timeout=None):
+        return await self.query('fetchrow', sql, args)
+
+    async def prepare(self, sql: str):
+        return await self.query('prepare', sql, ())
+
+    def cursor(self, sql: str, *args, prefetch=None, timeout=None):
+        assert self.in_transaction, 'cursors can only be used in a transaction'
+        self.calls.append(('cursor', sql, args, prefetch))
+        return FakeCursor(self.rows)
+
+    def transaction(self) -> FakeTransaction:
+        return FakeTransaction(self)
+
+    async def copy_records_to_table(self, table: str, *, records, columns, schema_name=None):
+        self.calls.append(('copy', table, records, tuple(columns)))
+
+    async def copy_to_table(self, table: str, *, source: AsyncIterable[bytes], **kwargs):
+        data = b''.join([d async for d in source])
+        self.calls.append(('copy_to', table, data, kwargs))
+        return f'COPY {len(data.splitlines())}'
+
+    async def set_type_codec(self, name: str, *, encoder, decoder, schema, format):
+        assert (schema, format) == ('pg_catalog', 'binary')
+        self.codecs[name] = encoder, decoder
+
+
+class FakeAcquire:
+    """
+    Like asyncpg's pool.acquire() this can be awaited or used as an async context manager.
+    """
+
+    def __init__(self, pool: 'FakePool', timeout: Optional[float]):
+        self.pool = pool
+        self.timeout = timeout
+        self.conn = None
+
+    def __await__(self):
+        return self.pool.get_conn(self.timeout).__await__()
+
+    async def __aenter__(self):
+        self.conn = await self.pool.get_conn(self.timeout)
+        return self.conn
+
+    async def __aexit__(self, *args):
+        await self.pool.release(self.conn)
+
+
+class FakePool:
+    """
+    Pool of up to size FakeConns (or conn_class in subclasses), released connections are recorded by pool name.
+    """
+
+    conn_class = FakeConn
+
+    def __init__(self, name: str = 'primary', size: int = 1):
+        self.name = name
+        self.semaphore = asyncio.Semaphore(size)
+        self.conns: List[FakeConn] = []
+        self.released: List[str] = []
+        self.closed = False
+
+    def acquire(self, *, timeout: Optional[float] = None) -> FakeAcquire:
+        return FakeAcquire(self, timeout)
+
+    async def get_conn(self, timeout: Optional[float]) -> FakeConn:
+        await asyncio.wait_for(self.semaphore.acquire(), timeout)
+        conn = self.conn_class(self)
+        self.conns.append(conn)
+        return conn
+
+    async def release(self, conn: FakeConn):
+        assert conn.pool is self
+        self.released.append(self.name)
+        self.semaphore.release()
+
+    async def close(self):
+        self.closed = True
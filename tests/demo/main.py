@@ -34,13 +34,7 @@ add_middleware(
     session_cookie=glove.settings.cookie_name,
     same_site='strict',
 )
-
-
-def should_check_csrf(request):
-    return request.url.path != '/no-csrf/'
-
-
-add_middleware(CsrfMiddleware, should_check=should_check_csrf)
+add_middleware(CsrfMiddleware)
 add_middleware(PgMiddleware)
 
 
@@ -3,7 +3,7 @@ from typing import Dict
 from buildpg.asyncpg import BuildPgConnection
 
 from foxglove import glove
-from foxglove.db.patches import patch, run_sql_section
+from foxglove.db.patches import Chunked, patch, run_sql_section
 
 
 @patch
@@ -33,3 +33,11 @@ async def run_full_name(conn: BuildPgConnection, args: Dict[str, str], **kwargs)
     example of migrations patch
     """
     await run_sql_section('full_name', glove.settings.sql, conn)
+
+
+@patch(chunked=Chunked('select min(id), max(id) from organisations', batch_size=10, workers=2))
+async def upper_org_names(conn: BuildPgConnection, start: int, end: int, **kwargs):
+    """
+    example of a chunked patch
+    """
+    await conn.execute('update organisations set name=upper(name) where id >= $1 and id < $2', start, end)
@@ -1,5 +1,6 @@
+import re
 from pathlib import Path
-from typing import List, Optional
+from typing import List, Optional, Pattern
 
 from arq.connections import RedisSettings
 
@@ -16,3 +17,4 @@ class Settings(BaseSettings):
     redis_settings: Optional[RedisSettings] = 'redis://localhost:6379/6'
 
     worker_func = 'demo.main:worker'
+    csrf_ignore_paths: List[Pattern] = [re.compile('/no-csrf/')]
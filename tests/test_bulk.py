@@ -0,0 +1,77 @@
+import logging
+
+import pytest
+
+from foxglove.db.bulk import copy_records, copy_stream, iter_chunks, upsert_records
+from tests.conftest import FakeConn
+
+pytestmark = pytest.mark.asyncio
+
+
+async def agen(items):
+    for item in items:
+        yield item
+
+
+@pytest.mark.parametrize('wrap', [list, agen])
+async def test_iter_chunks(wrap):
+    assert [c async for c in iter_chunks(wrap(range(5)), 2)] == [[0, 1], [2, 3], [4]]
+    assert [c async for c in iter_chunks(wrap([]), 2)] == []
+
+
+async def test_copy_records(caplog):
+    caplog.set_level(logging.INFO, 'foxglove.db.patch')
+    conn = FakeConn()
+    records = agen([(i, f'org {i}') for i in range(3)])
+    assert await copy_records(conn, 'organisations', records, columns=['id', 'name'], chunk_size=2) == 3
+    assert conn.calls == [
+        ('copy', 'organisations', [(0, 'org 0'), (1, 'org 1')], ('id', 'name')),
+        ('copy', 'organisations', [(2, 'org 2')], ('id', 'name')),
+    ]
+    assert [m.split(',')[0] for m in caplog.messages] == [
+        '2 copied to organisations',
+        '3 copied to organisations',
+        'finished',
+    ]
+
+
+async def test_upsert_records():
+    conn = FakeConn(status='INSERT 0 2')
+    records = [(1, 'a@example.com', 'anne'), (1, 'b@example.com', 'ben')]
+    n = await upsert_records(
+        conn, 'users', records, columns=['org', 'email', 'first_name'], conflict_columns=['org', 'email']
+    )
+    assert n == 2
+    assert conn.calls == [
+        ('begin',),
+        ('execute', 'create temporary table foxglove_upsert (like "users" including defaults)', ()),
+        ('copy', 'foxglove_upsert', records, ('org', 'email', 'first_name')),
+        (
+            'execute',
+            'insert into "users" ("org", "email", "first_name") select "org", "email", "first_name" '
+            'from foxglove_upsert on conflict ("org", "email") do update set "first_name"=excluded."first_name"',
+            (),
+        ),
+        ('execute', 'drop table foxglove_upsert', ()),
+        ('commit',),
+    ]
+
+    conn = FakeConn(status='INSERT 0 1')
+    await upsert_records(conn, 'organisations', [(1,)], columns=['id'], conflict_columns=['id'], schema='public')
+    assert conn.calls[3][1] == (
+        'insert into "public"."organisations" ("id") select "id" from foxglove_upsert on conflict ("id") do nothing'
+    )
+
+
+async def test_copy_stream():
+    conn = FakeConn()
+    status = await copy_stream(conn, 'organisations', agen([b'name\n', b'a\nb\n']), columns=['name'], header=True)
+    assert status == 'COPY 3'
+    assert conn.calls == [
+        (
+            'copy_to',
+            'organisations',
+            b'name\na\nb\n',
+            {'columns': ['name'], 'schema_name': None, 'format': 'csv', 'header': True},
+        )
+    ]
@@ -1,3 +1,5 @@
+import os
+
 from typer.testing import CliRunner
 
 from foxglove import glove
@@ -36,12 +38,20 @@ def test_web_no_settings(mocker):
     assert mock_uvicorn_run.call_count == 0
 
 
-def test_web(mocker):
+def test_web(mocker, monkeypatch):
+    monkeypatch.delenv('foxglove_database_prepared', raising=False)
+    # settings are loaded from demo.settings by the cli, not the session's test_mode settings
+    monkeypatch.setattr(glove, '_settings', None)
+    mock_prepare_database = mocker.patch('foxglove.cli.prepare_database')
     mock_uvicorn_run = mocker.patch('foxglove.cli.uvicorn_run')
     runner = CliRunner()
     result = runner.invoke(cli, ['-s', 'demo.settings', 'web'])
     assert result.exit_code == 0, result.output
+    assert 'preparing database...' in result.output
     assert 'running web server at 8000...' in result.output
+    mock_prepare_database.assert_called_once_with(glove.settings, False, run_migrations=True)
+    assert os.environ['foxglove_database_prepared'] == 'TRUE'
+    assert glove.settings.pg_database_prepared is True
     mock_uvicorn_run.assert_called_once()
     assert mock_uvicorn_run.call_args.kwargs['host'] == '0.0.0.0'
     assert mock_uvicorn_run.call_args.kwargs['port'] == 8000
@@ -64,7 +74,10 @@ def test_dev(mocker):
     assert mock_uvicorn_run.call_args.kwargs.get('access_log') is None
 
 
-def test_auto_web(mocker):
+def test_auto_web(mocker, monkeypatch):
+    monkeypatch.delenv('foxglove_database_prepared', raising=False)
+    monkeypatch.setattr(glove, '_settings', None)
+    mock_prepare_database = mocker.patch('foxglove.cli.prepare_database')
     mock_uvicorn_run = mocker.patch('foxglove.cli.uvicorn_run')
     runner = CliRunner()
     result = runner.invoke(cli, ['-s', 'demo.settings', 'auto'], env={'FOXGLOVE_COMMAND': 'web'})
@@ -86,6 +99,8 @@ def test_auto_web(mocker):
     assert 'running web server at 5000...' in result.output
     assert mock_uvicorn_run.call_count == 3
     assert mock_uvicorn_run.call_args.kwargs['port'] == 5000
+    # the database is only prepared once per process
+    assert mock_prepare_database.call_count == 1
 
 
 def test_worker(loop):
@@ -1,3 +1,7 @@
+from starlette.responses import StreamingResponse
+
+from foxglove import glove
+from foxglove.middleware import ErrorMiddleware
 from foxglove.testing import TestClient as Client
 
 
@@ -42,6 +46,7 @@ def test_errors_raise_unexpected(client: Client, caplog):
     assert r.request['url'] == 'http://testserver/error/'
     assert r.extra['route_endpoint'] == 'error'
     assert r.extra['response_body'] == {'message': 'raised HttpBadRequest'}
+    assert r.transaction == '/error/'
 
 
 def test_errors_exception(client: Client, caplog):
@@ -97,3 +102,72 @@ def test_null_json_error(client: Client):
     assert client.post_json('/create-user/', {'first_name': 'Samuel\x00', 'last_name': 'Colvin'}, status=400) == {
         'detail': 'There was an error parsing the body'
     }
+
+
+async def streaming_400_app(scope, receive, send):
+    async def body():
+        yield b'{"error": '
+        yield b'"streamed"}'
+
+    await StreamingResponse(body(), status_code=400, media_type='application/json')(scope, receive, send)
+
+
+def test_error_middleware_streaming(settings, caplog):
+    client = Client(ErrorMiddleware(streaming_400_app))
+    r = client.get('/foo/')
+    assert r.status_code == 400, r.text
+    assert r.json() == {'error': 'streamed'}
+
+    assert len(caplog.records) == 1, caplog.text
+    assert '"GET /foo/", unexpected response: 400' in caplog.text
+    assert caplog.records[0].extra['response_body'] == {'error': 'streamed'}
+
+
+async def error_after_start_app(scope, receive, send):
+    await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+    raise RuntimeError('error after start')
+
+
+def test_error_middleware_error_after_start(settings, caplog):
+    client = Client(ErrorMiddleware(error_after_start_app), raise_server_exceptions=False)
+    r = client.get('/')
+    assert r.status_code == 200
+    assert len(caplog.records) == 1, caplog.text
+    assert '"GET /", RuntimeError(\'error after start\')' in caplog.text
+
+
+async def large_400_app(scope, receive, send):
+    await send({'type': 'http.response.start', 'status': 400, 'headers': []})
+    for _ in range(10):
+        await send({'type': 'http.response.body', 'body': b'x' * 100, 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+def test_error_middleware_truncate_body(settings, caplog, monkeypatch):
+    # ErrorMiddleware reads glove.settings on each request
+    monkeypatch.setattr(glove.settings, 'log_response_body_limit', 150)
+    client = Client(ErrorMiddleware(large_400_app))
+    r = client.get('/foo/123/')
+    assert r.status_code == 400, r.text
+    assert len(r.content) == 1000
+
+    assert len(caplog.records) == 1, caplog.text
+    record = caplog.records[0]
+    assert record.extra['response_body'] == 'x' * 150 + '... (truncated, 1,000 bytes)'
+    # no route matched
+    assert record.transaction == '<unmatched>'
+
+
+def test_error_middleware_should_warn(settings, caplog):
+    responses = []
+
+    def should_warn(response):
+        # should_warn is called as the response starts, before the body has been sent
+        responses.append((response.status_code, response.headers['content-type'], response.body))
+        return True
+
+    client = Client(ErrorMiddleware(streaming_400_app, should_warn=should_warn))
+    r = client.get('/foo/')
+    assert r.status_code == 400, r.text
+    assert responses == [(400, 'application/json', b'')]
+    assert caplog.records[0].extra['response_body'] == {'error': 'streamed'}
@@ -0,0 +1,95 @@
+import asyncio
+
+import pytest
+
+from foxglove import glove
+from foxglove.cloudflare import CloudflareIPStore, get_cloudflare_ips
+
+pytestmark = pytest.mark.asyncio
+
+
+@pytest.fixture(name='dummy_cloudflare')
+def fix_dummy_cloudflare(settings, dummy_server, monkeypatch):
+    cf_settings = settings.copy(update={'cloudflare_ips_url': dummy_server.server_name + '/ips-v{version}'})
+    monkeypatch.setattr(glove, '_settings', cf_settings)
+    return dummy_server
+
+
+async def test_snapshot():
+    store = CloudflareIPStore()
+    assert store.loaded_from == 'snapshot'
+    assert len(store.index) == 22
+    assert store.index.lookup('162.158.186.183') is not None
+    assert store.index.lookup('2606:4700:3033::ac43:b36c') is not None
+    assert store.index.lookup('1.1.1.1') is None
+
+
+async def test_refresh_from_dummy_server(dummy_cloudflare):
+    dummy_cloudflare.app['cloudflare_ips'] = ['10.0.0.0/8', '2400:cb00::/32']
+    store = CloudflareIPStore()
+    assert await store.refresh() is True
+    assert store.loaded_from == 'source'
+    assert [str(r.range) for r in store.index.ranges] == ['10.0.0.0/8', '2400:cb00::/32']
+    assert store.index.lookup('10.1.2.3') is not None
+    assert store.index.lookup('162.158.186.183') is None
+    assert sorted(dummy_cloudflare.log) == ['GET /ips-v4 > 200', 'GET /ips-v6 > 200']
+
+
+async def test_get_cloudflare_ips(dummy_cloudflare):
+    ips = await get_cloudflare_ips()
+    assert len(ips) == 22
+    assert repr(ips[0]) == 'IPRangeCounter(173.245.48.0/20, 0)'
+
+
+async def test_refresh_error_keeps_ranges(caplog):
+    async def broken_source():
+        raise RuntimeError('cloudflare is down')
+
+    store = CloudflareIPStore(broken_source)
+    assert await store.refresh() is False
+    assert store.loaded_from == 'snapshot'
+    assert len(store.index) == 22
+    assert "error refreshing Cloudflare IP ranges, keeping 22 ranges: RuntimeError('cloudflare is down')" in caplog.text
+
+
+async def test_background_refresh():
+    refreshed = asyncio.Event()
+
+    async def source():
+        refreshed.set()
+        return ['10.0.0.0/8']
+
+    store = CloudflareIPStore(source, refresh_interval=3600)
+    await store.startup()
+    # startup doesn't wait for the refresh
+    assert store.loaded_from == 'snapshot'
+
+    await asyncio.wait_for(refreshed.wait(), timeout=1)
+    await asyncio.sleep(0)
+    assert store.loaded_from == 'source'
+    assert store.index.lookup('10.0.0.1') is not None
+
+    await store.shutdown()
+    assert store._task is None
+
+
+async def test_redis_cache(glove):
+    sources = []
+
+    async def source():
+        sources.append(1)
+        return ['10.0.0.0/8']
+
+    store = CloudflareIPStore(source, refresh_interval=60)
+    await store.startup(glove.redis)
+    assert await store.refresh() is True
+    assert await glove.redis.get(CloudflareIPStore.redis_key) == b'10.0.0.0/8'
+    await store.shutdown()
+
+    # a second worker loads ranges from redis on startup rather than downloading them
+    store2 = CloudflareIPStore(source, refresh_interval=60)
+    await store2.startup(glove.redis)
+    assert store2.loaded_from == 'redis'
+    assert [str(r.range) for r in store2.index.ranges] == ['10.0.0.0/8']
+    await store2.shutdown()
+    assert sources == [1]
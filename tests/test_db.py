@@ -4,9 +4,17 @@ import pytest
 from buildpg.asyncpg import BuildPgConnection
 from pytest_toolbox.comparison import AnyInt, CloseToNow
 
-from foxglove.db import prepare_database
+from foxglove.db import create_pg_replica_pools, prepare_database, prepared
+from foxglove.db.bulk import copy_records, upsert_records
+from foxglove.db.cursor import iter_rows
+from foxglove.db.instrument import current_request_queries, reset_request_queries, start_request_queries
+from foxglove.db.json_codecs import RawJSON
+from foxglove.db.main import connect_pg_pool
+from foxglove.db.prepared import StatementRegistry
+from foxglove.db.repeated import RepeatedQueries, reset_repeated_queries, start_repeated_queries
 from foxglove.db.utils import AsyncPgContext
 from foxglove.redis import async_flush_redis, flush_redis
+from foxglove.responses import CSVResponse, JSONArrayResponse, NDJSONResponse, RawJSONResponse, StreamingRawJSONResponse
 from foxglove.settings import BaseSettings
 from tests.conftest import ConnContext
 
@@ -114,3 +122,149 @@ async def test_async_flush_redis(settings, glove):
     assert len(await glove.redis.keys('*')) == 2
     await async_flush_redis(settings)
     assert len(await glove.redis.keys('*')) == 0
+
+
+async def test_replica_pools(settings: BaseSettings, alt_settings: BaseSettings):
+    await prepare_database(alt_settings, False)
+    replica_settings = settings.copy(update=dict(pg_replica_dsns=[alt_settings.pg_dsn, settings.pg_dsn]))
+    replicas = await create_pg_replica_pools(replica_settings)
+    try:
+        names = []
+        for _ in range(3):
+            conn = await replicas.acquire()
+            names.append(await conn.fetchval('select current_database()'))
+            await replicas.release(conn)
+        assert names == [alt_settings.pg_name, settings.pg_name, alt_settings.pg_name]
+    finally:
+        await replicas.close()
+
+    assert await create_pg_replica_pools(settings) is None
+
+
+async def test_instrumented_pool(settings: BaseSettings, clean_db):
+    instrument_settings = settings.copy(update=dict(pg_instrument=True, pg_slow_query_threshold=None))
+    pool = await connect_pg_pool(instrument_settings, settings.pg_dsn)
+    token = start_request_queries()
+    try:
+        async with pool.acquire() as conn:
+            assert await conn.fetchval_b('select :v::int', v=42) == 42
+            assert len(await conn.fetch('select generate_series(1, 3)')) == 3
+            assert await conn.execute('select 1') == 'SELECT 1'
+        queries = current_request_queries().queries
+    finally:
+        reset_request_queries(token)
+        await pool.close()
+
+    assert [(q['sql'], q['rows']) for q in queries] == [
+        ('select $1::int', 1),
+        ('select generate_series(?, ?)', 3),
+        ('select ?', 1),
+    ]
+
+
+async def test_hot_statements(settings: BaseSettings, clean_db, monkeypatch, caplog):
+    registry = StatementRegistry()
+    monkeypatch.setattr(prepared, 'hot_statements', registry)
+    sql = registry.add_b('select :a::int + :b::int', a=1, b=2)
+    assert sql == 'select $1::int + $2::int'
+    registry.add('select * from missing_table')
+
+    pool = await connect_pg_pool(settings.copy(update=dict(pg_pool_min_size=2)), settings.pg_dsn)
+    try:
+        async with pool.acquire() as conn:
+            count_sql = 'select count(*) from pg_prepared_statements where statement=$1'
+            assert await conn.fetchval(count_sql, sql) == 1
+            assert await conn.fetchval_b('select :a::int + :b::int', a=1, b=2) == 3
+            # the query used the statement from the cache rather than preparing another
+            assert await conn.fetchval(count_sql, sql) == 1
+    finally:
+        await pool.close()
+    assert caplog.text.count('error preparing statement') == 2
+
+
+@pytest.mark.parametrize('mode,expected', [('decode', {'a': [1, 2]}), ('raw', RawJSON(b'{"a": [1, 2]}'))])
+async def test_json_codecs(settings: BaseSettings, clean_db, mode, expected):
+    codec_settings = settings.copy(update=dict(pg_json_codec=mode, pg_pool_min_size=1))
+    pool = await connect_pg_pool(codec_settings, settings.pg_dsn)
+    try:
+        async with pool.acquire() as conn:
+            assert await conn.fetchval('select $1::jsonb', {'a': [1, 2]}) == expected
+            assert await conn.fetchval('select \'{"a": [1, 2]}\'::json') == expected
+    finally:
+        await pool.close()
+
+
+async def test_raw_json_responses(settings: BaseSettings, clean_db):
+    pool = await connect_pg_pool(settings.copy(update=dict(pg_json_codec='raw', pg_pool_min_size=1)), settings.pg_dsn)
+    sql = 'select v as id, v * 2 as double from generate_series(1, $1) v'
+    try:
+        async with pool.acquire() as conn:
+            r = await RawJSONResponse.from_rows(conn, sql, 2)
+            assert r.body == b'[{"id":1,"double":2}, \n {"id":2,"double":4}]'
+            r = await RawJSONResponse.from_rows(conn, sql, 0)
+            assert r.body == b'[]'
+
+            r = StreamingRawJSONResponse(conn, sql, 3, prefetch=2)
+            body = b''.join([chunk async for chunk in r.body_iterator])
+            assert body == b'[{"id":1,"double":2},{"id":2,"double":4},{"id":3,"double":6}]'
+    finally:
+        await pool.close()
+
+
+async def test_raw_json_rows_responses(settings: BaseSettings, clean_db):
+    pool = await connect_pg_pool(settings.copy(update=dict(pg_json_codec='raw', pg_pool_min_size=1)), settings.pg_dsn)
+    sql = """select v as id, jsonb_build_object('v', v) as data from generate_series(1, $1) v"""
+    try:
+        async with pool.acquire() as conn:
+            r = JSONArrayResponse(iter_rows(conn, sql, 2))
+            body = b''.join([chunk async for chunk in r.body_iterator])
+            assert body == b'[{"id":1,"data":{"v": 1}},{"id":2,"data":{"v": 2}}]'
+
+            r = NDJSONResponse(iter_rows(conn, sql, 2))
+            body = b''.join([chunk async for chunk in r.body_iterator])
+            assert body == b'{"id":1,"data":{"v": 1}}\n{"id":2,"data":{"v": 2}}\n'
+
+            r = CSVResponse(iter_rows(conn, sql, 2))
+            body = b''.join([chunk async for chunk in r.body_iterator])
+            assert body == b'id,data\r\n1,"{""v"": 1}"\r\n2,"{""v"": 2}"\r\n'
+    finally:
+        await pool.close()
+
+
+async def test_repeated_queries_pool(settings: BaseSettings, clean_db):
+    pool = await connect_pg_pool(settings.copy(update=dict(pg_pool_min_size=1)), settings.pg_dsn)
+    repeated = RepeatedQueries(2)
+    token = start_repeated_queries(repeated)
+    try:
+        async with pool.acquire() as conn:
+            for i in range(3):
+                assert await conn.fetchval_b('select :v::int', v=i) == i
+    finally:
+        reset_repeated_queries(token)
+        await pool.close()
+    assert repeated.counts == {'select $1::int': 3}
+    assert repeated.report().startswith('repeated queries in request')
+
+
+async def test_iter_rows(db_conn):
+    conn = await db_conn.acquire()
+    rows = [dict(r) async for r in iter_rows(conn, 'select v as id from generate_series(1, $1) v', 5, prefetch=2)]
+    assert rows == [{'id': i} for i in range(1, 6)]
+
+
+async def test_bulk_upsert(db_conn):
+    conn = await db_conn.acquire()
+    await copy_records(conn, 'organisations', [(1, 'org 1'), (2, 'org 2')], columns=['id', 'name'])
+
+    async def records():
+        for i in range(1, 4):
+            yield i, f'new {i}'
+
+    assert (
+        await upsert_records(
+            conn, 'organisations', records(), columns=['id', 'name'], conflict_columns=['id'], chunk_size=2
+        )
+        == 3
+    )
+    rows = await conn.fetch('select id, name from organisations order by id')
+    assert [tuple(r) for r in rows] == [(1, 'new 1'), (2, 'new 2'), (3, 'new 3')]
@@ -0,0 +1,195 @@
+import logging
+
+import pytest
+from starlette.responses import Response
+
+from foxglove.db.hooks import QueryHooksMixin
+from foxglove.db.instrument import (
+    ProcessQueryStats,
+    QueryInstrument,
+    RequestQueries,
+    current_request_queries,
+    fingerprint_sql,
+    record_query,
+    reset_request_queries,
+    start_request_queries,
+)
+from foxglove.middleware import ErrorMiddleware
+from foxglove.timing import current_timings, reset_timings, start_timings, time_query
+from tests.conftest import FakeConn
+
+pytestmark = pytest.mark.asyncio
+
+
+@pytest.mark.parametrize(
+    'sql,expected',
+    [
+        ('select * from users where id=$1', 'select * from users where id=$1'),
+        (
+            "select * from users\n  where email='x@example.com' and age > 21",
+            'select * from users where email=? and age > ?',
+        ),
+        ("select 'it''s', 1.5", 'select ?, ?'),
+        ('select * from t1', 'select * from t1'),
+    ],
+)
+async def test_fingerprint(sql, expected):
+    assert fingerprint_sql(sql) == expected
+
+
+async def test_process_stats():
+    stats = ProcessQueryStats(max_fingerprints=2)
+    stats.record('a', 0.1, 3, False)
+    stats.record('a', 0.3, 2, False)
+    stats.record('b', 0.1, None, True)
+    stats.record('c', 0.1, 1, False)
+    stats.record('d', 0.1, 1, False)
+    assert stats.summary(reset=True) == {
+        'a': {'count': 2, 'errors': 0, 'total_time': 0.4, 'mean_time': 0.2, 'max_time': 0.3, 'rows': 5},
+        'b': {'count': 1, 'errors': 1, 'total_time': 0.1, 'mean_time': 0.1, 'max_time': 0.1, 'rows': 0},
+        'other': {'count': 2, 'errors': 0, 'total_time': 0.2, 'mean_time': 0.1, 'max_time': 0.1, 'rows': 2},
+    }
+    assert stats.summary() == {}
+
+
+async def test_request_queries(caplog):
+    caplog.set_level(logging.WARNING, 'foxglove.db.queries')
+    record_query('select 1', (), 0.01, 1, None, 0.5)
+    assert current_request_queries() is None
+
+    token = start_request_queries()
+    try:
+        queries = current_request_queries()
+        record_query('select * from users where id=$1', (42,), 0.002, 1, None, 0.5)
+        record_query("update users set name='secret' where id=$1", (42,), 0.6, 1, None, 0.5)
+        record_query('select oops', (), 0.001, None, ValueError('bad'), 0.5)
+    finally:
+        reset_request_queries(token)
+
+    assert queries.as_dict() == {
+        'count': 3,
+        'total_time': '603.00ms',
+        'queries': [
+            {'sql': 'select * from users where id=$1', 'time': '2.00ms', 'rows': 1},
+            {'sql': 'update users set name=? where id=$1', 'time': '600.00ms', 'rows': 1},
+            {'sql': 'select oops', 'time': '1.00ms', 'rows': None, 'error': "ValueError('bad')"},
+        ],
+    }
+    assert len(caplog.records) == 1
+    r = caplog.records[0]
+    assert r.message == 'slow query 600.00ms: update users set name=? where id=$1'
+    assert r.params == ['int']
+
+
+async def test_request_queries_limit():
+    queries = RequestQueries(max_queries=2)
+    for i in range(5):
+        queries.record(f'select {i}', 0.001, 1, None)
+    d = queries.as_dict()
+    assert d['count'] == 5
+    assert d['total_time'] == '5.00ms'
+    assert [q['sql'] for q in d['queries']] == ['select 0', 'select 1']
+    assert d['omitted'] == 3
+
+
+async def test_error_middleware_queries(create_request, settings, monkeypatch, caplog):
+    caplog.set_level(logging.WARNING, 'foxglove.bad_requests')
+    monkeypatch.setattr(settings, 'pg_instrument', True)
+    monkeypatch.setattr(settings, 'pg_instrument_max_queries', 1)
+
+    async def app(scope, receive, send):
+        record_query('select * from users where id=$1', (1,), 0.002, 0, None, None)
+        record_query('select * from users where id=$1', (2,), 0.002, 0, None, None)
+        await Response('not found', status_code=404)(scope, receive, send)
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        pass
+
+    await ErrorMiddleware(app)(create_request(path='/foo/').scope, receive, send)
+    assert current_request_queries() is None
+
+    assert len(caplog.records) == 1
+    extra = caplog.records[0].extra
+    assert extra['db_time'] == '4.00ms'
+    assert extra['queries'] == [{'sql': 'select * from users where id=$1', 'time': '2.00ms', 'rows': 0}]
+    assert extra['queries_omitted'] == 1
+
+
+class HookedConn(QueryHooksMixin, FakeConn):
+    def result(self, method, sql, args):
+        if 'oops' in sql:
+            raise ValueError('bad')
+        return super().result(method, sql, args)
+
+
+async def test_query_hooks():
+    calls = []
+
+    def hook(conn, method, sql, args):
+        calls.append((method, sql, args))
+        return lambda result, error: calls.append(('after', result, error and repr(error)))
+
+    def before_only(conn, method, sql, args):
+        calls.append('before only')
+
+    conn = HookedConn(value=42)
+    conn.query_hooks = (hook, before_only)
+    assert await conn.fetchval('select $1', 1) == 42
+    await conn.executemany('insert into t values ($1)', [(1,), (2,)])
+    await conn.copy_records_to_table('t', records=[(1,)], columns=['x'])
+    with pytest.raises(ValueError, match='bad'):
+        await conn.execute('select oops')
+    assert calls == [
+        ('fetchval', 'select $1', (1,)),
+        'before only',
+        ('after', 42, None),
+        ('executemany', 'insert into t values ($1)', ([(1,), (2,)],)),
+        'before only',
+        ('after', None, None),
+        ('copy_records_to_table', None, ()),
+        'before only',
+        ('after', None, None),
+        ('execute', 'select oops', ()),
+        'before only',
+        ('after', None, "ValueError('bad')"),
+    ]
+
+
+async def test_query_instrument():
+    conn = HookedConn(value=42, rows=[{'id': 1}, {'id': 2}], status='UPDATE 3')
+    conn.query_hooks = (QueryInstrument(),)
+    token = start_request_queries()
+    try:
+        await conn.fetchval('select 1')
+        await conn.fetch('select id from users')
+        await conn.execute('update users set x=1')
+        await conn.prepare('select 2')
+        with pytest.raises(ValueError):
+            await conn.execute('select oops')
+        queries = current_request_queries().queries
+    finally:
+        reset_request_queries(token)
+
+    assert [(q['sql'], q['rows'], q.get('error')) for q in queries] == [
+        ('select ?', 1, None),
+        ('select id from users', 2, None),
+        ('update users set x=?', 3, None),
+        ('select oops', None, "ValueError('bad')"),
+    ]
+
+
+async def test_time_query():
+    conn = HookedConn()
+    conn.query_hooks = (time_query,)
+    await conn.fetch('select 1')
+    token = start_timings(0)
+    try:
+        await conn.fetch('select 1')
+        await conn.execute('select 2')
+        timings = current_timings()
+    finally:
+        reset_timings(token)
+    assert timings.phases['db'][1] == 2
@@ -0,0 +1,45 @@
+import pytest
+from pydantic import ValidationError
+
+from foxglove import BaseSettings
+from foxglove.db.json_codecs import RawJSON, decode_jsonb, encode, encode_jsonb, raw_jsonb, register_json_codecs
+from tests.conftest import FakeConn
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_encode():
+    assert encode({'a': [1, None]}) == b'{"a":[1,null]}'
+    assert encode('{"a": 1}') == b'{"a": 1}'
+    assert encode(b'[1]') == b'[1]'
+    assert encode_jsonb([1]) == b'\x01[1]'
+
+
+async def test_decode():
+    assert decode_jsonb(b'\x01{"a": [1, 2]}') == {'a': [1, 2]}
+    raw = raw_jsonb(b'\x01{"a": [1, 2]}')
+    assert isinstance(raw, RawJSON)
+    assert raw == b'{"a": [1, 2]}'
+    assert repr(raw) == 'RawJSON(b\'{"a": [1, 2]}\')'
+
+
+@pytest.mark.parametrize('mode,expected', [('decode', {'a': 1}), ('raw', RawJSON(b'{"a":1}'))])
+async def test_register(mode, expected):
+    conn = FakeConn()
+    await register_json_codecs(conn, mode)
+    json_encoder, json_decoder = conn.codecs['json']
+    jsonb_encoder, jsonb_decoder = conn.codecs['jsonb']
+    assert json_decoder(json_encoder({'a': 1})) == expected
+    assert jsonb_decoder(jsonb_encoder({'a': 1})) == expected
+
+
+async def test_register_invalid():
+    with pytest.raises(ValueError, match='mode must be one of'):
+        await register_json_codecs(FakeConn(), 'foobar')
+
+
+async def test_json_codec_setting():
+    assert BaseSettings(pg_json_codec='raw').pg_json_codec == 'raw'
+    assert BaseSettings().pg_json_codec is None
+    with pytest.raises(ValidationError, match='pg_json_codec'):
+        BaseSettings(pg_json_codec='foobar')
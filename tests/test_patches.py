@@ -1,13 +1,14 @@
+import asyncio
 import logging
 
 import pytest
-from pytest_toolbox.comparison import AnyInt, CloseToNow
+from pytest_toolbox.comparison import AnyInt, CloseToNow, RegexStr
 
 from foxglove import BaseSettings
-from foxglove.db.migrations import run_migrations
-from foxglove.db.patches import Patch, run_patch
+from foxglove.db.migrations import migrations_digest, run_migrations
+from foxglove.db.patches import Chunked, Patch, _run_chunked, patch, pending_batches, progress_table_sql, run_patch
 from foxglove.db.utils import AsyncPgContext
-from tests.conftest import SyncConnContext
+from tests.conftest import FakeConn, FakePool, SyncConnContext
 
 pytestmark = pytest.mark.asyncio
 
@@ -49,6 +50,147 @@ def test_patch_error(settings: BaseSettings, wipe_db, caplog):
     ]
 
 
+def create_orgs(settings: BaseSettings, count: int):
+    with SyncConnContext(settings.pg_dsn) as conn:
+        conn.execute("insert into organisations (name) select 'org-' || n from generate_series(1, $1) n", count)
+
+
+def upper_names(settings: BaseSettings) -> int:
+    with SyncConnContext(settings.pg_dsn) as conn:
+        return conn.fetchval("select count(*) from organisations where name like 'ORG-%'")
+
+
+def test_patch_chunked(settings: BaseSettings, wipe_db, caplog):
+    create_orgs(settings, 25)
+    caplog.set_level(logging.INFO, 'foxglove.db')
+    assert run_patch('upper_org_names', True, {}) == 0
+    assert upper_names(settings) == 25
+    with SyncConnContext(settings.pg_dsn) as conn:
+        assert conn.fetchval("select count(*) from patch_progress where patch='upper_org_names'") == 3
+
+    assert caplog.messages[0] == '--- running patch upper_org_names chunked live ---'
+    assert sorted(m for m in caplog.messages if m.startswith('batch ')) == [
+        RegexStr(r'batch 1/3 complete, keys \d+ to \d+, .*'),
+        RegexStr(r'batch 2/3 complete, keys \d+ to \d+, .*'),
+        RegexStr(r'batch 3/3 complete, keys \d+ to \d+, .*'),
+    ]
+    assert caplog.messages[-2:] == [
+        'result: 3 batches run, 3/3 complete',
+        '--------------- committed batches ----------------',
+    ]
+
+    caplog.clear()
+    assert run_patch('upper_org_names', True, {}) == 0
+    assert caplog.messages[1:3] == ['resuming, 3 of 3 batches already complete', 'result: 0 batches run, 3/3 complete']
+
+
+def test_patch_chunked_dry_run(settings: BaseSettings, wipe_db, caplog):
+    create_orgs(settings, 25)
+    caplog.set_level(logging.INFO, 'foxglove.db')
+    assert run_patch('upper_org_names', False, {}) == 0
+    assert upper_names(settings) == 0
+    with SyncConnContext(settings.pg_dsn) as conn:
+        # the progress table is created in the rolled back transaction
+        assert conn.fetchval("select to_regclass('patch_progress')") is None
+
+    assert caplog.messages[-2:] == [
+        'result: 1 batches run, 1/3 complete',
+        '------------- not live, rolled back --------------',
+    ]
+
+
+def test_patch_chunked_resume(settings: BaseSettings, wipe_db, caplog):
+    create_orgs(settings, 25)
+    with SyncConnContext(settings.pg_dsn) as conn:
+        min_id = conn.fetchval('select min(id) from organisations')
+    assert run_patch('upper_org_names', True, {}) == 0
+    with SyncConnContext(settings.pg_dsn) as conn:
+        conn.execute('update organisations set name=lower(name)')
+        conn.execute('delete from patch_progress where batch_start > $1', min_id)
+
+    caplog.set_level(logging.INFO, 'foxglove.db')
+    assert run_patch('upper_org_names', True, {}) == 0
+    assert upper_names(settings) == 15
+    assert 'resuming, 1 of 3 batches already complete' in caplog.messages
+
+    assert run_patch('upper_org_names', True, {}, restart=True) == 0
+    assert upper_names(settings) == 25
+
+
+async def test_chunked_invalid():
+    async def chunked_patch(**kwargs):
+        pass
+
+    with pytest.raises(TypeError, match='chunked patches commit each batch'):
+        patch(direct=True, chunked=Chunked('select 1, 2'))(chunked_patch)
+    with pytest.raises(TypeError, match='chunked patches must be async functions'):
+        patch(chunked=Chunked('select 1, 2'))(lambda **kwargs: None)
+
+
+class ChunkedConn(FakeConn):
+    def result(self, method, sql, args):
+        if method == 'fetchrow':
+            return 1, 100
+        return []
+
+
+async def test_chunked_error_cancels_workers(settings: BaseSettings, monkeypatch):
+    pool = FakePool(size=2)
+    pool.conn_class = ChunkedConn
+
+    async def connect_pg_pool(pool_settings, dsn):
+        assert pool_settings.pg_pool_max_size == 2
+        return pool
+
+    monkeypatch.setattr('foxglove.db.main.connect_pg_pool', connect_pg_pool)
+    started = []
+
+    async def chunked_patch(conn, start, **kwargs):
+        started.append(start)
+        if start == 1:
+            await asyncio.sleep(0)
+            raise RuntimeError('broken')
+        await asyncio.sleep(1)
+
+    p = Patch(chunked_patch, chunked=Chunked('select min(id), max(id) from x', batch_size=10, workers=2))
+    with pytest.raises(RuntimeError, match='broken'):
+        await _run_chunked(p, ChunkedConn(), True, {}, False)
+    assert started == [1, 11]
+    assert pool.closed
+    assert [c.calls[-1] for c in pool.conns] == [('rollback',), ('rollback',)]
+
+
+async def test_chunked_dry_run_rollback():
+    conn = ChunkedConn()
+
+    async def chunked_patch(conn, start, end, **kwargs):
+        await conn.execute('update x set v=1 where id >= $1 and id < $2', start, end)
+
+    p = Patch(chunked_patch, chunked=Chunked('select min(id), max(id) from x', batch_size=10, workers=2))
+    assert await _run_chunked(p, conn, False, {}, True) == '1 batches run, 1/10 complete'
+    assert conn.calls[:2] == [('begin',), ('execute', progress_table_sql, ())]
+    assert conn.calls[-1] == ('rollback',)
+    assert conn.transaction_depth == 0
+
+
+@pytest.mark.parametrize(
+    'key_min,key_end,batch_size,done,expected',
+    [
+        (1, 26, 10, [], [(1, 11), (11, 21), (21, 26)]),
+        (1, 26, 10, [(1, 11), (11, 21)], [(21, 26)]),
+        (1, 26, 10, [(1, 11), (11, 21), (21, 26)], []),
+        # resumed with a larger batch_size, the keys after the first completed batch are still run
+        (1, 26, 20, [(1, 11)], [(11, 26)]),
+        (1, 41, 20, [(11, 21)], [(1, 11), (21, 41)]),
+        # resumed with a smaller batch_size or after key_min moved
+        (1, 26, 5, [(1, 11), (21, 26)], [(11, 16), (16, 21)]),
+        (5, 26, 10, [(1, 11)], [(11, 21), (21, 26)]),
+    ],
+)
+async def test_pending_batches(key_min, key_end, batch_size, done, expected):
+    assert list(pending_batches(key_min, key_end, batch_size, done)) == expected
+
+
 async def test_run_migrations_ok(settings: BaseSettings, wipe_db, db_conn, caplog):
     async def ok_patch(logger, **kwargs):
         logger.info('running ok_patch')
@@ -75,6 +217,11 @@ async def test_run_migrations_ok(settings: BaseSettings, wipe_db, db_conn, caplo
         assert await conn.fetchval('select count(*) from migrations') == 1
 
     async with AsyncPgContext(settings.pg_dsn) as conn:
+        await conn.execute('delete from migrations_digest')
+    assert await run_migrations(settings, patches, True) == 0
+
+    async with AsyncPgContext(settings.pg_dsn) as conn:
+        await conn.execute('delete from migrations_digest')
         async with conn.transaction():
             await conn.execute('lock table migrations')
             assert await run_migrations(settings, patches, True) == 0
@@ -86,12 +233,40 @@ async def test_run_migrations_ok(settings: BaseSettings, wipe_db, db_conn, caplo
         'running ok_patch',
         '--------------- ok_patch:foobar ✓ ----------------',
         '1 migration patches run, 0 already up to date ✓',
+        'all 1 migrations already up to date ✓',
         'checking 1 migration patches...',
         'all 1 migrations already up to date ✓',
         'another transaction has locked migrations, skipping migrations here',
     ]
 
 
+async def test_run_migrations_digest(settings: BaseSettings, wipe_db, caplog):
+    async def patch_a(logger, **kwargs):
+        logger.info('running patch_a')
+
+    async def patch_b(logger, **kwargs):
+        logger.info('running patch_b')
+
+    assert await run_migrations(settings, [Patch(patch_a, auto_run=True)], True) == 1
+    caplog.set_level(logging.INFO, 'foxglove.db')
+    assert await run_migrations(settings, [Patch(patch_a, auto_run=True)], True) == 0
+    assert caplog.messages == ['all 1 migrations already up to date ✓']
+
+    caplog.clear()
+    assert await run_migrations(settings, [Patch(patch_b, auto_run=True), Patch(patch_a, auto_run=True)], True) == 1
+    assert 'running patch_b' in caplog.messages
+    assert 'running patch_a' not in caplog.messages
+
+    async with AsyncPgContext(settings.pg_dsn) as conn:
+        assert await conn.fetchval('select count(*) from migrations_digest') == 2
+
+
+async def test_migrations_digest():
+    assert migrations_digest([('a', '-'), ('b', '-')]) == migrations_digest([('b', '-'), ('a', '-')])
+    assert migrations_digest([('a', '-')]) != migrations_digest([('a', 'x::\nselect 1')])
+    assert migrations_digest([('ab', '-')]) != migrations_digest([('a', 'b-')])
+
+
 async def test_run_migrations_error(settings: BaseSettings, wipe_db, caplog):
     def ok_patch(logger, **kwargs):
         return 'hello'
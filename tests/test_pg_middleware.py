@@ -0,0 +1,563 @@
+import asyncio
+
+import pytest
+from pydantic import ValidationError
+from pytest_toolbox.comparison import AnyInt
+from starlette.requests import Request
+from starlette.responses import Response
+
+from foxglove import BaseSettings, glove
+from foxglove.db.hooks import QueryHooksMixin
+from foxglove.db.loader import batch_loader
+from foxglove.db.middleware import PgMiddleware, acquire_metrics, get_db, get_db_primary, get_db_readonly
+from foxglove.db.repeated import count_repeated, record_repeated, repeated_queries_key
+from foxglove.db.replicas import ReplicaPoolSet, is_write, track_writes
+from foxglove.responses import NDJSONResponse
+from tests.conftest import FakeConn, FakePool
+
+pytestmark = pytest.mark.asyncio
+
+
+class LsnConn(FakeConn):
+    def result(self, method, sql, args):
+        if 'pg_current_wal_lsn' in sql:
+            return '0/16B3748'
+        else:
+            assert args == ('0/16B3748',)
+            return self.pool.caught_up
+
+
+class EchoConn(FakeConn):
+    def result(self, method, sql, args):
+        return args[0]
+
+
+class RepeatedQueriesConn(QueryHooksMixin, EchoConn):
+    query_hooks = (count_repeated,)
+
+
+class ReplicaPool(FakePool):
+    conn_class = LsnConn
+    # whether replicas have replayed up to the LSN
+    caught_up = True
+
+
+@pytest.fixture(name='fake_pool')
+def _fix_fake_pool(settings, monkeypatch):
+    pool = ReplicaPool()
+    monkeypatch.setattr(glove, 'pg', pool, raising=False)
+    monkeypatch.setattr(settings, 'pg_acquire_timeout', 0.01)
+    acquire_metrics.reset()
+    return pool
+
+
+async def call(app, create_request, method='GET'):
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        messages.append(message)
+
+    await app(create_request(method=method).scope, receive, send)
+    return messages
+
+
+async def test_release_after_response(fake_pool: ReplicaPool, create_request):
+    released_before_return = None
+
+    async def app(scope, receive, send):
+        nonlocal released_before_return
+        assert (await get_db(Request(scope, receive))).pool is fake_pool
+        await Response('ok')(scope, receive, send)
+        released_before_return = list(fake_pool.released)
+
+    messages = await call(PgMiddleware(app), create_request)
+    assert messages[0]['status'] == 200
+    assert released_before_return == ['primary']
+    assert fake_pool.released == ['primary']
+    assert acquire_metrics.get()['acquired'] == 1
+
+
+async def test_acquire_timeout(fake_pool: ReplicaPool, create_request):
+    await fake_pool.acquire()
+
+    async def app(scope, receive, send):
+        await get_db(Request(scope, receive))
+        await Response('ok')(scope, receive, send)
+
+    messages = await call(PgMiddleware(app), create_request)
+    assert messages[0]['status'] == 503
+    assert (b'retry-after', b'2') in messages[0]['headers']
+    assert messages[1]['body'] == b'{"message":"Service Unavailable, please try again shortly"}'
+    m = acquire_metrics.get(reset=True)
+    assert m['acquired'] == 0
+    assert m['timeouts'] == 1
+    assert m['max_wait'] >= 0.01
+    assert acquire_metrics.get()['timeouts'] == 0
+
+
+async def test_replica_round_robin():
+    pools = [ReplicaPool('a', size=2), ReplicaPool('b', size=2)]
+    replicas = ReplicaPoolSet(pools)
+    conns = [await replicas.acquire() for _ in range(4)]
+    assert [c.pool.name for c in conns] == ['a', 'b', 'a', 'b']
+    for conn in conns:
+        await replicas.release(conn)
+    assert pools[0].released == ['a', 'a']
+
+
+async def test_replica_least_busy():
+    pools = [ReplicaPool('a', size=2), ReplicaPool('b', size=2)]
+    replicas = ReplicaPoolSet(pools, strategy='least-busy')
+    c1 = await replicas.acquire()
+    c2 = await replicas.acquire()
+    assert (c1.pool.name, c2.pool.name) == ('a', 'b')
+    await replicas.release(c1)
+    c3 = await replicas.acquire()
+    assert c3.pool.name == 'a'
+
+
+async def test_replica_strategy_setting():
+    assert BaseSettings(pg_replica_strategy='least-busy').pg_replica_strategy == 'least-busy'
+    with pytest.raises(ValidationError, match='pg_replica_strategy'):
+        BaseSettings(pg_replica_strategy='round_robin')
+
+
+@pytest.mark.parametrize(
+    'method,dependency,expected',
+    [
+        ('GET', get_db, 'replica'),
+        ('HEAD', get_db, 'replica'),
+        ('POST', get_db, 'primary'),
+        ('GET', get_db_primary, 'primary'),
+        ('POST', get_db_readonly, 'replica'),
+    ],
+)
+async def test_route_reads(fake_pool: ReplicaPool, create_request, monkeypatch, method, dependency, expected):
+    replica = ReplicaPool('replica')
+    monkeypatch.setattr(glove, 'pg_read', ReplicaPoolSet([replica]), raising=False)
+    used = None
+
+    async def app(scope, receive, send):
+        nonlocal used
+        used = (await dependency(Request(scope, receive))).pool.name
+        await Response('ok')(scope, receive, send)
+
+    await call(PgMiddleware(app), create_request, method)
+    assert used == expected
+    assert fake_pool.released + replica.released == [expected]
+
+
+async def test_readonly_after_primary(fake_pool: ReplicaPool, create_request, monkeypatch):
+    replica = ReplicaPool('replica')
+    monkeypatch.setattr(glove, 'pg_read', ReplicaPoolSet([replica]), raising=False)
+    used = []
+
+    async def app(scope, receive, send):
+        request = Request(scope, receive)
+        used.append((await get_db_primary(request)).pool.name)
+        # a request which has written shouldn't read from a replica
+        used.append((await get_db_readonly(request)).pool.name)
+        await Response('ok')(scope, receive, send)
+
+    await call(PgMiddleware(app), create_request)
+    assert used == ['primary', 'primary']
+
+
+async def test_read_your_writes(fake_pool: ReplicaPool, create_request, monkeypatch):
+    replica = ReplicaPool('replica')
+    monkeypatch.setattr(glove, 'pg_read', ReplicaPoolSet([replica]), raising=False)
+    used = []
+
+    async def app(scope, receive, send):
+        used.append((await get_db(Request(scope, receive))).pool.name)
+        await Response('ok')(scope, receive, send)
+
+    session = {}
+
+    async def request(method):
+        await PgMiddleware(app)(create_request(method=method, session=session).scope, receive, send)
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        pass
+
+    await request('GET')
+    assert session == {}
+    await request('POST')
+    assert session == {'pg_lsn': ['0/16B3748', AnyInt()]}
+
+    replica.caught_up = False
+    await request('GET')
+    replica.caught_up = True
+    await request('GET')
+    assert used == ['replica', 'primary', 'primary', 'replica']
+    assert replica.released == ['replica', 'replica', 'replica']
+
+    session['pg_lsn'][1] -= 60
+    await request('GET')
+    assert session == {}
+
+
+async def test_lsn_header(fake_pool: ReplicaPool, create_request, monkeypatch):
+    replica = ReplicaPool('replica')
+    monkeypatch.setattr(glove, 'pg_read', ReplicaPoolSet([replica]), raising=False)
+
+    async def app(scope, receive, send):
+        await get_db(Request(scope, receive))
+        await Response('ok')(scope, receive, send)
+
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = create_request(method='POST').scope
+    del scope['session']
+    await PgMiddleware(app)(scope, receive, send)
+    assert (b'x-pg-lsn', b'0/16B3748') in messages[0]['headers']
+
+    replica.caught_up = False
+    scope = create_request(headers={'X-Pg-Lsn': '0/16B3748'}).scope
+    del scope['session']
+    await PgMiddleware(app)(scope, receive, send)
+    assert fake_pool.released == ['primary', 'primary']
+
+
+async def test_lsn_header_invalid(fake_pool: ReplicaPool, create_request, monkeypatch):
+    replica = ReplicaPool('replica')
+    monkeypatch.setattr(glove, 'pg_read', ReplicaPoolSet([replica]), raising=False)
+
+    async def app(scope, receive, send):
+        await get_db(Request(scope, receive))
+        await Response('ok')(scope, receive, send)
+
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        messages.append(message)
+
+    for lsn in ('0/16B3748; drop table users', 'garbage', '123456789/0', '/1'):
+        scope = create_request(headers={'X-Pg-Lsn': lsn}).scope
+        del scope['session']
+        await PgMiddleware(app)(scope, receive, send)
+    assert [m['status'] for m in messages if m['type'] == 'http.response.start'] == [200] * 4
+    # invalid values are ignored so replicas are used without checking their position
+    assert replica.released == ['replica'] * 4
+    assert [c.calls for c in replica.conns] == [[]] * 4
+
+
+class BrokenReplicaConn(FakeConn):
+    def result(self, method, sql, args):
+        raise RuntimeError('replica down')
+
+
+async def test_replica_check_error(fake_pool: ReplicaPool, create_request, monkeypatch):
+    replica = ReplicaPool('replica')
+    replica.conn_class = BrokenReplicaConn
+    monkeypatch.setattr(glove, 'pg_read', ReplicaPoolSet([replica]), raising=False)
+
+    async def app(scope, receive, send):
+        await get_db(Request(scope, receive))
+
+    scope = create_request(headers={'X-Pg-Lsn': '0/16B3748'}).scope
+    del scope['session']
+    with pytest.raises(RuntimeError, match='replica down'):
+        await PgMiddleware(app)(scope, None, None)
+    assert replica.released == ['replica']
+
+
+class WriteTrackingConn(QueryHooksMixin, FakeConn):
+    query_hooks = (track_writes,)
+
+    def result(self, method, sql, args):
+        if 'pg_current_wal_lsn' in sql:
+            return '0/16B3748'
+
+
+async def test_lsn_only_after_writes(fake_pool: ReplicaPool, create_request, monkeypatch):
+    monkeypatch.setattr(glove, 'pg_read', ReplicaPoolSet([ReplicaPool('replica')]), raising=False)
+    fake_pool.conn_class = WriteTrackingConn
+    sql = 'select 1'
+
+    async def app(scope, receive, send):
+        await (await get_db(Request(scope, receive))).execute(sql)
+        await Response('ok')(scope, receive, send)
+
+    session = {}
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        pass
+
+    await PgMiddleware(app)(create_request(method='POST', session=session).scope, receive, send)
+    assert session == {}
+    assert fake_pool.conns[0].calls == [('execute', 'select 1', ())]
+
+    sql = 'update users set active=false'
+    await PgMiddleware(app)(create_request(method='POST', session=session).scope, receive, send)
+    assert session == {'pg_lsn': ['0/16B3748', AnyInt()]}
+
+    # writes are tracked for each request, not on the connection
+    session.clear()
+    sql = 'select 1'
+    await PgMiddleware(app)(create_request(method='POST', session=session).scope, receive, send)
+    assert session == {}
+
+
+class ConnProxy:
+    """
+    Like asyncpg's PoolConnectionProxy: attributes are read from the connection but can't be set.
+    """
+
+    __slots__ = ('_con',)
+
+    def __init__(self, con):
+        self._con = con
+
+    def __getattr__(self, attr):
+        return getattr(self._con, attr)
+
+
+class ProxyPool(ReplicaPool):
+    conn_class = WriteTrackingConn
+
+    async def get_conn(self, timeout):
+        # the same connection is reused for every request
+        if not self.conns:
+            await super().get_conn(timeout)
+        else:
+            await asyncio.wait_for(self.semaphore.acquire(), timeout)
+        return ConnProxy(self.conns[0])
+
+
+async def test_lsn_pool_proxy(create_request, settings, monkeypatch):
+    pool = ProxyPool()
+    monkeypatch.setattr(glove, 'pg', pool, raising=False)
+    monkeypatch.setattr(glove, 'pg_read', ReplicaPoolSet([ReplicaPool('replica')]), raising=False)
+    sqls = ['update users set active=false', 'select 1']
+    sessions = []
+
+    async def app(scope, receive, send):
+        await (await get_db(Request(scope, receive))).execute(sqls.pop(0))
+        await Response('ok')(scope, receive, send)
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        pass
+
+    for _ in range(2):
+        sessions.append({})
+        await PgMiddleware(app)(create_request(method='POST', session=sessions[-1]).scope, receive, send)
+    assert sessions == [{'pg_lsn': ['0/16B3748', AnyInt()]}, {}]
+    assert len(pool.conns) == 1
+
+
+@pytest.mark.parametrize(
+    'sql,expected',
+    [
+        ('select * from users where id=$1', False),
+        ('-- comment\n  SELECT 1', False),
+        ('with x as (select 1) select * from x', False),
+        ('with x as (delete from users returning id) select * from x', True),
+        ('insert into users (name) values ($1)', True),
+        ('UPDATE users set name=$1', True),
+        ('begin', False),
+        ('create table x (id int)', True),
+    ],
+)
+async def test_is_write(sql, expected):
+    assert is_write(sql) is expected
+
+
+class LoaderConn(FakeConn):
+    def result(self, method, sql, args):
+        (ids,) = args
+        if -1 in ids:
+            raise RuntimeError('broken')
+        return [{'id': i, 'name': f'user {i}'} for i in ids if i < 10]
+
+
+def loaded_ids(conn: FakeConn):
+    return [args[0] for _, _, args in conn.calls]
+
+
+async def test_batch_loader(create_request):
+    conn = LoaderConn()
+    request = create_request()
+
+    async def get_pg_conn(*, readonly=False):
+        assert readonly is True
+        return conn
+
+    request.state.get_pg_conn = get_pg_conn
+    get_users = batch_loader('select id, name from users where id = any($1)')
+    users = await get_users(request)
+    assert await get_users(request) is users
+
+    async def nested(user_id):
+        return (await users.load(user_id))['name']
+
+    r = await asyncio.gather(users.load(1), users.load(2), users.load(1), nested(3), users.load(42))
+    assert r == [{'id': 1, 'name': 'user 1'}, {'id': 2, 'name': 'user 2'}, {'id': 1, 'name': 'user 1'}, 'user 3', None]
+    assert loaded_ids(conn) == [[1, 2, 3, 42]]
+
+    assert await users.load_many([3, 4, 42]) == [{'id': 3, 'name': 'user 3'}, {'id': 4, 'name': 'user 4'}, None]
+    assert loaded_ids(conn) == [[1, 2, 3, 42], [4]]
+
+    with pytest.raises(RuntimeError, match='broken'):
+        await users.load_many([5, -1])
+    assert await users.load(5) == {'id': 5, 'name': 'user 5'}
+    assert loaded_ids(conn) == [[1, 2, 3, 42], [4], [5, -1], [5]]
+
+
+async def test_batch_loader_tasks(create_request):
+    running_tasks = []
+
+    class TasksConn(LoaderConn):
+        def result(self, method, sql, args):
+            running_tasks.append(len(users._tasks))
+            return super().result(method, sql, args)
+
+    conn = TasksConn()
+    request = create_request()
+
+    async def get_pg_conn(*, readonly=False):
+        return conn
+
+    request.state.get_pg_conn = get_pg_conn
+    users = await batch_loader('select id, name from users where id = any($1)')(request)
+    assert await users.load(1) == {'id': 1, 'name': 'user 1'}
+    await asyncio.sleep(0)
+    # the batch task is referenced while it's running
+    assert running_tasks == [1]
+    assert users._tasks == set()
+
+    # errors building the result are raised by load() rather than lost with the task
+    missing_key = await batch_loader('select name from users where id = any($1)', key='user_id')(request)
+    with pytest.raises(KeyError, match='user_id'):
+        await missing_key.load(2)
+
+
+async def test_batch_loader_cancel(create_request):
+    conn = LoaderConn()
+    request = create_request()
+    fetching = asyncio.Event()
+    finish = asyncio.Event()
+
+    async def get_pg_conn(*, readonly=False):
+        fetching.set()
+        await finish.wait()
+        return conn
+
+    request.state.get_pg_conn = get_pg_conn
+    users = await batch_loader('select id, name from users where id = any($1)')(request)
+
+    # cancelling one caller doesn't cancel the load for others waiting on the same key
+    t1 = asyncio.ensure_future(users.load(1))
+    t2 = asyncio.ensure_future(users.load(1))
+    await fetching.wait()
+    t1.cancel()
+    finish.set()
+    assert await t2 == {'id': 1, 'name': 'user 1'}
+    assert t1.cancelled()
+    assert await users.load(1) == {'id': 1, 'name': 'user 1'}
+
+    # if the batch itself is cancelled the key can be loaded again
+    finish.clear()
+    fetching.clear()
+    t3 = asyncio.ensure_future(users.load(2))
+    await fetching.wait()
+    (batch_task,) = users._tasks
+    batch_task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await t3
+    finish.set()
+    assert await users.load(2) == {'id': 2, 'name': 'user 2'}
+    assert loaded_ids(conn) == [[1], [2]]
+
+
+async def test_release_after_stream(fake_pool: ReplicaPool, create_request):
+    released_during_stream = []
+
+    async def app(scope, receive, send):
+        await get_db(Request(scope, receive))
+
+        async def rows():
+            for i in range(3):
+                released_during_stream.append(list(fake_pool.released))
+                yield {'id': i}
+
+        await NDJSONResponse(rows())(scope, receive, send)
+
+    messages = []
+    received = False
+
+    async def receive():
+        nonlocal received
+        if received:
+            # StreamingResponse listens for a disconnect while streaming
+            await asyncio.Event().wait()
+        received = True
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        messages.append(message)
+
+    await PgMiddleware(app)(create_request().scope, receive, send)
+    assert b''.join(m.get('body', b'') for m in messages[1:]) == b'{"id":0}\n{"id":1}\n{"id":2}\n'
+    assert released_during_stream == [[], [], []]
+    assert fake_pool.released == ['primary']
+
+
+async def test_repeated_queries(fake_pool: ReplicaPool, create_request, monkeypatch, caplog):
+    monkeypatch.setattr(glove.settings, 'pg_repeated_query_limit', 3)
+    fake_pool.conn_class = RepeatedQueriesConn
+
+    def repeated_app(n: int):
+        async def app(scope, receive, send):
+            conn = await get_db(Request(scope, receive))
+            for i in range(n):
+                assert await conn.fetchval('select $1', i) == i
+            await Response('ok')(scope, receive, send)
+
+        return app
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        pass
+
+    scope = create_request().scope
+    await PgMiddleware(repeated_app(3))(scope, receive, send)
+    assert repeated_queries_key not in scope['state']
+    assert caplog.records == []
+
+    scope = create_request().scope
+    await PgMiddleware(repeated_app(5))(scope, receive, send)
+    report = scope['state'][repeated_queries_key]
+    assert report.startswith('repeated queries in request, use a join or "where id = any($1)" instead:\n')
+    assert '5 queries (limit 3): select $1\n' in report
+    assert 'in app\n' in report
+    assert 'record_repeated' not in report
+    assert '_run_hooks' not in report
+    assert len(caplog.records) == 1
+    assert caplog.records[0].name == 'foxglove.db.repeated'
+
+    # queries outside a request aren't counted
+    record_repeated('select 1')
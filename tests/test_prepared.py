@@ -0,0 +1,51 @@
+import inspect
+import logging
+
+import pytest
+from asyncpg import Connection
+from buildpg import V
+
+from foxglove.db import prepared
+from foxglove.db.prepared import StatementRegistry, init_connection
+from tests.conftest import FakeConn
+
+pytestmark = pytest.mark.asyncio
+
+
+class PrepareConn(FakeConn):
+    async def _get_statement(self, sql, timeout):
+        if 'missing' in sql:
+            raise RuntimeError('relation "missing" does not exist')
+        self.calls.append(('prepare', sql, ()))
+
+
+async def test_registry(monkeypatch, caplog):
+    caplog.set_level(logging.DEBUG, 'foxglove.db')
+    registry = StatementRegistry()
+    monkeypatch.setattr(prepared, 'hot_statements', registry)
+    conn = PrepareConn()
+    await init_connection(conn)
+    assert conn.calls == []
+
+    assert registry.add('select * from users where id=$1') == 'select * from users where id=$1'
+    assert registry.add_b('select * from users where :where', where=V('org') == 1) == (
+        'select * from users where org = $1'
+    )
+    registry.add('select * from users where id=$1')
+    registry.add('select * from missing')
+    assert len(registry) == 3
+
+    await init_connection(conn)
+    assert conn.calls == [
+        ('prepare', 'select * from users where id=$1', ()),
+        ('prepare', 'select * from users where org = $1', ()),
+    ]
+    assert "error preparing statement 'select * from missing': RuntimeError" in caplog.text
+    assert 'prepared 2 statements' in caplog.text
+
+
+async def test_get_statement_signature():
+    # StatementRegistry.prepare uses this private method to add statements to asyncpg's statement cache
+    params = inspect.signature(Connection._get_statement).parameters
+    assert list(params)[:3] == ['self', 'query', 'timeout']
+    assert params['use_cache'].default is True
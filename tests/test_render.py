@@ -0,0 +1,76 @@
+import pytest
+from buildpg import V, Values, funcs, render
+from buildpg.asyncpg import BuildPgConnection
+from buildpg.components import BuildError, SetValues
+
+from foxglove.db.hooks import QueryHooksMixin
+from foxglove.db.instrument import QueryInstrument
+from foxglove.db.main import connection_class
+from foxglove.db.render import RenderCache, RenderCacheMixin
+from foxglove.db.repeated import count_repeated
+from foxglove.db.replicas import track_writes
+from foxglove.timing import time_query
+
+
+@pytest.mark.parametrize(
+    'template,ctx_list',
+    [
+        ('select * from users where id=:id', [dict(id=1), dict(id=2)]),
+        ('select :a, :b, :a', [dict(a=1, b='x'), dict(a=[1, 2], b=None)]),
+        (
+            'select * from users where :where',
+            [
+                dict(where=V('id') == 1),
+                dict(where=V('id') == 2),
+                dict(where=funcs.AND(V('id') == 3, V('name') == 'x')),
+                dict(where=funcs.AND(V('id') == 4, V('name') == 'y')),
+                dict(where=funcs.AND(V('id') == 5, V('email') == 'y')),
+            ],
+        ),
+        ('update users set :values where id=:id', [dict(values=SetValues(a=1, b=2), id=3)] * 2),
+        ('insert into users (:values__names) values :values', [dict(values=Values(a=1, b=2))] * 2),
+    ],
+)
+def test_render_cache(template, ctx_list):
+    cache = RenderCache()
+    for ctx in ctx_list * 2:
+        assert cache(template, **ctx) == render(template, **ctx)
+
+
+def test_render_cache_hit():
+    cache = RenderCache(max_size=2)
+    sql1, params1 = cache('select :a, :b', a=1, b=2)
+    sql2, params2 = cache('select :a, :b', a=3, b=4)
+    assert sql2 is sql1
+    assert (params1, params2) == ([1, 2], [3, 4])
+    assert len(cache) == 1
+
+    cache('select :a', a=1)
+    cache('select :b', b=1)
+    assert len(cache) == 2
+    assert cache('select :a, :b', a=5, b=6)[0] is not sql1
+
+
+def test_render_cache_error():
+    cache = RenderCache()
+    with pytest.raises(BuildError, match='variable "b" not found in context'):
+        cache('select :a, :b', a=1)
+    assert len(cache) == 0
+
+
+def test_connection_class(settings):
+    cls = connection_class(settings)
+    assert issubclass(cls, RenderCacheMixin)
+    # queries are counted on the connection itself so the render cache is still used in tests
+    assert issubclass(cls, QueryHooksMixin)
+    assert issubclass(cls, BuildPgConnection)
+    assert cls.query_hooks == (count_repeated, time_query)
+    cls = connection_class(settings.copy(update=dict(pg_replica_dsns=['postgres://r/db'], pg_instrument=True)))
+    track, count, instrument, time = cls.query_hooks
+    assert (track, count, time) == (track_writes, count_repeated, time_query)
+    assert isinstance(instrument, QueryInstrument)
+    cls = connection_class(settings.copy(update=dict(test_mode=False, pg_render_cache=False, request_timings=False)))
+    assert cls is BuildPgConnection
+    assert connection_class(settings.copy(update=dict(pg_render_cache=False, request_timings=False))).__name__ == (
+        'BuildPgConnection'
+    )
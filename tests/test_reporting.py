@@ -0,0 +1,255 @@
+import asyncio
+import logging
+
+import pytest
+from starlette.requests import Request
+from starlette.responses import Response
+
+from foxglove import glove
+from foxglove.db.middleware import PgMiddleware, get_db
+from foxglove.middleware import ErrorMiddleware
+from foxglove.reporting import ErrorReporter, EventRateLimiter
+from tests.conftest import FakeConn, FakePool
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_reporter_batches():
+    calls = []
+    reporter = ErrorReporter(batch_size=3)
+    reporter.start()
+    assert reporter.running
+
+    for i in range(7):
+
+        async def report(i_=i):
+            calls.append(i_)
+
+        assert reporter.submit(report) is True
+
+    assert calls == []
+    await reporter.flush()
+    assert calls == [0, 1, 2, 3, 4, 5, 6]
+    await reporter.shutdown()
+    assert not reporter.running
+
+
+async def test_reporter_full(caplog):
+    calls = []
+    reporter = ErrorReporter(max_size=2)
+    reporter.start()
+
+    async def report():
+        calls.append(1)
+
+    assert reporter.submit(report) is True
+    assert reporter.submit(report) is True
+    assert reporter.submit(report) is False
+    assert reporter.submit(report) is False
+    assert reporter.dropped == 2
+
+    await reporter.shutdown()
+    assert calls == [1, 1]
+    assert reporter.dropped == 0
+    assert 'error report queue full, 2 reports dropped' in caplog.text
+
+
+async def test_reporter_error(caplog):
+    calls = []
+    reporter = ErrorReporter()
+    reporter.start()
+
+    async def broken_report():
+        raise RuntimeError('broken')
+
+    async def report():
+        calls.append(1)
+
+    reporter.submit(broken_report)
+    reporter.submit(report)
+    await reporter.shutdown()
+    assert calls == [1]
+    assert 'error running error report' in caplog.text
+
+
+async def test_shutdown_flushes(caplog):
+    calls = []
+    reporter = ErrorReporter()
+    reporter.start()
+
+    async def slow_report():
+        await asyncio.sleep(0.01)
+        calls.append(1)
+
+    for _ in range(3):
+        reporter.submit(slow_report)
+    await reporter.shutdown()
+    assert calls == [1, 1, 1]
+
+
+async def test_error_middleware_reports_after_response(create_request, monkeypatch, caplog):
+    caplog.set_level(logging.WARNING, 'foxglove.bad_requests')
+    reporter = ErrorReporter()
+    reporter.start()
+    monkeypatch.setattr(glove, 'error_reporter', reporter, raising=False)
+
+    async def app(scope, receive, send):
+        await Response('{"error": "bad"}', status_code=400)(scope, receive, send)
+
+    sent = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        sent.append(message['type'])
+
+    request = create_request(path='/foo/')
+    await ErrorMiddleware(app)(request.scope, receive, send)
+    assert sent == ['http.response.start', 'http.response.body']
+    assert caplog.records == []
+
+    await reporter.shutdown()
+    assert len(caplog.records) == 1
+    assert '"GET /foo/", unexpected response: 400' in caplog.text
+    assert caplog.records[0].extra['response_body'] == {'error': 'bad'}
+
+
+class UserConn(FakeConn):
+    def result(self, method, sql, args):
+        return 'anne'
+
+
+async def test_error_middleware_get_user_db(settings, create_request, monkeypatch, caplog):
+    caplog.set_level(logging.WARNING, 'foxglove.bad_requests')
+    pool = FakePool()
+    pool.conn_class = UserConn
+    monkeypatch.setattr(glove, 'pg', pool, raising=False)
+    monkeypatch.setattr(glove, 'pg_read', pool, raising=False)
+    reporter = ErrorReporter()
+    reporter.start()
+    monkeypatch.setattr(glove, 'error_reporter', reporter, raising=False)
+
+    async def get_user(request):
+        conn = await get_db(request)
+        return {'username': await conn.fetchval('select name from users where id=$1', 1)}
+
+    async def app(scope, receive, send):
+        await get_db(Request(scope, receive))
+        await Response('bad', status_code=400)(scope, receive, send)
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        pass
+
+    app = ErrorMiddleware(PgMiddleware(app), get_user=get_user)
+    await app(create_request(path='/foo/').scope, receive, send)
+    # get_user ran before the report was queued and the connection it acquired has been released
+    assert pool.released == ['primary', 'primary']
+    assert pool.conns[1].calls == [('fetchval', 'select name from users where id=$1', (1,))]
+    assert caplog.records == []
+
+    await reporter.shutdown()
+    assert len(caplog.records) == 1
+    assert caplog.records[0].user['username'] == 'anne'
+
+
+async def test_event_rate_limiter(mocker):
+    now = mocker.patch('foxglove.reporting.monotonic', return_value=100)
+    limiter = EventRateLimiter(burst=2, window=10)
+    assert await limiter.check('a') == 0
+    assert await limiter.check('a') == 0
+    assert await limiter.check('a') is None
+    assert await limiter.check('a') is None
+    assert await limiter.check('b') == 0
+
+    now.return_value = 104
+    assert await limiter.check('a') is None
+    now.return_value = 105
+    assert await limiter.check('a') == 3
+    assert await limiter.check('a') is None
+
+
+async def test_event_rate_limiter_max_fingerprints():
+    limiter = EventRateLimiter(burst=1, max_fingerprints=2)
+    assert await limiter.check('a') == 0
+    assert await limiter.check('b') == 0
+    assert await limiter.check('c') == 0
+    assert list(limiter._buckets) == ['b', 'c']
+    assert await limiter.check('a') == 0
+
+
+async def test_event_rate_limiter_pop_suppressed():
+    limiter = EventRateLimiter(burst=1, window=10)
+    assert await limiter.check('a', 'first') == 0
+    assert await limiter.check('a', 'second') is None
+    assert await limiter.check('a', 'third') is None
+    assert await limiter.check('b', 'other') == 0
+    assert await limiter.pop_suppressed() == [('a', 'third', 2)]
+    assert await limiter.pop_suppressed() == []
+
+
+async def test_reporter_summary(caplog):
+    caplog.set_level(logging.WARNING, 'foxglove.bad_requests')
+    limiter = EventRateLimiter(burst=1, window=10)
+    reporter = ErrorReporter(event_limiter=limiter, summary_interval=0.01)
+    reporter.start()
+    for _ in range(4):
+        await limiter.check(('/foo/', 'GET', '500'), '"GET /foo/", unexpected response: 500')
+    # the storm has stopped, the summary is still reported
+    await asyncio.sleep(0.05)
+    assert caplog.messages == ['"GET /foo/", unexpected response: 500, suppressed 3 similar events']
+    assert caplog.records[0].suppressed_events == 3
+    await reporter.shutdown()
+    assert len(caplog.records) == 1
+
+
+async def test_event_rate_limiter_redis(glove, mocker):
+    now = mocker.patch('foxglove.reporting.time', return_value=1000)
+    limiter = EventRateLimiter(burst=2, window=10, redis=glove.redis)
+    other_worker = EventRateLimiter(burst=2, window=10, redis=glove.redis)
+    assert await limiter.check('a', 'msg') == 0
+    assert await other_worker.check('a', 'msg') == 0
+    assert await limiter.check('a', 'msg') is None
+    assert await other_worker.check('a', 'msg') is None
+    assert await limiter.check('b', 'msg') == 0
+    # the window hasn't finished
+    assert await limiter.pop_suppressed() == []
+
+    now.return_value = 1010
+    assert await limiter.pop_suppressed() == [('a', 'msg', 2)]
+    # the count was deleted so it's only reported once
+    assert await other_worker.pop_suppressed() == []
+    assert await limiter.check('a', 'msg') == 0
+
+    for _ in range(4):
+        await limiter.check('a', 'msg')
+    now.return_value = 1020
+    assert await limiter.check('a', 'msg') == 3
+    assert await limiter.pop_suppressed() == []
+
+
+async def test_error_middleware_suppressed(create_request, monkeypatch, caplog):
+    caplog.set_level(logging.WARNING, 'foxglove.bad_requests')
+    monkeypatch.setattr(glove, 'event_limiter', EventRateLimiter(burst=1, window=0.01), raising=False)
+
+    async def app(scope, receive, send):
+        await Response('bad', status_code=404)(scope, receive, send)
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        pass
+
+    for _ in range(3):
+        await ErrorMiddleware(app)(create_request(path='/foo/').scope, receive, send)
+    assert len(caplog.records) == 1
+
+    await asyncio.sleep(0.02)
+    await ErrorMiddleware(app)(create_request(path='/foo/').scope, receive, send)
+    assert len(caplog.records) == 2
+    assert '"GET /foo/", unexpected response: 404, suppressed 2 similar events' in caplog.text
+    assert caplog.records[1].extra['suppressed_events'] == 2
@@ -0,0 +1,149 @@
+import json
+from datetime import date
+from decimal import Decimal
+
+import pytest
+
+from foxglove.db.cursor import iter_rows_b
+from foxglove.db.json_codecs import RawJSON, raw_json, raw_jsonb
+from foxglove.responses import (
+    CSVResponse,
+    JSONArrayResponse,
+    NDJSONResponse,
+    RawJSONResponse,
+    StreamingRawJSONResponse,
+    StreamingRowsResponse,
+    json_bytes,
+)
+from tests.conftest import FakeConn
+
+pytestmark = pytest.mark.asyncio
+
+
+@pytest.mark.parametrize(
+    'value,expected',
+    [
+        (RawJSON(b'{"a": 1}'), b'{"a": 1}'),
+        ('{"a": 1}', b'{"a": 1}'),
+        ({'a': 1}, b'{"a":1}'),
+        (None, b'null'),
+    ],
+)
+async def test_json_bytes(value, expected):
+    assert json_bytes(value) == expected
+
+
+async def test_from_query():
+    conn = FakeConn(value=RawJSON(b'{"count": 3}'))
+    r = await RawJSONResponse.from_query(conn, "select json_build_object('count', count(*)) from users where x=$1", 1)
+    assert r.body == b'{"count": 3}'
+    assert r.headers['content-type'] == 'application/json'
+    assert conn.calls == [('fetchval', "select json_build_object('count', count(*)) from users where x=$1", (1,))]
+
+
+async def test_from_rows():
+    conn = FakeConn(value='[{"id": 1}]')
+    r = await RawJSONResponse.from_rows(conn, 'select id from users', status_code=201)
+    assert r.body == b'[{"id": 1}]'
+    assert r.status_code == 201
+    assert conn.calls == [('fetchval', "select coalesce(json_agg(t), '[]') from (select id from users) t", ())]
+
+
+async def stream_body(response):
+    return b''.join([chunk async for chunk in response.body_iterator])
+
+
+@pytest.mark.parametrize(
+    'rows,expected',
+    [
+        ([], b'[]'),
+        ([('{"id": 1}',), (RawJSON(b'{"id": 2}'),)], b'[{"id": 1},{"id": 2}]'),
+    ],
+)
+async def test_streaming(rows, expected):
+    conn = FakeConn(rows=rows)
+    r = StreamingRawJSONResponse(conn, 'select id from users where x=$1', 1, prefetch=10)
+    assert await stream_body(r) == expected
+    assert conn.calls == [
+        ('begin',),
+        ('cursor', 'select row_to_json(t) from (select id from users where x=$1) t', (1,), 10),
+        ('commit',),
+    ]
+
+
+async def test_streaming_chunks(monkeypatch):
+    monkeypatch.setattr('foxglove.responses.stream_chunk_size', 20)
+    conn = FakeConn(rows=[(f'{{"id": {i}}}',) for i in range(5)])
+    r = StreamingRawJSONResponse(conn, 'select id from users')
+    chunks = [chunk async for chunk in r.body_iterator]
+    assert chunks == [b'[{"id": 0},{"id": 1}', b',{"id": 2},{"id": 3}', b',{"id": 4}]']
+
+
+async def aiter_rows(rows):
+    for row in rows:
+        yield row
+
+
+rows = [
+    {'id': 1, 'name': 'anne', 'created': date(2032, 1, 1), 'balance': Decimal('1.50')},
+    {'id': 2, 'name': 'ben, "b"', 'created': None, 'balance': Decimal('0')},
+]
+
+
+async def test_json_array():
+    r = JSONArrayResponse(aiter_rows(rows))
+    assert r.media_type == 'application/json'
+    assert json.loads(await stream_body(r)) == [
+        {'id': 1, 'name': 'anne', 'created': '2032-01-01', 'balance': '1.50'},
+        {'id': 2, 'name': 'ben, "b"', 'created': None, 'balance': '0'},
+    ]
+    assert await stream_body(JSONArrayResponse(aiter_rows([]))) == b'[]'
+
+
+async def test_ndjson():
+    r = NDJSONResponse(aiter_rows(rows))
+    assert r.headers['content-type'] == 'application/x-ndjson'
+    assert await stream_body(r) == (
+        b'{"id":1,"name":"anne","created":"2032-01-01","balance":"1.50"}\n'
+        b'{"id":2,"name":"ben, \\"b\\"","created":null,"balance":"0"}\n'
+    )
+
+
+async def test_csv():
+    r = CSVResponse(aiter_rows(rows))
+    assert r.headers['content-type'] == 'text/csv; charset=utf-8'
+    assert await stream_body(r) == (b'id,name,created,balance\r\n1,anne,2032-01-01,1.50\r\n2,"ben, ""b""",,0\r\n')
+    assert await stream_body(CSVResponse(aiter_rows(rows), columns=['name'])) == b'name\r\nanne\r\n"ben, ""b"""\r\n'
+    assert await stream_body(CSVResponse(aiter_rows([]), columns=['id', 'name'])) == b'id,name\r\n'
+    assert await stream_body(CSVResponse(aiter_rows([]))) == b''
+
+
+# values as returned by the "raw" json codec
+raw_rows = [
+    {'id': 1, 'data': raw_jsonb(b'\x01{"a": 1}'), 'tags': raw_json(b'["x", "y"]')},
+    {'id': 2, 'data': raw_jsonb(b'\x01null'), 'tags': None},
+]
+
+
+async def test_raw_json_rows():
+    assert json.loads(await stream_body(JSONArrayResponse(aiter_rows(raw_rows)))) == [
+        {'id': 1, 'data': {'a': 1}, 'tags': ['x', 'y']},
+        {'id': 2, 'data': None, 'tags': None},
+    ]
+    assert await stream_body(NDJSONResponse(aiter_rows(raw_rows))) == (
+        b'{"id":1,"data":{"a": 1},"tags":["x", "y"]}\n{"id":2,"data":null,"tags":null}\n'
+    )
+    assert await stream_body(CSVResponse(aiter_rows(raw_rows))) == (
+        b'id,data,tags\r\n1,"{""a"": 1}","[""x"", ""y""]"\r\n2,null,\r\n'
+    )
+
+
+async def test_rows_response_abstract():
+    with pytest.raises(TypeError):
+        StreamingRowsResponse(aiter_rows([]))
+
+
+async def test_iter_rows():
+    conn = FakeConn(rows=rows)
+    assert [r async for r in iter_rows_b(conn, 'select * from users where id > :id', id=0, prefetch=5)] == rows
+    assert conn.calls == [('begin',), ('cursor', 'select * from users where id > $1', (0,), 5), ('commit',)]
@@ -0,0 +1,93 @@
+from starlette.middleware.sessions import SessionMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.websockets import WebSocket
+
+from foxglove.db.middleware import GetPgConn
+from foxglove.stack import FoxgloveMiddleware
+from foxglove.testing import TestClient as Client
+
+
+async def session_app(scope, receive, send):
+    request = Request(scope, receive)
+    if request.query_params.get('error'):
+        raise RuntimeError('broken')
+    if value := request.query_params.get('set'):
+        request.session['value'] = value
+    data = {'session': request.session, 'pg': isinstance(getattr(request.state, 'get_pg_conn', None), GetPgConn)}
+    await JSONResponse(data)(scope, receive, send)
+
+
+def test_session_csrf(settings):
+    client = Client(FoxgloveMiddleware(session_app))
+    r = client.post('/')
+    assert r.status_code == 403, r.text
+    assert r.json() == {'message': 'Permission Denied, no session set, updates not permitted'}
+
+    r = client.get('/', params={'set': 'foo'})
+    assert r.status_code == 200, r.text
+    # session_id is added to the session as the response starts
+    assert r.json() == {'session': {'value': 'foo'}, 'pg': True}
+    assert r.headers['set-cookie'].endswith('; path=/; Max-Age=1209600; httponly; samesite=strict')
+
+    session_id = client.get('/').json()['session']['session_id']
+
+    r = client.post('/')
+    assert r.status_code == 200, r.text
+    assert r.json() == {'session': {'session_id': session_id, 'value': 'foo'}, 'pg': True}
+
+
+def test_session_starlette_compatible(settings):
+    client = Client(FoxgloveMiddleware(session_app, csrf=False, pg=False))
+    r = client.get('/', params={'set': 'foo'})
+    assert r.json() == {'session': {'value': 'foo'}, 'pg': False}
+
+    starlette_app = SessionMiddleware(session_app, secret_key=settings.secret_key, session_cookie=settings.cookie_name)
+    starlette_client = Client(starlette_app)
+    starlette_client.cookies = client.cookies
+    assert starlette_client.get('/').json() == {'session': {'value': 'foo'}, 'pg': False}
+
+
+def test_host_redirect(settings):
+    client = Client(FoxgloveMiddleware(session_app, host_redirect='example.com'))
+    r = client.get('/foo/?a=1', allow_redirects=False)
+    assert r.status_code == 301, r.text
+    assert r.headers['location'] == 'http://example.com/foo/?a=1'
+    assert 'set-cookie' not in r.headers
+
+
+def test_cloudflare_check(settings, caplog):
+    client = Client(FoxgloveMiddleware(session_app, cloudflare_check=True))
+    r = client.get('/')
+    assert r.status_code == 400, r.text
+    assert 'Request not routed through CloudFlare ip=testclient' in caplog.text
+
+    r = client.get('/', headers={'x-forwarded-for': '1.2.3.4, 173.245.48.1'})
+    assert r.status_code == 200, r.text
+
+
+def test_error(settings, caplog):
+    client = Client(FoxgloveMiddleware(session_app), raise_server_exceptions=False)
+    r = client.get('/', params={'error': '1'})
+    assert r.status_code == 500, r.text
+    assert r.text == 'Internal Server Error'
+    assert '"GET /?error=1", RuntimeError(\'broken\')' in caplog.text
+
+
+async def session_websocket_app(scope, receive, send):
+    websocket = WebSocket(scope, receive, send)
+    await websocket.accept()
+    await websocket.send_json(websocket.session)
+    await websocket.close()
+
+
+def test_websocket_session(settings):
+    client = Client(FoxgloveMiddleware(session_app))
+    client.get('/', params={'set': 'foo'})
+    session = client.get('/').json()['session']
+    assert session['value'] == 'foo'
+
+    ws_client = Client(FoxgloveMiddleware(session_websocket_app))
+    ws_client.cookies = client.cookies
+    with ws_client.websocket_connect('/') as websocket:
+        assert websocket.receive_json() == session
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import re
+
+import httpx
+import pytest
+from starlette.responses import Response
+
+from foxglove.middleware import ErrorMiddleware
+from foxglove.timing import (
+    current_timings,
+    http_request_hook,
+    http_response_hook,
+    reset_timings,
+    start_timings,
+    timed,
+    timed_redis_execute,
+)
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_timed():
+    with timed('db'):
+        pass
+    assert current_timings() is None
+
+    token = start_timings(0)
+    try:
+        timings = current_timings()
+        assert timings.sampled is False
+        with timed('db'):
+            await asyncio.sleep(0.001)
+        with timed('db'):
+            pass
+        with timed('redis'):
+            pass
+        assert timings.phases['db'][1] == 2
+        assert timings.phases['db'][0] >= 0.001
+        assert list(timings.as_dict()) == ['db', 'redis']
+        assert re.fullmatch(
+            r'db;dur=[\d.]+;desc="2", redis;dur=[\d.]+;desc="1", total;dur=[\d.]+', timings.server_timing()
+        )
+    finally:
+        reset_timings(token)
+    assert current_timings() is None
+
+
+async def test_sampled():
+    token = start_timings(1)
+    assert current_timings().sampled is True
+    reset_timings(token)
+
+
+async def test_redis_execute():
+    async def execute(command, *args):
+        return command
+
+    wrapped = timed_redis_execute(execute)
+    assert await wrapped('GET', 'foo') == 'GET'
+
+    token = start_timings(0)
+    try:
+        assert await wrapped('GET', 'foo') == 'GET'
+        assert current_timings().phases['redis'][1] == 1
+    finally:
+        reset_timings(token)
+
+
+async def test_http_hooks():
+    transport = httpx.MockTransport(lambda request: httpx.Response(200, text='ok'))
+    event_hooks = {'request': [http_request_hook], 'response': [http_response_hook]}
+    async with httpx.AsyncClient(transport=transport, event_hooks=event_hooks) as client:
+        assert (await client.get('https://example.com')).text == 'ok'
+
+        token = start_timings(0)
+        try:
+            await client.get('https://example.com')
+            await client.get('https://example.com')
+            assert current_timings().phases['http'][1] == 2
+        finally:
+            reset_timings(token)
+
+
+async def test_error_middleware_server_timing(create_request, settings, monkeypatch, caplog):
+    caplog.set_level(logging.WARNING, 'foxglove.bad_requests')
+    monkeypatch.setattr(settings, 'server_timing_sample_rate', 1)
+
+    async def app(scope, receive, send):
+        with timed('db'):
+            pass
+        await Response('bad', status_code=400)(scope, receive, send)
+
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        messages.append(message)
+
+    await ErrorMiddleware(app)(create_request(path='/foo/').scope, receive, send)
+    headers = dict(messages[0]['headers'])
+    assert re.fullmatch(rb'db;dur=[\d.]+;desc="1", total;dur=[\d.]+', headers[b'server-timing'])
+    assert current_timings() is None
+
+    assert len(caplog.records) == 1
+    assert list(caplog.records[0].extra['timings']) == ['db']
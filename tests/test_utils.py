@@ -1,6 +1,6 @@
 import pytest
 
-from foxglove.utils import dict_not_none, list_not_none
+from foxglove.utils import LazyDict, dict_not_none, list_not_none
 
 
 def test_list_not_none():
@@ -16,3 +16,29 @@ def test_dict_not_none():
         dict_not_none({'a': 1}, {'b': None})
     with pytest.raises(TypeError, match='dict_not_none must be a dict, got list'):
         dict_not_none([1])
+
+
+def test_lazy_dict():
+    calls = []
+
+    def factory():
+        calls.append(1)
+        return 'lazy'
+
+    d = LazyDict(a=1)
+    d.set_lazy('b', factory)
+    assert len(d) == 2
+    assert 'b' in d
+    assert calls == []
+    assert d['b'] == 'lazy'
+    assert d['b'] == 'lazy'
+    assert calls == [1]
+    assert dict(d) == {'a': 1, 'b': 'lazy'}
+
+    d.set_lazy('c', factory)
+    d['c'] = 'eager'
+    del d['a']
+    assert dict(d) == {'b': 'lazy', 'c': 'eager'}
+    assert calls == [1]
+    with pytest.raises(KeyError):
+        d['missing']